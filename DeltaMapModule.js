@@ -0,0 +1,80 @@
+var DeltaMapModule = function (view, zoom, map_width, map_height, viewport) {
+  // Create the map tag:
+  var map_tag = "<div style='width:" + map_width + "px; height:" + map_height + "px;border:1px dotted' id='mapid'></div>"
+  // Append it to body:
+  var div = $(map_tag)[0]
+  $('#elements').append(div)
+
+  // Create Leaflet map, the NDVI and density overlays and the Animal layer
+  var Lmap = L.map('mapid').setView(view, zoom)
+  var NDVIOverlay = null
+  var DensityOverlay = null
+  var AnimalLayer = L.layerGroup().addTo(Lmap)
+  // Animal markers by animal id
+  var markers = {}
+
+  // create the OSM tile layer with correct attribution
+  var osmUrl = 'http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png'
+  var osmAttrib = 'Map data © <a href="http://openstreetmap.org">OpenStreetMap</a> contributors'
+  var osm = new L.TileLayer(osmUrl, { minZoom: 0, maxZoom: 18, attribution: osmAttrib })
+  Lmap.addLayer(osm)
+
+  // Tell the server which part of the map is visible, so it only sends those animals
+  var sendViewport = function () {
+    if (!viewport || ws.readyState !== WebSocket.OPEN) return
+    var bounds = Lmap.getBounds()
+    send({ type: 'viewport', bounds: [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()] })
+  }
+  Lmap.on('moveend', sendViewport)
+  ws.addEventListener('open', sendViewport)
+
+  this.render = function (data) {
+    // NDVI layer, only sent when it changed
+    if (data.ndvi) {
+      if (NDVIOverlay) NDVIOverlay.remove()
+      NDVIOverlay = L.imageOverlay(data.ndvi.url, data.ndvi.bounds, { opacity: 0.8 }).addTo(Lmap)
+      if (DensityOverlay) DensityOverlay.bringToFront()
+    }
+
+    // Animal density, only sent when the model stepped
+    if (data.density) {
+      if (DensityOverlay) {
+        DensityOverlay.setUrl(data.density.url)
+      } else {
+        DensityOverlay = L.imageOverlay(data.density.url, data.density.bounds, { opacity: 0.6 }).addTo(Lmap)
+      }
+    }
+
+    data.removed.forEach(function (id) {
+      if (markers[id]) {
+        AnimalLayer.removeLayer(markers[id])
+        delete markers[id]
+      }
+    })
+
+    data.added.forEach(function (animal) {
+      if (markers[animal[0]]) AnimalLayer.removeLayer(markers[animal[0]])
+      markers[animal[0]] = L.circleMarker([animal[1], animal[2]], { radius: animal[3], color: animal[4] })
+        .bindPopup('<table><tr><td>animal</td><td>' + animal[0] + '</td></tr><tr><td>animal_count</td><td>' +
+                   animal[5] + '</td></tr></table>')
+        .addTo(AnimalLayer)
+    })
+
+    data.moved.forEach(function (animal) {
+      if (markers[animal[0]]) markers[animal[0]].setLatLng([animal[1], animal[2]])
+    })
+  }
+
+  this.reset = function () {
+    AnimalLayer.clearLayers()
+    markers = {}
+    if (NDVIOverlay) {
+      NDVIOverlay.remove()
+      NDVIOverlay = null
+    }
+    if (DensityOverlay) {
+      DensityOverlay.remove()
+      DensityOverlay = null
+    }
+  }
+}
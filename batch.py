@@ -0,0 +1,289 @@
+"""
+
+Use this file to run the model headless, e.g. for parameter sweeps.
+
+"""
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+import pandas as pd
+from model import AnimalModel, get_survey_polygon
+from recorder import TrajectoryRecorder, segment_path
+from density import model_density
+from survey_coverage import get_coverage_index
+from checkpoint import Checkpointer, restore_state
+from boundary import BOUNDARY_MODES
+from preprocess import get_2008_population_data, get_2017_population_data, get_census_store
+
+# Datasets loaded by the parent process, inherited by forked workers
+_DATASETS = {}
+
+
+def load_datasets(years, cloudmasks, coverage=False) -> dict:
+    """Load census and NDVI data once, for all combinations in a sweep.
+    :param years: Census years to load, 2008 and/or 2017.
+    :param cloudmasks: Cloudmask settings to load NDVI data for.
+    :param coverage: Also load the block and flight strip coverage of every NDVI layer.
+
+    Returns: Dictionary with ('census', year) -> {species: gdf}, ('ndvi', cloudmask) -> gdf_ndvi and
+             optionally ('coverage', cloudmask) -> CoverageIndex.
+    """
+
+    # Import here, so runs on datasets already in memory do not need xarray and rasterio
+    from sentinel import get_ndvi_gdf
+
+    loaders = {2008: get_2008_population_data, 2017: get_2017_population_data}
+    datasets = {}
+    for year in years:
+        datasets[('census', year)] = {name: gdf for gdf, name in loaders[year]()}
+    for cloudmask in cloudmasks:
+        datasets[('ndvi', cloudmask)] = get_ndvi_gdf(preload=True, cloudmask=cloudmask,
+                                                     survey_area=get_survey_polygon())
+        if coverage:
+            datasets[('coverage', cloudmask)] = get_coverage_index(datasets[('ndvi', cloudmask)])
+    return datasets
+
+
+def _set_datasets(datasets) -> None:
+    """Worker initializer for start methods that cannot fork."""
+    _DATASETS.update(datasets)
+
+
+def run_model(params, steps, datasets=None) -> dict:
+    """Run a single model headless and summarize its final state.
+    :param params: Dictionary with year, species ('EL+BF' runs both in one model), cloudmask, mobility_range,
+                   replicate and optionally engine, movement, boundary, movement_noise, record_path,
+                   record_interval, ndvi_interval, checkpoint_path, checkpoint_interval and density_bandwidth.
+                   A run with an existing checkpoint resumes from it, and records into files with the
+                   resumed step in their name, e.g. run.step100.parquet. With density_bandwidth, the recorded
+                   statistics and the summary include the peak density and core area of the animals. With
+                   block_path, observed and simulated counts per census block are written there every
+                   block_interval steps; this needs the coverage datasets.
+    :param steps: Number of steps to run.
+    :param datasets: Datasets from load_datasets, defaults to the ones shared with this process.
+
+    Returns: Dictionary with the parameters and summary statistics of the run.
+    """
+
+    datasets = _DATASETS if datasets is None else datasets
+    # Species joined by '+' share one model
+    census = datasets[('census', params['year'])]
+    animal_data = [(census[name], name) for name in params['species'].split('+')]
+    gdf_ndvi = datasets[('ndvi', params['cloudmask'])]
+
+    # Optionally step through the NDVI dates, opened per process for its own reader thread
+    ndvi_series = None
+    if params.get('ndvi_interval'):
+        from sentinel import get_ndvi_series
+        ndvi_series = get_ndvi_series(params['cloudmask'], get_survey_polygon())
+
+    # Optionally write checkpoints, to resume the run if it is interrupted
+    checkpointer = None
+    if params.get('checkpoint_path'):
+        checkpointer = Checkpointer(params['checkpoint_path'], interval=params.get('checkpoint_interval', 100))
+
+    # Optionally count the animals per census block, against the census
+    blocks = []
+    coverage = datasets[('coverage', params['cloudmask'])] if params.get('block_path') else None
+
+    def count_blocks():
+        counts = coverage.compare(model, get_census_store(), params['year'])
+        blocks.append(counts.reset_index().assign(step=model.steps))
+
+    start = time.perf_counter()
+    model = AnimalModel(animal_data, gdf_ndvi, None, gdf_ndvi['value'],
+                        engine=params.get('engine', 'array'),
+                        movement=params.get('movement', 'global'),
+                        boundary=params.get('boundary', 'stay'),
+                        mobility_range=params['mobility_range'],
+                        movement_noise=params.get('movement_noise', 0.0),
+                        seed=params['replicate'],
+                        ndvi_series=ndvi_series,
+                        ndvi_interval=params.get('ndvi_interval') or 10,
+                        checkpointer=checkpointer)
+    x_start, y_start, counts = model.animal_positions()
+    x_start, y_start = x_start.copy(), y_start.copy()
+    if checkpointer is not None and os.path.exists(params['checkpoint_path']):
+        restore_state(model, params['checkpoint_path'])
+        print(f"Resumed at step {model.steps} from {params['checkpoint_path']}")
+
+    # Optionally stream trajectories to disk, from the step the model starts at. A resumed run records
+    # into files of its own, named after that step, and a finished one records nothing
+    recorder = None
+    if params.get('record_path') and model.steps < steps:
+        root, ext = os.path.splitext(segment_path(params['record_path'], model.steps))
+        # Statistics next to the trajectories, in the same format
+        recorder = TrajectoryRecorder(root + ext,
+                                      interval=params.get('record_interval', 1),
+                                      stats_path=root + '.stats' + ext,
+                                      density_bandwidth=params.get('density_bandwidth'))
+        model.recorder = recorder
+        recorder.collect(model)
+    setup_time = time.perf_counter() - start
+
+    if coverage is not None:
+        count_blocks()
+    while model.steps < steps:
+        model.step()
+        if coverage is not None and model.steps % params.get('block_interval', 1) == 0:
+            count_blocks()
+    x, y, counts = model.animal_positions()
+    summary = {}
+    if params.get('density_bandwidth'):
+        summary.update(model_density(model, bandwidth=params['density_bandwidth']).summary())
+    if coverage is not None:
+        blocks = pd.concat(blocks, ignore_index=True)
+        blocks.to_parquet(params['block_path'], index=False)
+        final = blocks[blocks['step'] == blocks['step'].max()]
+        # How well a survey of the simulated animals would match the census, block by block
+        summary['block_correlation'] = final['observed'].corr(final['simulated_in_strip'])
+    if recorder is not None:
+        recorder.close()
+    if checkpointer is not None:
+        # Final state too, so running the sweep again returns at once
+        checkpointer.save(model)
+        checkpointer.close()
+    if ndvi_series is not None:
+        ndvi_series.close()
+    model.profile_report()
+
+    displacement = np.hypot(x - x_start, y - y_start)
+    return dict(params,
+                steps=steps,
+                animals=len(x),
+                mean_x=np.average(x, weights=counts),
+                mean_y=np.average(y, weights=counts),
+                mean_displacement=displacement.mean(),
+                moved_fraction=np.mean(displacement > 0),
+                **summary,
+                setup_seconds=setup_time,
+                run_seconds=time.perf_counter() - start - setup_time)
+
+
+def _run_job(job) -> dict:
+    params, steps = job
+    return run_model(params, steps)
+
+
+def sweep(mobility_ranges, species=('EL', 'BF'), years=(2017,), cloudmasks=(True,),
+          replicates=1, steps=100, processes=None, engine='array', movement='global', boundary='stay',
+          movement_noise=0.0, record_dir=None, record_interval=1, ndvi_interval=None, checkpoint_dir=None,
+          checkpoint_interval=100, density_bandwidth=None, block_dir=None, block_interval=1) -> pd.DataFrame:
+    """Run all combinations of parameters across a process pool.
+    Data is loaded once in this process; forked workers share it copy-on-write.
+    :param mobility_ranges: Mobility ranges to sweep.
+    :param species: Species to sweep, 'EL', 'BF' and/or 'EL+BF' to model both together.
+    :param years: Census years to sweep, 2008 and/or 2017.
+    :param cloudmasks: Cloudmask settings to sweep.
+    :param replicates: Number of replicates per combination, each with its own seed. More than one needs
+                       movement_noise, without it every replicate repeats the same run.
+    :param steps: Number of steps per run.
+    :param processes: Number of worker processes, defaults to the number of CPUs.
+    :param engine: Stepping engine of the model.
+    :param movement: Movement mode of the model.
+    :param boundary: Boundary rule of the model.
+    :param movement_noise: Standard deviation of the random displacement of every move, in census CRS units.
+    :param record_dir: Optional directory to write a trajectory file per run to.
+    :param record_interval: Record every record_interval-th step.
+    :param ndvi_interval: Switch to the next NDVI date every ndvi_interval steps, None for a single date.
+    :param checkpoint_dir: Optional directory to write a checkpoint per run to. Running the same sweep
+                           again resumes every run from its checkpoint.
+    :param checkpoint_interval: Write a checkpoint every checkpoint_interval-th step.
+    :param density_bandwidth: Kernel standard deviation for density summaries of the animals, in units of
+                              the census CRS; None leaves them out.
+    :param block_dir: Optional directory to write observed and simulated counts per census block to,
+                      one file per run.
+    :param block_interval: Count the animals per block every block_interval-th step.
+
+    Returns: DataFrame with one row per run.
+    """
+
+    if replicates > 1 and not movement_noise:
+        raise ValueError("Replicates of a model without movement_noise are identical, set movement_noise")
+
+    datasets = load_datasets(years, cloudmasks, coverage=block_dir is not None)
+    jobs = [(dict(year=year, species=name, cloudmask=cloudmask, mobility_range=mobility_range,
+                  replicate=replicate, engine=engine, movement=movement, boundary=boundary,
+                  movement_noise=movement_noise, ndvi_interval=ndvi_interval,
+                  density_bandwidth=density_bandwidth), steps)
+            for year, name, cloudmask, mobility_range, replicate in itertools.product(
+                years, species, cloudmasks, mobility_ranges, range(replicates))]
+    if record_dir is not None:
+        os.makedirs(record_dir, exist_ok=True)
+        for run, (params, _) in enumerate(jobs):
+            params['record_path'] = os.path.join(record_dir, f'run_{run}.parquet')
+            params['record_interval'] = record_interval
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for run, (params, _) in enumerate(jobs):
+            params['checkpoint_path'] = os.path.join(checkpoint_dir, f'run_{run}.arrow')
+            params['checkpoint_interval'] = checkpoint_interval
+    if block_dir is not None:
+        os.makedirs(block_dir, exist_ok=True)
+        for run, (params, _) in enumerate(jobs):
+            params['block_path'] = os.path.join(block_dir, f'run_{run}.blocks.parquet')
+            params['block_interval'] = block_interval
+    print(f"Running {len(jobs)} models...")
+
+    if 'fork' in mp.get_all_start_methods():
+        # Workers inherit the loaded data, nothing is re-read or pickled
+        _DATASETS.update(datasets)
+        pool = mp.get_context('fork').Pool(processes)
+    else:
+        pool = mp.get_context().Pool(processes, initializer=_set_datasets, initargs=(datasets,))
+
+    with pool:
+        results = pool.map(_run_job, jobs, chunksize=1)
+    print("All models finished!")
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run parameter sweeps of the animal model without visualization.")
+    parser.add_argument('--steps', type=int, default=100, help="Steps per run.")
+    parser.add_argument('--mobility', type=float, nargs='+', default=[0.1], help="Mobility ranges to sweep.")
+    parser.add_argument('--species', nargs='+', default=['EL', 'BF'], choices=['EL', 'BF', 'EL+BF'],
+                        help="Species to sweep, EL+BF runs both in one model.")
+    parser.add_argument('--years', type=int, nargs='+', default=[2017], choices=[2008, 2017],
+                        help="Census years to sweep.")
+    parser.add_argument('--cloudmask', nargs='+', default=['on'], choices=['on', 'off'],
+                        help="Cloudmask settings to sweep.")
+    parser.add_argument('--replicates', type=int, default=1,
+                        help="Replicates per combination, needs --movement-noise.")
+    parser.add_argument('--processes', type=int, default=None, help="Worker processes, defaults to all CPUs.")
+    parser.add_argument('--engine', default='array', choices=AnimalModel.ENGINES, help="Stepping engine.")
+    parser.add_argument('--movement', default='global', choices=AnimalModel.MOVEMENTS, help="Movement mode.")
+    parser.add_argument('--boundary', default='stay', choices=BOUNDARY_MODES,
+                        help="Rule for moves that would leave the survey area.")
+    parser.add_argument('--movement-noise', type=float, default=0.0,
+                        help="Standard deviation of the random displacement of every move, in census CRS units.")
+    parser.add_argument('--output', default='batch_results.csv', help="CSV file to write results to.")
+    parser.add_argument('--record', default=None, help="Directory to write per-run trajectory files to.")
+    parser.add_argument('--record-interval', type=int, default=1, help="Record every n-th step.")
+    parser.add_argument('--ndvi-interval', type=int, default=None,
+                        help="Step through the NDVI time series, switching dates every n steps.")
+    parser.add_argument('--checkpoint', default=None,
+                        help="Directory to write per-run checkpoints to, and to resume runs from.")
+    parser.add_argument('--checkpoint-interval', type=int, default=100, help="Write a checkpoint every n steps.")
+    parser.add_argument('--density-bandwidth', type=float, default=None,
+                        help="Kernel bandwidth of per-step density summaries, in census CRS units.")
+    parser.add_argument('--blocks', default=None,
+                        help="Directory to write per-run observed and simulated counts per census block to.")
+    parser.add_argument('--block-interval', type=int, default=1, help="Count animals per block every n steps.")
+    args = parser.parse_args()
+
+    results = sweep(args.mobility, species=args.species, years=args.years,
+                    cloudmasks=[mask == 'on' for mask in args.cloudmask],
+                    replicates=args.replicates, steps=args.steps, processes=args.processes,
+                    engine=args.engine, movement=args.movement, boundary=args.boundary,
+                    movement_noise=args.movement_noise, record_dir=args.record,
+                    record_interval=args.record_interval,
+                    ndvi_interval=args.ndvi_interval, checkpoint_dir=args.checkpoint,
+                    checkpoint_interval=args.checkpoint_interval, density_bandwidth=args.density_bandwidth,
+                    block_dir=args.blocks, block_interval=args.block_interval)
+    results.to_csv(args.output, index=False)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,469 @@
+"""
+
+Use this file to benchmark the model on synthetic data.
+
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+import numpy as np
+import geopandas as gp
+import pandas as pd
+import rasterio
+import xarray as xr
+from affine import Affine
+from mesa_geo import GeoSpace
+from mesa_geo.geoagent import GeoAgent
+from shapely.geometry import Point, box
+import model
+import sentinel
+import density
+from mapmodule import AnimalPortrayal, DeltaMapModule
+from spatial import SplitGeoSpace
+
+# Synthetic study area, in EPSG:4326 degrees
+BOUNDS = (0.0, 0.0, 1.0, 1.0)
+
+# Default output directory of benchmark suite results
+results_path = r'./bench_results/'
+
+# Import-time and startup budgets, in seconds; a clean import of model
+# measures about 2.2 s, mostly mesa_geo, and does not load sentinel or rasterio
+IMPORT_BUDGETS = {'preprocess': 2.0, 'sentinel': 3.0, 'model': 3.0}
+SERVER_STARTUP_BUDGET = 30.0
+
+
+def synthetic_ndvi(n_side, bounds=BOUNDS, seed=0) -> gp.GeoDataFrame:
+    """Create a square grid of NDVI cells with random values.
+    :param n_side: Number of cells along each side of the grid.
+    :param bounds: (minx, miny, maxx, maxy) of the grid.
+    :param seed:   Random seed.
+
+    Returns: gdf_ndvi: gp.GeoDataFrame with NDVI values & geometry, indexed like get_ndvi_gdf.
+    """
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    xs = np.linspace(minx, maxx, n_side + 1)
+    ys = np.linspace(miny, maxy, n_side + 1)
+    geometries = [box(xs[i], ys[j], xs[i + 1], ys[j + 1])
+                  for i in range(n_side) for j in range(n_side)]
+    values = rng.uniform(-1, 1, len(geometries))
+
+    gdf_ndvi = gp.GeoDataFrame({"value": values, "geometry": geometries}, crs="epsg:4326")
+    gdf_ndvi.index = pd.Index(['NDVI' + str(idx) for idx in range(len(gdf_ndvi))])
+    return gdf_ndvi
+
+
+def synthetic_animals(n_animals, animal_name='EL', bounds=BOUNDS, seed=0) -> gp.GeoDataFrame:
+    """Create random animal observations with counts.
+    :param n_animals:   Number of observations.
+    :param animal_name: Name of the count column.
+    :param bounds:      (minx, miny, maxx, maxy) to draw points in.
+    :param seed:        Random seed.
+
+    Returns: gdf_animal: gp.GeoDataFrame with counts & geometry, indexed like get_2017_population_data.
+    """
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    # Keep a margin, so all observations fall inside the NDVI grid
+    dx, dy = 0.01 * (maxx - minx), 0.01 * (maxy - miny)
+    x = rng.uniform(minx + dx, maxx - dx, n_animals)
+    y = rng.uniform(miny + dy, maxy - dy, n_animals)
+
+    gdf_animal = gp.GeoDataFrame({animal_name: rng.integers(1, 50, n_animals),
+                                  "geometry": [Point(xy) for xy in zip(x, y)]},
+                                 crs="epsg:4326")
+    gdf_animal.index = pd.Index(['Obs' + str(idx) for idx in range(n_animals)])
+    return gdf_animal
+
+
+def synthetic_raster(n_side, bounds=BOUNDS, seed=0) -> xr.DataArray:
+    """Create a square NDVI raster with random values, as get_ndvi_gdf reads it.
+    :param n_side: Number of pixels along each side of the raster.
+    :param bounds: (minx, miny, maxx, maxy) of the raster. Keep it square, since polygonize swaps x and y.
+    :param seed:   Random seed.
+
+    Returns: xr.DataArray with NDVI values and transform/crs attributes.
+    """
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    transform = Affine((maxx - minx) / n_side, 0, minx, 0, -(maxy - miny) / n_side, maxy)
+    values = rng.uniform(-1, 1, (n_side, n_side)).astype(np.float32)
+
+    da = xr.DataArray(values, dims=("y", "x"))
+    return da.assign_attrs(transform=tuple(transform)[:6], crs="epsg:4326")
+
+
+@contextmanager
+def synthetic_workspace(n_side, bounds=BOUNDS, seed=0):
+    """Temporarily run in a directory with synthetic versions of the data files the model reads:
+    the survey polygon and both NDVI rasters.
+    :param n_side: Number of pixels along each side of the NDVI rasters.
+    :param bounds: (minx, miny, maxx, maxy) of the study area.
+    :param seed:   Random seed.
+    """
+
+    workspace = tempfile.mkdtemp(prefix='animalmodel_bench_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workspace)
+
+        # Survey polygon slightly larger than the study area, so all cells lie within it
+        minx, miny, maxx, maxy = bounds
+        margin = 0.01 * (maxx - minx)
+        os.makedirs(model.polygon_path)
+        gp.GeoDataFrame(geometry=[box(minx - margin, miny - margin, maxx + margin, maxy + margin)],
+                        crs="epsg:4326").to_file(os.path.join(model.polygon_path, 'Census2017Polygon-filled.shp'))
+
+        da = synthetic_raster(n_side, bounds=bounds, seed=seed)
+        for cloudmask in (True, False):
+            raster = sentinel.get_ndvi_loc(cloudmask)
+            os.makedirs(os.path.dirname(raster), exist_ok=True)
+            with rasterio.open(raster, 'w', driver='GTiff', height=n_side, width=n_side, count=1,
+                               dtype='float32', crs=da.attrs['crs'],
+                               transform=Affine(*da.attrs['transform'])) as dst:
+                dst.write(da.values, 1)
+
+        model.get_survey_polygon.cache_clear()
+        model.get_map_coords.cache_clear()
+        yield workspace
+    finally:
+        os.chdir(cwd)
+        model.get_survey_polygon.cache_clear()
+        model.get_map_coords.cache_clear()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def measure(func, setup=None, repeat=3) -> dict:
+    """Time a function and measure its peak Python memory.
+    Timing and memory are measured in separate calls, since tracemalloc slows code down.
+    tracemalloc sees NumPy buffers, but not memory allocated inside GEOS or GDAL.
+    :param func: Function to measure, called with the result of setup.
+    :param setup: Optional function without arguments, whose return value is passed to func. Not measured.
+    :param repeat: Number of timed calls.
+
+    Returns: Dictionary with fastest and mean seconds, and peak memory in MB.
+    """
+
+    timings = []
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            arg = setup() if setup else None
+            start = time.perf_counter()
+            func(arg)
+            timings.append(time.perf_counter() - start)
+
+        arg = setup() if setup else None
+        tracemalloc.start()
+        try:
+            func(arg)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {"seconds": min(timings), "mean_seconds": float(np.mean(timings)), "peak_mb": peak / 2 ** 20}
+
+
+def run_suite(cell_sides=(50, 100), animal_counts=(1000, 5000), steps=5, repeat=3, seed=0) -> list:
+    """Benchmark model construction, NDVI pairing, stepping, portrayal, density, polygonize and get_ndvi_gdf on
+    synthetic data.
+    :param cell_sides: NDVI grid sizes, as number of cells along each side.
+    :param animal_counts: Numbers of animals.
+    :param steps: Number of model steps per timed stepping call; step times are reported per step.
+    :param repeat: Number of timed calls per benchmark.
+    :param seed: Random seed.
+
+    Returns: List of result dictionaries.
+    """
+
+    results = []
+
+    def record(name, stats, **params):
+        results.append(dict(benchmark=name, **params, **stats))
+        print(f"{name} {params}: {stats['seconds']:.4f} s, {stats['peak_mb']:.1f} MB")
+
+    for n_side in cell_sides:
+        with synthetic_workspace(n_side, seed=seed):
+            da = synthetic_raster(n_side, seed=seed)
+            survey_area = model.get_survey_polygon()
+            n_cells = n_side * n_side
+
+            record("polygonize", measure(lambda _: sentinel.polygonize(da), repeat=repeat),
+                   ndvi_cells=n_cells)
+            record("polygonize_tiled",
+                   measure(lambda _: sentinel.polygonize_tiled(da.values, da.attrs['transform'], da.attrs['crs'],
+                                                               survey_area), repeat=repeat),
+                   ndvi_cells=n_cells)
+            record("get_ndvi_gdf", measure(lambda _: sentinel.get_ndvi_gdf(False, True, survey_area),
+                                           repeat=repeat),
+                   ndvi_cells=n_cells, preload=False)
+            record("get_ndvi_gdf", measure(lambda _: sentinel.get_ndvi_gdf(True, True, survey_area),
+                                           repeat=repeat),
+                   ndvi_cells=n_cells, preload=True)
+
+            gdf_ndvi = synthetic_ndvi(n_side, seed=seed)
+            for n_animals in animal_counts:
+                gdf_animal = synthetic_animals(n_animals, seed=seed)
+                params = dict(ndvi_cells=n_cells, animals=n_animals)
+
+                # The same number of animals split over two species, sharing the NDVI layer
+                two_species = [(synthetic_animals(n_animals // 2, 'EL', seed=seed), 'EL'),
+                               (synthetic_animals(n_animals - n_animals // 2, 'BF', seed=seed + 1), 'BF')]
+
+                def build(engine, animal_data=None):
+                    if animal_data is None:
+                        return model.AnimalModel(gdf_animal, gdf_ndvi, 'EL', gdf_ndvi['value'],
+                                                 engine=engine, profile=False)
+                    return model.AnimalModel(animal_data, gdf_ndvi, None, gdf_ndvi['value'],
+                                             engine=engine, profile=False)
+
+                def run_steps(animal_model):
+                    for _ in range(steps):
+                        animal_model.step()
+
+                for engine in model.AnimalModel.ENGINES:
+                    record("AnimalModel.__init__", measure(lambda _: build(engine), repeat=repeat),
+                           engine=engine, **params)
+
+                    step_stats = measure(run_steps, setup=lambda: build(engine), repeat=repeat)
+                    step_stats["seconds"] /= steps
+                    step_stats["mean_seconds"] /= steps
+                    record("AnimalModel.step", step_stats, engine=engine, **params)
+
+                    record("AnimalModel.__init__", measure(lambda _: build(engine, two_species), repeat=repeat),
+                           engine=engine, species=2, **params)
+                    step_stats = measure(run_steps, setup=lambda: build(engine, two_species), repeat=repeat)
+                    step_stats["seconds"] /= steps
+                    step_stats["mean_seconds"] /= steps
+                    record("AnimalModel.step", step_stats, engine=engine, species=2, **params)
+
+                # Density surface of the census counts, without the cache
+                x, y = gdf_animal.geometry.x.to_numpy(), gdf_animal.geometry.y.to_numpy()
+                record("density_surface",
+                       measure(lambda _: density.density_surface(x, y, gdf_animal['EL'].to_numpy()),
+                               repeat=repeat),
+                       **params)
+
+                record("get_animal_ndvi_pairs",
+                       measure(lambda animal_model: animal_model.get_animal_ndvi_pairs(),
+                               setup=lambda: build("agent"), repeat=repeat),
+                       **params)
+
+                # Map frames as the server sends them: the first one renders the NDVI overlay and adds
+                # every animal, the next one only sends the animals that moved in a step
+                def map_setup(frames):
+                    animal_model, element = build("array"), DeltaMapModule(AnimalPortrayal())
+                    for _ in range(frames):
+                        element.render(animal_model)
+                        animal_model.step()
+                    return animal_model, element
+
+                for frame, warm_frames in (("first", 0), ("next", 1)):
+                    record("DeltaMapModule.render",
+                           measure(lambda arg: arg[1].render(arg[0]),
+                                   setup=lambda: map_setup(warm_frames), repeat=repeat),
+                           frame=frame, **params)
+
+    return results
+
+
+def git_commit() -> str:
+    """Get the current git commit, or 'unknown' outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(results, output=None) -> str:
+    """Store suite results as JSON, together with the commit and platform they were measured on.
+    :param results: List of result dictionaries from run_suite.
+    :param output: File to write, defaults to bench_results/<commit>.json.
+
+    Returns: Location of the written file.
+    """
+
+    commit = git_commit()
+    output = output or os.path.join(results_path, commit + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({"commit": commit,
+                   "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "results": results}, f, indent=2, default=float)
+    return output
+
+
+def compare_results(base_file, new_file) -> pd.DataFrame:
+    """Compare two stored suite results.
+    :param base_file: JSON file of the baseline commit.
+    :param new_file: JSON file of the commit to compare.
+
+    Returns: DataFrame with seconds and peak memory of both, and their ratio (new / base).
+    """
+
+    frames = []
+    for file in (base_file, new_file):
+        with open(file) as f:
+            frames.append(pd.DataFrame(json.load(f)["results"]))
+    base, new = frames
+
+    keys = [col for col in base.columns
+            if col not in ("seconds", "mean_seconds", "peak_mb") and col in new.columns]
+    merged = base.merge(new, on=keys, how="outer", suffixes=("_base", "_new"))
+    merged["time_ratio"] = merged["seconds_new"] / merged["seconds_base"]
+    merged["memory_ratio"] = merged["peak_mb_new"] / merged["peak_mb_base"]
+    return merged[keys + ["seconds_base", "seconds_new", "time_ratio",
+                          "peak_mb_base", "peak_mb_new", "memory_ratio"]]
+
+
+def bench_rtree(agent_counts, n_side=100, steps=20, moved_fraction=1.0, seed=0) -> pd.DataFrame:
+    """Compare step-time R-tree upkeep of a full rebuild against the split static/dynamic index.
+    :param agent_counts:   Numbers of animals to benchmark.
+    :param n_side:         Number of NDVI cells along each side of the grid.
+    :param steps:          Number of steps to time per run.
+    :param moved_fraction: Fraction of animals that moves in each step.
+    :param seed:           Random seed.
+
+    Returns: DataFrame with mean milliseconds per step for both strategies.
+    """
+
+    rng = np.random.default_rng(seed)
+    gdf_ndvi = synthetic_ndvi(n_side, seed=seed)
+    results = []
+
+    for n_animals in agent_counts:
+        gdf_animal = synthetic_animals(n_animals, seed=seed)
+        row = {"animals": n_animals, "ndvi_cells": len(gdf_ndvi)}
+
+        for strategy in ("rebuild", "incremental"):
+            ndvi = [GeoAgent(idx, None, geom) for idx, geom in gdf_ndvi.geometry.items()]
+            animals = [GeoAgent(idx, None, geom) for idx, geom in gdf_animal.geometry.items()]
+
+            if strategy == "rebuild":
+                grid = GeoSpace(crs="epsg:4326")
+                grid.add_agents(ndvi)
+            else:
+                grid = SplitGeoSpace(crs="epsg:4326")
+                grid.add_static_agents(ndvi)
+            grid.add_agents(animals)
+
+            timings = []
+            for _ in range(steps):
+                movers = rng.random(n_animals) < moved_fraction
+                for animal, moves in zip(animals, movers):
+                    if moves:
+                        animal.shape = Point(animal.shape.x + rng.normal(0, 1e-3),
+                                             animal.shape.y + rng.normal(0, 1e-3))
+                start = time.perf_counter()
+                if strategy == "rebuild":
+                    grid._recreate_rtree()
+                else:
+                    grid.refresh()
+                timings.append(time.perf_counter() - start)
+
+            row[f"{strategy}_ms"] = 1000 * np.mean(timings)
+        results.append(row)
+
+    return pd.DataFrame(results)
+
+
+def time_import(module, repeat=3) -> float:
+    """Measure the import time of a module in a fresh interpreter.
+    Runs in the current directory, so relative data paths resolve like they do for the server.
+    :param module: Name of the module to import.
+    :param repeat: Number of measurements; the fastest one is returned.
+
+    Returns: Import time in seconds.
+    """
+
+    code = ("import time; start = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - start)")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                                capture_output=True, text=True)
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def check_startup_budgets(include_server=True) -> pd.DataFrame:
+    """Measure module import times and server startup against their budgets.
+    Server startup is the import of server.py, which loads all data and builds the first model.
+    :param include_server: Whether to measure server startup, which needs the data files.
+
+    Returns: DataFrame with measured seconds, budget and whether the budget was met.
+    """
+
+    budgets = dict(IMPORT_BUDGETS)
+    if include_server:
+        budgets['server'] = SERVER_STARTUP_BUDGET
+
+    results = []
+    for module, budget in budgets.items():
+        seconds = time_import(module, repeat=1 if module == 'server' else 3)
+        results.append({"module": module, "seconds": seconds, "budget": budget,
+                        "ok": seconds <= budget})
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the animal model on synthetic data.")
+    subparsers = parser.add_subparsers(dest='suite', required=True)
+
+    rtree_parser = subparsers.add_parser('rtree', help="R-tree upkeep per step.")
+    rtree_parser.add_argument('--agents', type=int, nargs='+', default=[100, 1000, 5000, 10000],
+                              help="Numbers of animals to benchmark.")
+    rtree_parser.add_argument('--cells', type=int, default=100, help="NDVI cells along each grid side.")
+    rtree_parser.add_argument('--steps', type=int, default=20, help="Steps to time per run.")
+    rtree_parser.add_argument('--moved', type=float, default=1.0, help="Fraction of animals moving per step.")
+
+    suite_parser = subparsers.add_parser('suite', help="Time and memory of model construction and stepping.")
+    suite_parser.add_argument('--cells', type=int, nargs='+', default=[50, 100],
+                              help="NDVI cells along each grid side.")
+    suite_parser.add_argument('--agents', type=int, nargs='+', default=[1000, 5000],
+                              help="Numbers of animals to benchmark.")
+    suite_parser.add_argument('--steps', type=int, default=5, help="Steps per timed stepping call.")
+    suite_parser.add_argument('--repeat', type=int, default=3, help="Timed calls per benchmark.")
+    suite_parser.add_argument('--output', default=None, help="JSON file to write, defaults to bench_results/<commit>.json.")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two stored suite results.")
+    compare_parser.add_argument('base', help="JSON results of the baseline.")
+    compare_parser.add_argument('new', help="JSON results to compare against the baseline.")
+
+    startup_parser = subparsers.add_parser('startup', help="Import-time and server startup budgets.")
+    startup_parser.add_argument('--no-server', action='store_true',
+                                help="Skip server startup, e.g. when the data files are missing.")
+    args = parser.parse_args()
+
+    if args.suite == 'rtree':
+        print(bench_rtree(args.agents, n_side=args.cells, steps=args.steps,
+                          moved_fraction=args.moved).to_string(index=False))
+    elif args.suite == 'suite':
+        output = save_results(run_suite(args.cells, args.agents, steps=args.steps, repeat=args.repeat),
+                              args.output)
+        print(f"Results written to {output}")
+    elif args.suite == 'compare':
+        print(compare_results(args.base, args.new).to_string(index=False))
+    elif args.suite == 'startup':
+        budgets = check_startup_budgets(include_server=not args.no_server)
+        print(budgets.to_string(index=False))
+        if not budgets['ok'].all():
+            sys.exit(1)
@@ -0,0 +1,160 @@
+"""
+
+Use this file to keep moving animals inside the survey area.
+
+"""
+import numpy as np
+import affine
+from shapely.geometry import Point
+from spatial import points_within
+
+# Available rules for moves that would leave the survey area
+BOUNDARY_MODES = ("stay", "clamp", "slide")
+
+
+class SurveyBoundary:
+    """Inside/outside test of the survey area, for many points at once.
+
+    The polygon is rasterized once into a mask of cells that lie fully inside, fully outside or on the
+    edge of the area. Points in inside or outside cells are answered by a single array lookup; only
+    points in edge cells get the exact test against the polygon, which shapely prepares per call.
+    """
+
+    def __init__(self, polygon, resolution=None, mode="stay", max_cells=4000000):
+        """Create a new survey boundary.
+        :param polygon: Shapely Polygon of survey area.
+        :param resolution: Width of the mask cells, e.g. the NDVI cell size. Defaults to 1/512 of the
+                           polygon's extent.
+        :param mode: What to do with a move that would leave the area: 'stay' where it is, 'clamp' to
+                     the last point inside along the move, or 'slide' along the boundary from there.
+        :param max_cells: Upper limit on the number of mask cells; the resolution is coarsened to fit.
+        """
+        if mode not in BOUNDARY_MODES:
+            raise ValueError(f"mode must be one of {BOUNDARY_MODES}")
+
+        self.polygon = polygon
+        self.mode = mode
+
+        minx, miny, maxx, maxy = polygon.bounds
+        extent = max(maxx - minx, maxy - miny)
+        if resolution is None or not resolution > 0:
+            resolution = extent / 512
+        resolution = max(resolution, extent / np.sqrt(max_cells))
+        self.resolution = float(resolution) if resolution > 0 else 1.0
+
+        self.width = int(np.ceil((maxx - minx) / self.resolution)) + 1
+        self.height = int(np.ceil((maxy - miny) / self.resolution)) + 1
+        self.origin = (minx, miny)
+        self.mask = self._rasterize()
+
+    def _rasterize(self) -> np.ndarray:
+        """Classify the mask cells: 0 outside, 1 inside and 2 on the edge of the area.
+        Row r covers y from miny + r * resolution upwards, column c x from minx + c * resolution.
+        """
+        # Import here, so importing the model does not load GDAL
+        import rasterio.features
+
+        transform = affine.Affine(self.resolution, 0, self.origin[0], 0, self.resolution, self.origin[1])
+        shape = (self.height, self.width)
+
+        # Cells whose center is inside; any cell the boundary touches needs the exact test
+        inside = rasterio.features.rasterize([self.polygon], out_shape=shape, transform=transform,
+                                             fill=0, default_value=1, dtype='uint8')
+        edge = rasterio.features.rasterize([self.polygon.boundary], out_shape=shape, transform=transform,
+                                           fill=0, default_value=1, all_touched=True,
+                                           dtype='uint8').astype(bool)
+
+        # Grow the edge by one cell, for boundaries running exactly along cell borders
+        grown = edge.copy()
+        grown[1:, :] |= edge[:-1, :]
+        grown[:-1, :] |= edge[1:, :]
+        grown[:, 1:] |= edge[:, :-1]
+        grown[:, :-1] |= edge[:, 1:]
+
+        mask = inside.astype(np.uint8)
+        mask[grown] = 2
+        return mask
+
+    def contains(self, x, y) -> np.ndarray:
+        """Vectorized equivalent of Point(x, y).within(polygon) for many points at once.
+        :param x: Array with x coordinates.
+        :param y: Array with y coordinates.
+
+        Returns: Boolean array, True where a point lies in the interior of the survey area.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        cols = np.floor((x - self.origin[0]) / self.resolution).astype(np.int64)
+        rows = np.floor((y - self.origin[1]) / self.resolution).astype(np.int64)
+        on_mask = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+
+        status = np.zeros(x.shape, dtype=np.uint8)
+        status[on_mask] = self.mask[rows[on_mask], cols[on_mask]]
+        inside = status == 1
+
+        near_edge = status == 2
+        if near_edge.any():
+            inside[near_edge] = points_within(self.polygon, x[near_edge], y[near_edge])
+        return inside
+
+    def move(self, x, y, new_x, new_y, iterations=20):
+        """Apply the boundary rule to many moves at once.
+        :param x: Array with current x coordinates.
+        :param y: Array with current y coordinates.
+        :param new_x: Array with x coordinates the animals want to move to.
+        :param new_y: Array with y coordinates the animals want to move to.
+        :param iterations: Bisection steps to find the boundary along a move, for 'clamp' and 'slide'.
+
+        Returns: (x, y): Arrays with the positions after the move.
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        new_x, new_y = np.array(new_x, dtype=float), np.array(new_y, dtype=float)
+
+        blocked = ~self.contains(new_x, new_y)
+        if self.mode == "stay" or not blocked.any():
+            return np.where(blocked, x, new_x), np.where(blocked, y, new_y)
+
+        # Only animals that start inside can be walked up to the boundary
+        walk = blocked & self.contains(x, y)
+        new_x[blocked & ~walk] = x[blocked & ~walk]
+        new_y[blocked & ~walk] = y[blocked & ~walk]
+
+        clamped_x, clamped_y = self._clamp(x[walk], y[walk], new_x[walk], new_y[walk], iterations)
+        if self.mode == "slide":
+            clamped_x, clamped_y = self._slide(clamped_x, clamped_y, new_x[walk], new_y[walk])
+        new_x[walk], new_y[walk] = clamped_x, clamped_y
+        return new_x, new_y
+
+    def _clamp(self, x, y, new_x, new_y, iterations):
+        """Find the last point inside along each move by bisection; the start must be inside."""
+        low = np.zeros(x.shape)
+        high = np.ones(x.shape)
+        for _ in range(iterations):
+            mid = (low + high) / 2
+            inside = self.contains(x + mid * (new_x - x), y + mid * (new_y - y))
+            low = np.where(inside, mid, low)
+            high = np.where(inside, high, mid)
+        return x + low * (new_x - x), y + low * (new_y - y)
+
+    def _slide(self, x, y, new_x, new_y):
+        """Continue the rest of each move along the boundary tangent, if that stays inside."""
+        boundary = self.polygon.boundary
+        step = self.resolution / 10
+        tangent = np.zeros((len(x), 2))
+        for i, (px, py) in enumerate(zip(x.tolist(), y.tolist())):
+            distance = boundary.project(Point(px, py))
+            a = boundary.interpolate(max(distance - step, 0))
+            b = boundary.interpolate(min(distance + step, boundary.length))
+            tangent[i] = (b.x - a.x, b.y - a.y)
+
+        norm = np.hypot(tangent[:, 0], tangent[:, 1])
+        norm[norm == 0] = 1
+        tangent /= norm[:, None]
+
+        # Remaining displacement, projected onto the boundary
+        along = (new_x - x) * tangent[:, 0] + (new_y - y) * tangent[:, 1]
+        slide_x, slide_y = x + along * tangent[:, 0], y + along * tangent[:, 1]
+
+        ok = self.contains(slide_x, slide_y)
+        return np.where(ok, slide_x, x), np.where(ok, slide_y, y)
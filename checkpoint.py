@@ -0,0 +1,256 @@
+"""
+
+Use this file to save model state to disk and to resume models from it.
+
+"""
+import json
+import os
+import queue
+import random
+import threading
+import numpy as np
+import geopandas as gp
+import pyarrow as pa
+from model import AnimalModel
+
+# Bump when the checkpoint layout changes
+CHECKPOINT_VERSION = 1
+
+# Per-animal state, in schedule order; model state is stored as JSON in the schema metadata
+CHECKPOINT_SCHEMA = pa.schema([('unique_id', pa.string()),
+                               ('species', pa.dictionary(pa.int8(), pa.string())),
+                               ('x', pa.float64()),
+                               ('y', pa.float64()),
+                               ('animal_count', pa.float64()),
+                               ('mobility_range', pa.float64()),
+                               ('ndvi', pa.float64())])
+
+
+def model_state(model) -> pa.Table:
+    """Take a snapshot of a model's state.
+    :param model: AnimalModel to snapshot.
+
+    Returns: pa.Table with one row per animal, and the model state in its schema metadata.
+    """
+
+    x, y, counts = model.animal_positions()
+    if model.engine == "array":
+        mobility = model.animal_mobility
+    else:
+        mobility = np.array([a.mobility_range for a in model._animal_agents], dtype=float)
+
+    version, internal_state, gauss_next = model.random.getstate()
+    state = {'version': CHECKPOINT_VERSION,
+             'steps': model.steps,
+             'schedule_steps': model.schedule.steps,
+             'schedule_time': model.schedule.time,
+             'running': model.running,
+             'ndvi_date': model.ndvi_date,
+             'ndvi_cells': len(model.ndvi_index.values),
+             'random_state': [version, list(internal_state), gauss_next],
+             'species': list(model.species),
+             'crs': model.grid.crs.to_string(),
+             'engine': model.engine,
+             'movement': model.movement,
+             'search_radius': model.search_radii,
+             'boundary': model.boundary.mode,
+             'update_ndvi': model.update_ndvi,
+             'ndvi_interval': model.ndvi_interval,
+             'movement_noise': model.movement_noise}
+
+    table = pa.Table.from_arrays(
+        [pa.array([str(a.unique_id) for a in model._animal_agents], type=pa.string()),
+         pa.DictionaryArray.from_arrays(pa.array(model.animal_species), pa.array(model.species)),
+         pa.array(np.array(x, dtype=np.float64)),
+         pa.array(np.array(y, dtype=np.float64)),
+         pa.array(np.array(counts, dtype=np.float64)),
+         pa.array(np.array(mobility, dtype=np.float64)),
+         pa.array(np.array(model.animal_ndvi_values(), dtype=np.float64))],
+        schema=CHECKPOINT_SCHEMA)
+    return table.replace_schema_metadata({'state': json.dumps(state)})
+
+
+def write_checkpoint(snapshot, path, compression='zstd') -> None:
+    """Write a snapshot as an Arrow IPC file.
+    The file is written next to its destination and renamed into place, so a crash while writing
+    never leaves a partial checkpoint behind.
+    :param snapshot: AnimalModel, or a table from model_state.
+    :param path: Location of the checkpoint file.
+    :param compression: Arrow IPC buffer compression, 'zstd', 'lz4' or None.
+    """
+
+    table = model_state(snapshot) if isinstance(snapshot, AnimalModel) else snapshot
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.OSFile(tmp_file, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    os.replace(tmp_file, path)
+
+
+def read_checkpoint(path):
+    """Read a checkpoint file.
+    :param path: Location of the checkpoint file.
+
+    Returns: (table, state): pa.Table with the animal state, and dictionary with the model state.
+    """
+
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    state = json.loads(table.schema.metadata[b'state'])
+    if state['version'] != CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint version {state['version']} is not supported, "
+                         f"expected {CHECKPOINT_VERSION}")
+    return table, state
+
+
+def restore_state(model, checkpoint, seed=None) -> None:
+    """Put a model back into the state of a checkpoint, without building it again.
+    The model must hold the same animals, in the same order, on the same NDVI layer. This makes it
+    cheap to fork many replicate runs from one warmed-up state.
+    :param model: AnimalModel to restore.
+    :param checkpoint: Location of a checkpoint file, or a table from model_state.
+    :param seed: Reseed the model's random number generator instead of restoring its state.
+    """
+
+    if isinstance(checkpoint, pa.Table):
+        table, state = checkpoint, json.loads(checkpoint.schema.metadata[b'state'])
+    else:
+        table, state = read_checkpoint(checkpoint)
+
+    unique_ids = [str(a.unique_id) for a in model._animal_agents]
+    if unique_ids != table.column('unique_id').to_pylist():
+        raise ValueError("Checkpoint holds other animals than the model")
+    if state['ndvi_cells'] != len(model.ndvi_index.values):
+        raise ValueError("Checkpoint was taken on another NDVI layer")
+
+    # The NDVI date first, since it sets the animals' NDVI values too
+    if state['ndvi_date'] is not None and model.ndvi_series is not None and state['ndvi_date'] != model.ndvi_date:
+        model.set_ndvi_date(state['ndvi_date'])
+
+    model.set_animal_state(table.column('x').to_numpy(), table.column('y').to_numpy(),
+                           table.column('ndvi').to_numpy(), table.column('mobility_range').to_numpy())
+
+    model.steps = state['steps']
+    model.schedule.steps = state['schedule_steps']
+    model.schedule.time = state['schedule_time']
+    model.running = state['running']
+
+    # Instance attribute, Mesa keeps the generator on the class
+    model.random = random.Random(seed)
+    if seed is None:
+        version, internal_state, gauss_next = state['random_state']
+        model.random.setstate((version, tuple(internal_state), gauss_next))
+
+
+def restore_model(path, gdf_ndvi, ndvi_series=None, seed=None, **kwargs) -> AnimalModel:
+    """Build a model from a checkpoint file, without reading any census data.
+    :param path: Location of the checkpoint file.
+    :param gdf_ndvi: NDVI data the checkpointed model ran on, as GeoDataFrame or NDVIRaster.
+    :param ndvi_series: NDVISeries the checkpointed model ran on, if any.
+    :param seed: Reseed the model's random number generator instead of restoring its state.
+    :param kwargs: Further AnimalModel arguments, e.g. recorder or profile. Arguments stored in the
+                   checkpoint, like engine or movement, can be overridden here.
+
+    Returns: AnimalModel in the state of the checkpoint.
+    """
+
+    table, state = read_checkpoint(path)
+    columns = table.to_pandas()
+    animal_data = []
+    for name in state['species']:
+        rows = columns[columns['species'] == name]
+        # Ids of several species were prefixed with the species by the model
+        index = rows['unique_id'].tolist()
+        if len(state['species']) > 1:
+            index = [unique_id[len(name) + 1:] for unique_id in index]
+        gdf = gp.GeoDataFrame({name: rows['animal_count'].to_numpy()}, index=index,
+                              geometry=gp.points_from_xy(rows['x'], rows['y']), crs=state['crs'])
+        animal_data.append((gdf, name))
+
+    params = dict(engine=state['engine'], movement=state['movement'], search_radius=state['search_radius'],
+                  boundary=state['boundary'], update_ndvi=state['update_ndvi'],
+                  ndvi_interval=state['ndvi_interval'], movement_noise=state.get('movement_noise', 0.0))
+    params.update(kwargs)
+    # Recording starts at the restored step, not at the state the model is built in
+    recorder = params.pop('recorder', None)
+
+    model = AnimalModel(animal_data, gdf_ndvi, None, None, ndvi_series=ndvi_series, **params)
+    restore_state(model, table, seed=seed)
+    model.recorder = recorder
+    return model
+
+
+class Checkpointer:
+    """Periodically write the model state to a checkpoint file.
+
+    collect() takes the snapshot, which is a copy of a few arrays, and hands it to a background thread
+    that compresses and writes it. Every checkpoint replaces the previous one atomically, unless the
+    path contains '{step}'.
+    """
+
+    def __init__(self, path, interval=100, compression='zstd'):
+        """Create a new checkpointer.
+        :param path: Location of the checkpoint file; '{step}' in it is replaced by the model step.
+        :param interval: Write a checkpoint every interval-th step.
+        :param compression: Arrow IPC buffer compression, 'zstd', 'lz4' or None.
+        """
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
+
+        self.path = path
+        self.interval = interval
+        self.compression = compression
+        self.last_path = None
+
+        # One snapshot waiting is enough, the model blocks rather than piling them up
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            path, table = item
+            try:
+                write_checkpoint(table, path, self.compression)
+                self.last_path = path
+            except Exception as error:
+                self._error = error
+
+    def collect(self, model) -> None:
+        """Write a checkpoint of a model, if its step is on the interval.
+        :param model: AnimalModel to checkpoint.
+        """
+        if model.steps == 0 or model.steps % self.interval:
+            return
+        self.save(model)
+
+    def save(self, model) -> None:
+        """Write a checkpoint of a model now, in the background.
+        :param model: AnimalModel to checkpoint.
+        """
+        if self._error is not None:
+            raise RuntimeError("Checkpoint writer failed") from self._error
+        self._queue.put((self.path.replace('{step}', str(model.steps)), model_state(model)))
+
+    def close(self) -> None:
+        """Write the remaining checkpoint and stop the writer."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError("Checkpoint writer failed") from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
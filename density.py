@@ -0,0 +1,344 @@
+"""
+
+Use this file to compute population density surfaces from census counts or model state.
+
+"""
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+
+# Grid cells along the longer side of the bounds, when no cell size is given
+DEFAULT_GRID_CELLS = 256
+
+# Kernel radius in bandwidths, the Gaussian is below 0.02% of its peak beyond it
+KERNEL_TRUNCATE = 4.0
+
+# Number of census density grids kept in memory
+DENSITY_CACHE_SIZE = 32
+
+# Density grids by (dataset, name, bandwidth, cell_size, bounds), least recently used first
+_DENSITY_CACHE = OrderedDict()
+
+
+class DensityGrid:
+    """Density surface on a regular grid, in weight (e.g. animals) per squared coordinate unit.
+
+    values[row, col] is the density at the center of the cell, row 0 in the south (lowest y) and column
+    0 in the west (lowest x), so it can be shown with imshow(values, origin='lower', extent=extent).
+    """
+
+    def __init__(self, values, bounds, cell_size, bandwidth, total):
+        """Create a new density grid.
+        :param values: 2D array of densities, rows along y and columns along x.
+        :param bounds: (minx, miny, maxx, maxy) of the grid.
+        :param cell_size: Width and height of a grid cell.
+        :param bandwidth: (x, y) standard deviation of the Gaussian kernel.
+        :param total: Sum of the weights binned onto the grid.
+        """
+        self.values = values
+        self.bounds = bounds
+        self.cell_size = cell_size
+        self.bandwidth = bandwidth
+        self.total = total
+
+    @property
+    def extent(self):
+        """(left, right, bottom, top) of the grid, as matplotlib's imshow expects."""
+        minx, miny, maxx, maxy = self.bounds
+        return minx, maxx, miny, maxy
+
+    def lookup(self, x, y) -> np.ndarray:
+        """Density at many points at once, from the cell each point falls in.
+        :param x: Array with x coordinates.
+        :param y: Array with y coordinates.
+
+        Returns: Array with the density at each point, 0 outside the grid.
+        """
+        cols = np.floor((np.asarray(x, dtype=float) - self.bounds[0]) / self.cell_size).astype(np.int64)
+        rows = np.floor((np.asarray(y, dtype=float) - self.bounds[1]) / self.cell_size).astype(np.int64)
+        height, width = self.values.shape
+        on_grid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+        density = np.zeros(cols.shape)
+        density[on_grid] = self.values[rows[on_grid], cols[on_grid]]
+        return density
+
+    def summary(self, fraction=0.5) -> dict:
+        """Summarize the surface, e.g. once per model step.
+        :param fraction: Share of the total weight the core area holds.
+
+        Returns: Dictionary with the peak density, its location, and the core area: the smallest area
+                 that holds the given fraction of the weight.
+        """
+        if not self.total > 0:
+            return {'peak_density': 0.0, 'peak_x': np.nan, 'peak_y': np.nan, 'core_area': 0.0}
+
+        peak = int(np.argmax(self.values))
+        row, col = np.unravel_index(peak, self.values.shape)
+
+        # Densest cells first, until they hold the fraction of the weight on the grid
+        ranked = np.sort(self.values, axis=None)[::-1]
+        mass = np.cumsum(ranked)
+        cells = int(np.searchsorted(mass, fraction * mass[-1])) + 1
+
+        return {'peak_density': float(self.values.flat[peak]),
+                'peak_x': self.bounds[0] + (col + 0.5) * self.cell_size,
+                'peak_y': self.bounds[1] + (row + 0.5) * self.cell_size,
+                'core_area': cells * self.cell_size ** 2}
+
+
+def scott_bandwidth(x, y, weights=None):
+    """Bandwidth of the Gaussian kernel by Scott's rule, like scipy's gaussian_kde and geoplot's kdeplot.
+    :param x: Array with x coordinates.
+    :param y: Array with y coordinates.
+    :param weights: Optional array with the weight (e.g. animal count) of each point.
+
+    Returns: (bx, by): Kernel standard deviation along x and y.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    weights = np.ones(x.shape) if weights is None else np.asarray(weights, dtype=float)
+
+    # Effective number of points, as in gaussian_kde
+    n_eff = weights.sum() ** 2 / np.sum(weights ** 2)
+    factor = n_eff ** (-1 / 6)
+
+    bandwidth = []
+    for values in (x, y):
+        mean = np.average(values, weights=weights)
+        std = np.sqrt(np.average((values - mean) ** 2, weights=weights))
+        bandwidth.append(float(std * factor))
+    return tuple(bandwidth)
+
+
+def bin_points(x, y, weights, bounds, cell_size) -> np.ndarray:
+    """Spread weighted points over the grid nodes (cell centers) around them, by linear binning.
+    Unlike counting points per cell, this keeps the binned surface accurate at cell sizes well
+    above the point spacing.
+    :param x: Array with x coordinates.
+    :param y: Array with y coordinates.
+    :param weights: Array with the weight of each point.
+    :param bounds: (minx, miny, maxx, maxy) of the grid.
+    :param cell_size: Width and height of a grid cell.
+
+    Returns: 2D array with the binned weight per cell, rows along y. Points off the grid are dropped.
+    """
+    minx, miny, maxx, maxy = bounds
+    width = max(int(np.ceil((maxx - minx) / cell_size)), 1)
+    height = max(int(np.ceil((maxy - miny) / cell_size)), 1)
+
+    # Position in cells, relative to the first cell center
+    gx = (np.asarray(x, dtype=float) - minx) / cell_size - 0.5
+    gy = (np.asarray(y, dtype=float) - miny) / cell_size - 0.5
+    weights = np.asarray(weights, dtype=float)
+    on_grid = (gx >= -0.5) & (gx <= width - 0.5) & (gy >= -0.5) & (gy <= height - 0.5)
+    gx, gy, weights = gx[on_grid], gy[on_grid], weights[on_grid]
+
+    col = np.floor(gx).astype(np.int64)
+    row = np.floor(gy).astype(np.int64)
+    fx = gx - col
+    fy = gy - row
+
+    # Pad by one node on each side, for points in the outer half of the edge cells
+    grid = np.zeros((height + 2) * (width + 2))
+    for drow, dcol, share in ((0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx),
+                              (1, 0, fy * (1 - fx)), (1, 1, fy * fx)):
+        cells = (row + drow + 1) * (width + 2) + col + dcol + 1
+        grid += np.bincount(cells, weights=weights * share, minlength=grid.size)
+    grid = grid.reshape(height + 2, width + 2)
+
+    # Fold the padding back onto the edge cells, so no weight is lost
+    grid[1, :] += grid[0, :]
+    grid[-2, :] += grid[-1, :]
+    grid[:, 1] += grid[:, 0]
+    grid[:, -2] += grid[:, -1]
+    return grid[1:-1, 1:-1]
+
+
+def _fast_length(n) -> int:
+    """Smallest length of at least n with only factors 2, 3 and 5, which the FFT handles fastest."""
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    power5 = 1
+    while power5 < best:
+        power3 = power5
+        while power3 < best:
+            length = power3
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            power3 *= 3
+        power5 *= 5
+    return best
+
+
+def gaussian_kernel(bandwidth, cell_size, truncate=KERNEL_TRUNCATE) -> np.ndarray:
+    """Discrete Gaussian kernel that sums to one.
+    :param bandwidth: (x, y) standard deviation of the kernel.
+    :param cell_size: Width and height of a grid cell.
+    :param truncate: Kernel radius in standard deviations.
+
+    Returns: 2D array of odd width and height, rows along y.
+    """
+    axes = []
+    for sigma in bandwidth:
+        sigma = sigma / cell_size
+        radius = int(np.ceil(truncate * sigma))
+        offsets = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 * (offsets / sigma) ** 2) if sigma > 0 else (offsets == 0).astype(float)
+        axes.append(kernel / kernel.sum())
+    return np.outer(axes[1], axes[0])
+
+
+@lru_cache(maxsize=16)
+def _kernel_spectrum(bandwidth, cell_size, fft_shape, truncate):
+    """Transform of the kernel, computed once per grid shape and bandwidth."""
+    spectrum = np.fft.rfft2(gaussian_kernel(bandwidth, cell_size, truncate), fft_shape)
+    spectrum.flags.writeable = False
+    return spectrum
+
+
+def fft_smooth(grid, bandwidth, cell_size, truncate=KERNEL_TRUNCATE) -> np.ndarray:
+    """Convolve a grid with a Gaussian kernel through the FFT.
+    The grid is zero padded by the kernel radius, so weight near one edge does not wrap around to the
+    other. Weight smoothed past the edges is lost, as with a direct kernel density estimate.
+    :param grid: 2D array with binned weights.
+    :param bandwidth: (x, y) standard deviation of the kernel.
+    :param cell_size: Width and height of a grid cell.
+    :param truncate: Kernel radius in standard deviations.
+
+    Returns: Smoothed array with the shape of the grid.
+    """
+    bandwidth = tuple(float(b) for b in bandwidth)
+    # Rows along y, like the grid
+    kernel_shape = tuple(2 * int(np.ceil(truncate * sigma / cell_size)) + 1 for sigma in bandwidth[::-1])
+    fft_shape = tuple(_fast_length(n + k - 1) for n, k in zip(grid.shape, kernel_shape))
+
+    spectrum = _kernel_spectrum(bandwidth, float(cell_size), fft_shape, truncate)
+    smoothed = np.fft.irfft2(np.fft.rfft2(grid, fft_shape) * spectrum, fft_shape)
+
+    # The kernel center sits at its radius, so the grid starts there
+    row, col = kernel_shape[0] // 2, kernel_shape[1] // 2
+    smoothed = smoothed[row:row + grid.shape[0], col:col + grid.shape[1]]
+    # Round-off of the transform leaves tiny negative values far from any point
+    return np.maximum(smoothed, 0)
+
+
+def density_surface(x, y, weights=None, bounds=None, bandwidth=None, cell_size=None,
+                    truncate=KERNEL_TRUNCATE) -> DensityGrid:
+    """Kernel density surface of weighted points, by binning them onto a grid and smoothing it.
+    The cost grows with the number of grid cells instead of cells times points, as a direct
+    kernel density estimate does.
+    :param x: Array with x coordinates.
+    :param y: Array with y coordinates.
+    :param weights: Optional array with the weight (e.g. animal count) of each point.
+    :param bounds: (minx, miny, maxx, maxy) of the grid. Defaults to the points' bounds, extended by
+                   three bandwidths like seaborn's kdeplot; required without points.
+    :param bandwidth: Standard deviation of the Gaussian kernel, a number or an (x, y) pair. Defaults to
+                      Scott's rule.
+    :param cell_size: Width and height of a grid cell. Defaults to the longer side of the bounds divided
+                      by DEFAULT_GRID_CELLS.
+    :param truncate: Kernel radius in standard deviations.
+
+    Returns: DensityGrid in weight per squared coordinate unit, zero everywhere without points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    weights = np.ones(x.shape) if weights is None else np.asarray(weights, dtype=float)
+    if bounds is None and len(x) == 0:
+        raise ValueError("bounds are required for a density surface without points")
+
+    if bandwidth is None:
+        # Scott's rule needs the spread of at least two weighted points
+        bandwidth = scott_bandwidth(x, y, weights) if np.count_nonzero(weights) > 1 else (0.0, 0.0)
+    elif np.isscalar(bandwidth):
+        bandwidth = (float(bandwidth), float(bandwidth))
+
+    if bounds is None:
+        bounds = (x.min() - 3 * bandwidth[0], y.min() - 3 * bandwidth[1],
+                  x.max() + 3 * bandwidth[0], y.max() + 3 * bandwidth[1])
+    minx, miny, maxx, maxy = bounds
+    if cell_size is None:
+        cell_size = max(maxx - minx, maxy - miny) / DEFAULT_GRID_CELLS
+    if not cell_size > 0:
+        cell_size = 1.0
+
+    grid = bin_points(x, y, weights, bounds, cell_size)
+    total = float(grid.sum())
+    values = fft_smooth(grid, bandwidth, cell_size, truncate) / cell_size ** 2
+    values.flags.writeable = False
+
+    # The grid may reach past maxx and maxy by part of a cell
+    bounds = (minx, miny, minx + grid.shape[1] * cell_size, miny + grid.shape[0] * cell_size)
+    return DensityGrid(values, bounds, cell_size, tuple(bandwidth), total)
+
+
+def _gdf_points(gdf, name=None):
+    """Coordinates and weights of a census GeoDataFrame.
+    :param gdf: GeoDataFrame with point geometries.
+    :param name: Column with the counts, e.g. 'EL' or 'BF'; each point weighs one without it.
+
+    Returns: (x, y, weights)
+    """
+    x = gdf.geometry.x.to_numpy(dtype=float)
+    y = gdf.geometry.y.to_numpy(dtype=float)
+    weights = np.ones(len(x)) if name is None else gdf[name].to_numpy(dtype=float)
+    return x, y, weights
+
+
+def census_density(gdf, name=None, bandwidth=None, cell_size=None, bounds=None) -> DensityGrid:
+    """Density surface of a census dataset, cached by its contents and the grid settings.
+    Plots and the web map can ask for the same surface again for free.
+    :param gdf: GeoDataFrame with point geometries, e.g. from get_2017_population_data.
+    :param name: Column with the counts, e.g. 'EL' or 'BF'; each point weighs one without it.
+    :param bandwidth: Standard deviation of the Gaussian kernel, defaults to Scott's rule.
+    :param cell_size: Width and height of a grid cell.
+    :param bounds: (minx, miny, maxx, maxy) of the grid.
+
+    Returns: DensityGrid, shared with other callers and read-only.
+    """
+    x, y, weights = _gdf_points(gdf, name)
+
+    # Key on the data itself, so reloaded or copied frames hit the cache too
+    digest = hashlib.blake2b(digest_size=16)
+    for values in (x, y, weights):
+        digest.update(np.ascontiguousarray(values).tobytes())
+    if bandwidth is not None and not np.isscalar(bandwidth):
+        bandwidth = tuple(float(b) for b in bandwidth)
+    key = (digest.hexdigest(), name, bandwidth, cell_size, None if bounds is None else tuple(bounds))
+
+    if key in _DENSITY_CACHE:
+        _DENSITY_CACHE.move_to_end(key)
+        return _DENSITY_CACHE[key]
+
+    grid = density_surface(x, y, weights, bounds=bounds, bandwidth=bandwidth, cell_size=cell_size)
+    _DENSITY_CACHE[key] = grid
+    if len(_DENSITY_CACHE) > DENSITY_CACHE_SIZE:
+        _DENSITY_CACHE.popitem(last=False)
+    return grid
+
+
+def clear_density_cache() -> None:
+    """Forget all cached census density grids."""
+    _DENSITY_CACHE.clear()
+    _kernel_spectrum.cache_clear()
+
+
+def model_density(model, bandwidth=None, cell_size=None, species=None) -> DensityGrid:
+    """Density surface of the animals of a running model, weighted by their counts.
+    The grid covers the survey area, so surfaces of different steps line up cell by cell. Pass a fixed
+    bandwidth to compare them; Scott's rule follows the animals as they spread or gather.
+    :param model: AnimalModel to take the animals from.
+    :param bandwidth: Standard deviation of the Gaussian kernel, defaults to Scott's rule.
+    :param cell_size: Width and height of a grid cell, defaults to the longer side of the survey area
+                      divided by DEFAULT_GRID_CELLS.
+    :param species: Only include the animals of this species.
+
+    Returns: DensityGrid in animals per squared unit of the model's CRS.
+    """
+    x, y, counts = model.animal_positions()
+    if species is not None:
+        group = model.species_slices[species]
+        x, y, counts = x[group], y[group], counts[group]
+    return density_surface(x, y, counts, bounds=model.SURVEY_POLYGON.bounds, bandwidth=bandwidth,
+                           cell_size=cell_size)
@@ -0,0 +1,299 @@
+"""
+
+Use this file for the map visualization of the web server.
+
+"""
+import base64
+import copy
+import io
+import math
+from functools import lru_cache
+import numpy as np
+import tornado.escape
+import matplotlib.colors
+import matplotlib.image
+from mesa_geo.visualization.ModularVisualization import ModularServer, SocketHandler, VisualizationElement
+from model import NO_NDVI
+from density import model_density
+
+try:
+    # Matplotlib >= 3.5
+    from matplotlib import colormaps as _colormaps
+    _get_cmap = _colormaps.__getitem__
+except ImportError:
+    from matplotlib.cm import get_cmap as _get_cmap
+
+# Decimals of the coordinates sent to the browser, about 10 cm
+COORD_DECIMALS = 6
+
+# Overlay state of a browser that has not received any NDVI layer yet
+_NO_OVERLAY = object()
+
+# Number of distinct NDVI colors, the resolution of matplotlib's own colormaps
+NDVI_COLOR_LEVELS = 256
+
+
+@lru_cache(maxsize=None)
+def ndvi_colors(cmap="Greens", levels=NDVI_COLOR_LEVELS):
+    """Quantized NDVI color table, computed once per colormap.
+    :param cmap: Name of the matplotlib colormap.
+    :param levels: Number of colors in the table.
+
+    Returns: (hex, rgba): Tuple of hex strings and (levels, 4) uint8 array with the same colors.
+    """
+    # Level centers, so each level takes exactly one color of a colormap with as many colors
+    centers = (np.arange(levels) + 0.5) / levels
+    rgba = _get_cmap(cmap)(centers, bytes=True)
+    rgba.flags.writeable = False
+    return tuple(matplotlib.colors.to_hex(color) for color in _get_cmap(cmap)(centers)), rgba
+
+
+def ndvi_color_index(values, levels=NDVI_COLOR_LEVELS):
+    """Index into the color table for NDVI values, like matplotlib maps [0,1] onto a colormap.
+    :param values: NDVI value or array of values in [-1,1]; NaN maps to the first color.
+
+    Returns: Integer index or array of indices.
+    """
+    # Convert NDVI value (from [-1,1] to [0,1] range)
+    scaled = np.nan_to_num((np.asarray(values, dtype=float) + 1) / 2 * levels)
+    return np.clip(scaled, 0, levels - 1).astype(int)
+
+
+class AnimalPortrayal:
+    """Portrayal function for the animals of AnimalModel, colored by species.
+
+    NDVI patches are not portrayed one by one; DeltaMapModule draws them as a single overlay.
+    """
+
+    # Colors of the animals per species, others are red
+    SPECIES_COLORS = {"EL": "Red", "BF": "Blue"}
+
+    def __call__(self, agent) -> dict:
+        return {"color": self.SPECIES_COLORS.get(agent.species, "Red"),
+                "radius": math.sqrt(agent.animal_count), "layer": 1}
+
+
+class DeltaMapModule(VisualizationElement):
+    """Leaflet map that sends the NDVI layer once, and afterwards only the animals that changed.
+
+    The NDVI patches are rendered into a single transparent PNG overlay, which is only sent again
+    when the model or its NDVI date changes. Overlays are cached per NDVI data and date, and shared
+    with the copies of the module made for other browser sessions. Animals are sent with their style when they first
+    appear; after that only their new coordinates, and only for animals inside the map viewport.
+    Optionally, the animal density is sent as a second overlay once per model step.
+
+    The module remembers what it sent, so it must render for a single browser: every connection renders
+    with its own session_copy, as ViewportSocketHandler and SessionSocketHandler do.
+    """
+
+    package_includes = ["leaflet.js"]
+    local_includes = ["DeltaMapModule.js"]
+
+    def __init__(self, portrayal_method, view=[0, 0], zoom=10, map_height=500, map_width=500,
+                 viewport=True, ndvi_cmap="Greens", max_overlay_pixels=1024, density_bandwidth=None,
+                 density_cmap="Reds"):
+        """Create a new map module.
+        :param portrayal_method: Function returning the portrayal dictionary (color, radius) of an animal.
+        :param view: [lat, lon] center of the map.
+        :param zoom: Initial zoom level.
+        :param map_height: Height of the map in pixels.
+        :param map_width: Width of the map in pixels.
+        :param viewport: Only send animals inside the browser's map viewport.
+        :param ndvi_cmap: Matplotlib colormap of the NDVI overlay.
+        :param max_overlay_pixels: Maximum width and height of the NDVI overlay image.
+        :param density_bandwidth: Kernel standard deviation of the animal density overlay, in units of
+                                  the model's CRS; None leaves the overlay out.
+        :param density_cmap: Matplotlib colormap of the density overlay.
+        """
+        self.portrayal_method = portrayal_method
+        self.map_height = map_height
+        self.map_width = map_width
+        self.view = view
+        self.ndvi_cmap = ndvi_cmap
+        self.max_overlay_pixels = max_overlay_pixels
+        self.density_bandwidth = density_bandwidth
+        self.density_cmap = density_cmap
+
+        # Viewport as (south, west, north, east), set by the browser
+        self.bounds = None
+        self._model = None
+        # (id of the NDVI data, NDVI date) -> (NDVI data, overlay); the data is kept so its id stays unique
+        self._overlays = {}
+        self._reset_client(0)
+
+        new_element = "new DeltaMapModule({}, {}, {}, {}, {})"
+        new_element = new_element.format(view, zoom, map_width, map_height, str(viewport).lower())
+        self.js_code = "elements.push(" + new_element + ");"
+
+    def _reset_client(self, n_animals) -> None:
+        """Forget what the browser shows, so the next render sends everything.
+        :param n_animals: Number of animals of the model.
+        """
+        self._shown_date = _NO_OVERLAY
+        self._shown_density = None
+        self._shown = np.zeros(n_animals, dtype=bool)
+        self._shown_lat = np.full(n_animals, np.nan)
+        self._shown_lon = np.full(n_animals, np.nan)
+
+    def session_copy(self):
+        """Copy the module for another browser session, which has its own map state.
+        The copy shares the cached NDVI overlays with this module.
+
+        Returns: DeltaMapModule that starts from an empty map.
+        """
+        element = copy.copy(self)
+        element.bounds = None
+        element._model = None
+        element._reset_client(0)
+        return element
+
+    def set_viewport(self, bounds) -> None:
+        """Store the map viewport of the browser.
+        :param bounds: [south, west, north, east] in degrees, or None for the whole map.
+        """
+        self.bounds = None if bounds is None else tuple(float(b) for b in bounds)
+
+    def ndvi_overlay(self, model) -> dict:
+        """Render the NDVI values within the survey area into a transparent PNG.
+        The image is sampled at the NDVI resolution, capped at max_overlay_pixels per side.
+        :param model: AnimalModel to render.
+
+        Returns: Dictionary with the PNG as data url and its [[south, west], [north, east]] bounds.
+        """
+        minx, miny, maxx, maxy = model.SURVEY_POLYGON.bounds
+        resolution = model.boundary.resolution
+        width = int(np.clip(np.ceil((maxx - minx) / resolution), 1, self.max_overlay_pixels))
+        height = int(np.clip(np.ceil((maxy - miny) / resolution), 1, self.max_overlay_pixels))
+
+        # Pixel centers, first row in the north
+        xs = minx + (np.arange(width) + 0.5) * (maxx - minx) / width
+        ys = maxy - (np.arange(height) + 0.5) * (maxy - miny) / height
+        x, y = (grid.ravel() for grid in np.meshgrid(xs, ys))
+
+        values = np.full(x.shape, np.nan)
+        inside = model.boundary.contains(x, y)
+        if model.ndvi_raster is not None:
+            values[inside] = model.ndvi_raster.lookup(x[inside], y[inside])
+        else:
+            patches = model.ndvi_polygon_index.locate(x[inside], y[inside])
+            values[inside] = np.where(patches >= 0, model.ndvi_index.values[np.maximum(patches, 0)], np.nan)
+        values[values == NO_NDVI] = np.nan
+
+        # Quantized colors, no data is transparent
+        rgba = ndvi_colors(self.ndvi_cmap)[1][ndvi_color_index(values)]
+        rgba[np.isnan(values), 3] = 0
+
+        png = io.BytesIO()
+        matplotlib.image.imsave(png, rgba.reshape(height, width, 4), format='png')
+        url = 'data:image/png;base64,' + base64.b64encode(png.getvalue()).decode()
+
+        lon, lat = model.grid.Transformer.transform([minx, maxx], [miny, maxy])
+        return {"url": url, "bounds": [[lat[0], lon[0]], [lat[1], lon[1]]]}
+
+    def density_overlay(self, model) -> dict:
+        """Render the density of the animals into a transparent PNG, opaque where they are densest.
+        :param model: AnimalModel to render.
+
+        Returns: Dictionary with the PNG as data url and its [[south, west], [north, east]] bounds.
+        """
+        density = model_density(model, bandwidth=self.density_bandwidth)
+        peak = density.values.max()
+        scaled = density.values / peak if peak > 0 else np.zeros(density.values.shape)
+
+        rgba = _get_cmap(self.density_cmap)(scaled, bytes=True)
+        rgba[..., 3] = (scaled * 255).astype(np.uint8)
+
+        # First row in the north
+        png = io.BytesIO()
+        matplotlib.image.imsave(png, rgba[::-1], format='png')
+        url = 'data:image/png;base64,' + base64.b64encode(png.getvalue()).decode()
+
+        minx, miny, maxx, maxy = density.bounds
+        lon, lat = model.grid.Transformer.transform([minx, maxx], [miny, maxy])
+        return {"url": url, "bounds": [[lat[0], lon[0]], [lat[1], lon[1]]]}
+
+    def render(self, model):
+        x, y, counts = model.animal_positions()
+        # A ModelSnapshot (see session.py) is rendered as the model it was taken of
+        source = getattr(model, 'model', model)
+        if source is not self._model or len(self._shown) != len(x):
+            # New or reset model: the browser starts from an empty map
+            self._model = source
+            self._reset_client(len(x))
+        data = {"ndvi": None, "density": None, "added": [], "moved": [], "removed": []}
+
+        # NDVI overlay, only when the browser shows another date
+        if model.ndvi_date != self._shown_date:
+            key = (id(model.gdf_ndvi), model.ndvi_date)
+            if key not in self._overlays:
+                self._overlays[key] = (model.gdf_ndvi, self.ndvi_overlay(model))
+            data["ndvi"] = self._overlays[key][1]
+            self._shown_date = model.ndvi_date
+
+        # Density overlay, once per step
+        if self.density_bandwidth is not None and model.steps != self._shown_density:
+            data["density"] = self.density_overlay(model)
+            self._shown_density = model.steps
+
+        lon, lat = model.grid.Transformer.transform(x, y)
+        lat = np.round(np.asarray(lat, dtype=float), COORD_DECIMALS)
+        lon = np.round(np.asarray(lon, dtype=float), COORD_DECIMALS)
+
+        visible = np.ones(len(lat), dtype=bool)
+        if self.bounds is not None:
+            south, west, north, east = self.bounds
+            visible = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+
+        added = visible & ~self._shown
+        moved = visible & self._shown & ((lat != self._shown_lat) | (lon != self._shown_lon))
+        removed = self._shown & ~visible
+
+        for i in np.flatnonzero(added).tolist():
+            portrayal = self.portrayal_method(model._animal_agents[i])
+            data["added"].append([i, lat[i], lon[i], portrayal.get("radius", 1), portrayal.get("color", "Red"),
+                                  float(counts[i])])
+        data["moved"] = np.column_stack([np.flatnonzero(moved), lat[moved], lon[moved]]).tolist()
+        data["removed"] = np.flatnonzero(removed).tolist()
+
+        sent = added | moved
+        self._shown_lat[sent] = lat[sent]
+        self._shown_lon[sent] = lon[sent]
+        self._shown = visible
+        return data
+
+
+class ViewportSocketHandler(SocketHandler):
+    """WebSocket handler that also receives the map viewport of the browser.
+
+    Every connection renders with its own copies of the visualization elements, so what is sent to a
+    browser only depends on what that browser was sent before, however many other pages are open.
+    """
+
+    def open(self):
+        # A new page shows an empty map
+        self.elements = [element.session_copy() if hasattr(element, 'session_copy') else element
+                         for element in self.application.visualization_elements]
+        super().open()
+
+    @property
+    def viz_state_message(self) -> dict:
+        return {"type": "viz_state", "data": [element.render(self.application.model) for element in self.elements]}
+
+    def on_message(self, message):
+        msg = tornado.escape.json_decode(message)
+        if msg["type"] != "viewport":
+            return super().on_message(message)
+
+        for element in self.elements:
+            if isinstance(element, DeltaMapModule):
+                element.set_viewport(msg["bounds"])
+        # Send the animals that came into view
+        self.write_message(self.viz_state_message)
+
+
+class DeltaModularServer(ModularServer):
+    """ModularServer whose WebSocket also handles viewport messages of DeltaMapModule."""
+
+    socket_handler = (r'/ws', ViewportSocketHandler)
+    handlers = [ModularServer.page_handler, socket_handler,
+                ModularServer.static_handler, ModularServer.local_handler]
@@ -4,18 +4,160 @@ Use this file to write the agent-based model.
 
 """
 
+import copy
 import os
+import random
+import threading
+from functools import lru_cache
 import numpy as np
 import geopandas as gp
 from mesa import Model
 from mesa.time import BaseScheduler
-from mesa_geo import GeoSpace
-from mesa_geo.geoagent import GeoAgent, AgentCreator
+import mesa_geo
+from mesa_geo.geoagent import GeoAgent
 from shapely.geometry import Point
+from spatial import NDVIIndex, PolygonIndex, CentroidIndex, best_cells, is_ndvi_raster, SplitGeoSpace
+from profiling import StepProfiler, null_section
+from boundary import SurveyBoundary, BOUNDARY_MODES
+
+# The agents are written for the GeoAgent and GeoSpace of mesa-geo 0.2, as pinned in requirements.txt
+if not mesa_geo.__version__.startswith('0.2.'):
+    raise ModuleNotFoundError(f"mesa-geo 0.2 is required, found {mesa_geo.__version__}; see requirements.txt",
+                              name='mesa_geo')
 
 # Set data path
 polygon_path = r'./data/geometries/'
 
+# NDVI value of an animal that is not on any NDVI patch
+NO_NDVI = -1
+
+
+@lru_cache(maxsize=None)
+def get_survey_polygon():
+    """Read the survey area polygon, once per process.
+
+    Returns: Shapely Polygon of survey area."""
+
+    return gp.read_file(os.path.join(
+        polygon_path, 'Census2017Polygon-filled.shp'))['geometry'].values[0]
+
+
+@lru_cache(maxsize=None)
+def get_map_coords() -> list:
+    """Calculate the center of the survey area as [lat, lon] for the map view."""
+
+    survey_polygon = get_survey_polygon()
+    y_mean = np.mean(np.concatenate(
+        [tup[0] for tup in [survey_polygon.exterior.coords.xy]]))
+    x_mean = np.mean(np.concatenate(
+        [tup[1] for tup in [survey_polygon.exterior.coords.xy]]))
+    return [x_mean, y_mean]
+
+
+class _LazyClassAttribute:
+    """Class attribute that is computed by a function on first access."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, instance, owner):
+        return self.func()
+
+
+def _read_only(array) -> np.ndarray:
+    """Mark an array as read-only, so models sharing it cannot change it by accident."""
+    array.flags.writeable = False
+    return array
+
+
+class SharedNDVILayer:
+    """NDVI patches with their spatial indexes, built once and shared read-only by many models.
+
+    Models built on a shared layer take the patch polygons, R-tree, patch index, centroids and
+    survey area mask from it instead of building their own, e.g. one model per server session.
+    Every model still keeps its own NDVI values, so it can step through an NDVI series on its own.
+    The array engine creates no NDVI agents at all on a shared layer.
+    """
+
+    def __init__(self, gdf_ndvi, crs=None):
+        """Create a new shared NDVI layer.
+        :param gdf_ndvi: GeoDataframe with NDVI values & geometry.
+        :param crs: CRS of the models that share the layer, None keeps the CRS of gdf_ndvi.
+        """
+        if crs is not None and not crs == gdf_ndvi.crs:
+            gdf_ndvi = gdf_ndvi.to_crs(crs)
+        self.gdf = gdf_ndvi
+        self.crs = gdf_ndvi.crs
+
+        self.bounds = _read_only(gdf_ndvi.geometry.bounds.to_numpy(dtype=float))
+        self.values = _read_only(gdf_ndvi['value'].to_numpy(dtype=float))
+        # Patch polygons in row order, for batched point lookups
+        self.polygon_index = PolygonIndex(gdf_ndvi.geometry.tolist(), bounds=self.bounds)
+        centroids = gdf_ndvi.geometry.centroid
+        self.ndvi_x = _read_only(centroids.x.to_numpy(dtype=float))
+        self.ndvi_y = _read_only(centroids.y.to_numpy(dtype=float))
+
+        # Built on first use, under the lock; the lock also guards queries of the R-tree
+        self.lock = threading.Lock()
+        self._static_index = None
+        self._patch_points = None
+        self._boundaries = {}
+        self._centroid_indexes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def static_index(self):
+        """R-tree over the patch bounds, keyed by patch position.
+
+        Returns: rtree Index for SplitGeoSpace.add_static_agents.
+        """
+        with self.lock:
+            if self._static_index is None:
+                self._static_index = SplitGeoSpace.static_index(self.bounds)
+            return self._static_index
+
+    def patch_points(self):
+        """Get a point inside every NDVI patch, in row order.
+
+        Returns: (x, y): Read-only arrays with coordinates.
+        """
+        with self.lock:
+            if self._patch_points is None:
+                points = [shape.representative_point() for shape in self.gdf.geometry.tolist()]
+                self._patch_points = (_read_only(np.array([point.x for point in points], dtype=float)),
+                                      _read_only(np.array([point.y for point in points], dtype=float)))
+            return self._patch_points
+
+    def boundary(self, polygon, mode) -> SurveyBoundary:
+        """Survey area mask at the resolution of the patches, rasterized once per polygon.
+        :param polygon: Shapely Polygon of survey area.
+        :param mode: Boundary rule of the model, see SurveyBoundary.
+
+        Returns: SurveyBoundary sharing its mask with the other models.
+        """
+        with self.lock:
+            key = polygon.wkb
+            if key not in self._boundaries:
+                boundary = SurveyBoundary(polygon, resolution=self.polygon_index.bucket_size)
+                _read_only(boundary.mask)
+                self._boundaries[key] = boundary
+            boundary = copy.copy(self._boundaries[key])
+        boundary.mode = mode
+        return boundary
+
+    def centroid_index(self, bucket_size) -> CentroidIndex:
+        """Spatial index over the patch centroids, built once per bucket size.
+        :param bucket_size: Bucket size of the index, e.g. the smallest search radius.
+
+        Returns: CentroidIndex.
+        """
+        with self.lock:
+            if bucket_size not in self._centroid_indexes:
+                self._centroid_indexes[bucket_size] = CentroidIndex(self.ndvi_x, self.ndvi_y,
+                                                                    bucket_size=bucket_size)
+            return self._centroid_indexes[bucket_size]
+
 
 class NDVIcell(GeoAgent):
     """Agent class representing stationary NDVI cells."""
@@ -32,9 +174,40 @@ class NDVIcell(GeoAgent):
         # Agent parameters
         self.value = value
 
+    @classmethod
+    def from_geodataframe(cls, model, gdf_ndvi) -> list:
+        """Create NDVI agents for all rows of a GeoDataFrame in one pass over its columns.
+        :param model:    Model in which the agents run
+        :param gdf_ndvi: GeoDataframe with NDVI values & geometry, in the CRS of the model
+
+        Returns: List of NDVIcell agents, in row order.
+        """
+        return [cls(unique_id, model, shape, value)
+                for unique_id, shape, value in zip(gdf_ndvi.index.tolist(),
+                                                   gdf_ndvi.geometry.tolist(),
+                                                   gdf_ndvi['value'].tolist())]
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        # Keep the model's NDVI index up to date
+        self._value = value
+        ndvi_index = getattr(self.model, 'ndvi_index', None)
+        if ndvi_index is not None and self in ndvi_index:
+            ndvi_index.update(self, value)
+
     def step(self):
         pass
 
+    def __geo_interface__(self):
+        """Return a GeoJSON Feature, with the NDVI value under its public name."""
+        feature = super().__geo_interface__()
+        feature['properties']['value'] = self.value
+        return feature
+
     def __repr__(self):
         return "NDVI Patch " + str(self.unique_id) + " with Value: " + str(self.value)
 
@@ -42,7 +215,8 @@ class NDVIcell(GeoAgent):
 class Animal(GeoAgent):
     """Agent Class representing an animal."""
 
-    def __init__(self, unique_id, model, shape, animal_count=1.0, mobility_range=0.1, ndvi_value=-1):
+    def __init__(self, unique_id, model, shape, animal_count=1.0, mobility_range=0.1, ndvi_value=NO_NDVI,
+                 species=None):
         """Create new animal agent.
 
         :param unique_id:      Unique identifier for the agent
@@ -50,19 +224,42 @@ class Animal(GeoAgent):
         :param shape:          Shape object for the agent
         :param animal_count:   Animal count per viewing, as presented in gdf.
         :param mobility range: Range of distance to move in one step.
-        :param ndvi:           Tuple holding underlying NDVI patch centroid and value
+        :param ndvi_value:     NDVI value of the patch the animal is on
+        :param species:        2-letter abbreviation name of the species
         """
         super().__init__(unique_id, model, shape)
         # Agent parameters
         self.animal_count = animal_count
         self.mobility_range = mobility_range  # distance travelled per step
         self.ndvi_value = ndvi_value
-
-    def move_animal(self, destination) -> Point:
+        self.destination = None  # best local NDVI patch, set by the model in 'local' movement
+        self.species = species
+
+    @classmethod
+    def from_geodataframe(cls, model, gdf_animal, animal_name, mobility_range=None, id_prefix="") -> list:
+        """Create animal agents for all rows of a GeoDataFrame in one pass over its columns.
+        :param model:          Model in which the agents run
+        :param gdf_animal:     GeoDataframe with animal counts & geometry, in the CRS of the model
+        :param animal_name:    Column holding the animal count per viewing, also the species of the agents
+        :param mobility_range: Range of distance to move in one step, None keeps the default
+        :param id_prefix:      Prefix of the unique ids, to keep the ids of several species apart
+
+        Returns: List of Animal agents, in row order.
+        """
+        kwargs = {} if mobility_range is None else {'mobility_range': mobility_range}
+        unique_ids = gdf_animal.index.tolist()
+        if id_prefix:
+            unique_ids = [id_prefix + str(unique_id) for unique_id in unique_ids]
+        return [cls(unique_id, model, shape, animal_count=int(count), species=animal_name, **kwargs)
+                for unique_id, shape, count in zip(unique_ids,
+                                                   gdf_animal.geometry.tolist(),
+                                                   gdf_animal[animal_name].tolist())]
+
+    def move_animal(self, destination) -> tuple:
         """Move animal based on surrounding NDVI values.
         :param destination: NDVI destination patch
 
-        Return Shapely Point geometry of new position of agent.
+        Return (x, y) the animal heads for, before the area boundaries are applied.
         """
 
         # If destination value is more than own ndvi value,
@@ -72,26 +269,32 @@ class Animal(GeoAgent):
 
         step = tuple(self.mobility_range * dim for dim in [x_dir, y_dir])
 
-        # Check if Point is within area boundaries
-        if Point(self.shape.x + step[0], self.shape.y + step[1]).within(self.model.SURVEY_POLYGON):
-            return Point(self.shape.x + step[0],
-                         self.shape.y + step[1])
-        else:
-            # If new location not within area, don't move
-            return Point(self.shape.x,
-                         self.shape.y)
+        return self.shape.x + step[0], self.shape.y + step[1]
 
     def step(self):
         """Advance one step."""
 
-        # Calculate NDVI patch with maximum value
-        all_ndvi = [agent for agent in self.model.grid.agents
-                    if isinstance(agent, NDVIcell)]
-        ndvi_max = max(all_ndvi, key=lambda x: x.value)
+        # NDVI patch with maximum value, globally or within the search radius
+        if self.model.movement == "local":
+            ndvi_max = self.destination
+            if ndvi_max is None:
+                return
+        else:
+            with self.model.profile_section('ndvi_lookup'):
+                ndvi_max, _ = self.model.ndvi_index.max()
 
-        # Move to patch with maximum NDVI
+        # Move to patch with maximum NDVI, the model checks area boundaries for all animals at once
         if ndvi_max.value > self.ndvi_value:
-            self.shape = self.move_animal(ndvi_max)
+            self.model.request_move(self, *self.move_animal(ndvi_max))
+
+    def __geo_interface__(self):
+        """Return a GeoJSON Feature, with the animal parameters as properties."""
+        feature = super().__geo_interface__()
+        feature['properties'].update(animal_count=self.animal_count,
+                                     mobility_range=self.mobility_range,
+                                     ndvi_value=self.ndvi_value,
+                                     species=self.species)
+        return feature
 
     def __repr__(self):
         return "Observation: " + str(self.unique_id)
@@ -100,36 +303,115 @@ class Animal(GeoAgent):
 class AnimalModel(Model):
     """Model Class for an animal population model."""
 
-    # Global vars
+    # Global vars, read on first access
     # Survey Area Polygon
-    SURVEY_POLYGON = gp.read_file(os.path.join(
-        polygon_path, 'Census2017Polygon-filled.shp'))['geometry'].values[0]
+    SURVEY_POLYGON = _LazyClassAttribute(lambda: get_survey_polygon())
     # Center of Model
-    y_mean = np.mean(np.concatenate(
-        [tup[0] for tup in [SURVEY_POLYGON.exterior.coords.xy]]))
-    x_mean = np.mean(np.concatenate(
-        [tup[1] for tup in [SURVEY_POLYGON.exterior.coords.xy]]))
-    MAP_COORDS = [x_mean, y_mean]
+    MAP_COORDS = _LazyClassAttribute(lambda: get_map_coords())
 
-    def __init__(self, gdf_animal, gdf_ndvi, animal_name, ndvi_value):
+    # Available stepping engines and movement modes
+    ENGINES = ("agent", "array")
+    MOVEMENTS = ("global", "local")
+
+    def __init__(self, gdf_animal, gdf_ndvi, animal_name, ndvi_value, engine="agent",
+                 movement="global", search_radius=0.1, mobility_range=None, seed=None, recorder=None,
+                 profile=None, profile_dump=None, update_ndvi=True, ndvi_series=None, ndvi_interval=10,
+                 boundary="stay", checkpointer=None, movement_noise=0.0):
         """
         Create a new animal model.
-        :param gdf_animal: GeoDataframe with animal data.
-        :param gdf_ndvi: GeoDataframe with NDVI data.
-        :param animal_name: 2-letter abbreviation name for animal species to be modelled.
+        :param gdf_animal: GeoDataframe with animal data, or a sequence of (gdf, name) pairs as returned by
+                           get_2017_population_data, to model several species on one NDVI layer.
+        :param gdf_ndvi: GeoDataframe with NDVI data, an NDVIRaster, or a SharedNDVILayer. With the array
+                         engine, a raster is never polygonized and a shared layer gets no NDVI agents,
+                         unless the visualization asks for them. The array engine on a raster heads
+                         for pixel centers instead of polygonized patches, see NDVIRaster.
+        :param animal_name: 2-letter abbreviation name for animal species to be modelled, or a list of names.
+                            With (gdf, name) pairs, the species to select, None for all of them.
         :param ndvi_value: NDVI value as present in gdf_ndvi.
+        :param engine: 'agent' steps every Mesa agent, 'array' moves all animals at once using NumPy arrays.
+        :param movement: 'global' heads for the maximum NDVI patch, 'local' for the best patch within search_radius.
+        :param search_radius: Radius (in CRS units) around an animal in which NDVI patches are considered,
+                              or a dictionary with the radius per species.
+        :param mobility_range: Fraction of the distance to the destination moved per step, None keeps the Animal default.
+                               A dictionary sets it per species.
+        :param seed: Seed for the model's random number generator.
+        :param recorder: Optional TrajectoryRecorder that is handed the model state after every step.
+        :param profile: Time every step per section; None follows the ANIMALMODEL_PROFILE environment variable.
+        :param profile_dump: Optional file to write cProfile stats of the profiled steps to.
+        :param update_ndvi: Look up the NDVI patch under every animal again after each step.
+        :param ndvi_series: Optional NDVISeries on the grid of gdf_ndvi, to step through NDVI dates.
+        :param ndvi_interval: Number of steps each NDVI date of ndvi_series stays active.
+        :param boundary: Rule for moves that would leave the survey area: 'stay' put, 'clamp' to the
+                         boundary, or 'slide' along it.
+        :param checkpointer: Optional Checkpointer that periodically writes the model state after a step.
+        :param movement_noise: Standard deviation (in CRS units) of a random displacement added to every
+                               move, drawn from the model's random number generator. 0 keeps the model
+                               deterministic, so that replicates only differ with noise.
         """
 
+        if engine not in self.ENGINES:
+            raise ValueError(f"engine must be one of {self.ENGINES}")
+        if movement not in self.MOVEMENTS:
+            raise ValueError(f"movement must be one of {self.MOVEMENTS}")
+        if boundary not in BOUNDARY_MODES:
+            raise ValueError(f"boundary must be one of {BOUNDARY_MODES}")
+        if ndvi_interval < 1:
+            raise ValueError("ndvi_interval must be at least 1")
+        if movement_noise < 0:
+            raise ValueError("movement_noise must not be negative")
+
+        # Species share the NDVI layer and its indexes, each has its own group of animals
+        animal_groups = self._animal_groups(gdf_animal, animal_name)
+        self.species = tuple(name for _, name in animal_groups)
+        self.mobility_ranges = self._per_species(mobility_range, 'mobility_range')
+        self.search_radii = self._per_species(search_radius, 'search_radius')
+
+        # Mesa keeps the generator it seeds on the class, where the next model would reseed it
+        self.random = random.Random(seed)
+
         # Input parameters
         self.gdf_animal = gdf_animal
         self.gdf_ndvi = gdf_ndvi
-        self.animal_name = animal_name
+        self.animal_name = animal_name if isinstance(animal_name, str) else "/".join(self.species)
         self.ndvi_value = ndvi_value
+        self.engine = engine
+        self.movement = movement
+        self.search_radius = search_radius
+        self.mobility_range = mobility_range
+        self.recorder = recorder
+        self.checkpointer = checkpointer
+        self.update_ndvi = update_ndvi
+        self.ndvi_series = ndvi_series
+        self.ndvi_interval = ndvi_interval
+        self.ndvi_date = None
+        self.movement_noise = movement_noise
+        # Random displacement of every animal in the current step, see _draw_noise
+        self._step_noise = None
+
+        # Step profiling, near free when off
+        if profile is None:
+            self.profiler = StepProfiler.from_env()
+        else:
+            self.profiler = StepProfiler(dump_path=profile_dump) if profile else None
+        self.profile_section = self.profiler.section if self.profiler else null_section
+
+        # NDVI data is a polygon GeoDataFrame, a raster layer, or polygons shared with other models
+        self.ndvi_raster = gdf_ndvi if is_ndvi_raster(gdf_ndvi) else None
+        self.ndvi_layer = gdf_ndvi if isinstance(gdf_ndvi, SharedNDVILayer) else None
 
         # Make sure that projections are equal
-        if not gdf_animal.crs == gdf_ndvi.crs:
-            gdf_ndvi = gdf_ndvi.to_crs(gdf_animal.crs)
-        self.grid = GeoSpace(crs=gdf_animal.crs)
+        crs = animal_groups[0][0].crs
+        animal_groups = [(gdf if gdf.crs == crs else gdf.to_crs(crs), name) for gdf, name in animal_groups]
+        if self.ndvi_raster is not None:
+            if not crs == self.ndvi_raster.crs:
+                raise ValueError("NDVI raster must be in the CRS of the animal data")
+        elif self.ndvi_layer is not None:
+            if not crs == self.ndvi_layer.crs:
+                raise ValueError("Shared NDVI layer must be in the CRS of the animal data")
+        elif not crs == gdf_ndvi.crs:
+            gdf_ndvi = gdf_ndvi.to_crs(crs)
+        # Stationary NDVI cells and moving animals are indexed separately
+        self.grid = SplitGeoSpace(crs=crs)
 
         self.schedule = BaseScheduler(self)
 
@@ -138,60 +420,531 @@ class AnimalModel(Model):
         self.running = True
 
         # Set up the NDVI patches(add to schedule later)
-        AC = AgentCreator(agent_class=NDVIcell,
-                          agent_kwargs={"model": self},
-                          crs=gdf_ndvi.crs)
-        ndvi_agents = AC.from_GeoDataFrame(gdf=gdf_ndvi,
-                                           unique_id="index",
-                                           set_attributes=True)
-        self.grid.add_agents(ndvi_agents)
-        print("NDVI agents added to grid.")
-
-        # Set up Animal Agents
-        gdf_animal = gdf_animal.filter(['geometry', animal_name], axis=1)
-
-        AC = AgentCreator(agent_class=Animal,
-                          agent_kwargs={"model": self},
-                          crs=gdf_animal.crs)
-        animal_agents = AC.from_GeoDataFrame(gdf=gdf_animal,
-                                             unique_id="index",
-                                             set_attributes=True)
+        if self.ndvi_raster is not None and self.engine == "array":
+            # Raster cells are used directly, NDVI agents are built when visualized
+            ndvi_agents = []
+        elif self.ndvi_raster is not None:
+            ndvi_agents = self._create_ndvi_agents(self.ndvi_raster.gdf)
+        elif self.ndvi_layer is not None and self.engine == "array":
+            # Patches are used by position, their polygons and indexes stay in the shared layer
+            ndvi_agents = []
+            self.ndvi_polygon_index = self.ndvi_layer.polygon_index
+        elif self.ndvi_layer is not None:
+            ndvi_agents = self._create_ndvi_agents(self.ndvi_layer.gdf, self.ndvi_layer)
+        else:
+            ndvi_agents = self._create_ndvi_agents(gdf_ndvi)
+
+        # Set up Animal Agents, species after species
+        animal_agents = []
+        self.species_slices = {}
+        for gdf, name in animal_groups:
+            start = len(animal_agents)
+            animal_agents += Animal.from_geodataframe(self, gdf, name, self.mobility_ranges[name],
+                                                      id_prefix=name + "_" if len(animal_groups) > 1 else "")
+            self.species_slices[name] = slice(start, len(animal_agents))
+        # Position of every animal's species in self.species
+        self.animal_species = np.repeat(np.arange(len(self.species), dtype=np.int8),
+                                        [group.stop - group.start for group in self.species_slices.values()])
         self.grid.add_agents(animal_agents)
         print("Animal agents added to grid.")
 
-        # Add agents to schedule with correct NDVI value
-        for ndvi in ndvi_agents:
-            ndvi.value = getattr(ndvi, 'value')
-            self.schedule.add(ndvi)
+        # Add agents to schedule
+        self._schedule_agents(ndvi_agents)
         print("NDVI agents added to schedule.")
 
-        for animal in animal_agents:
-            # Set animal count in agent
-            animal.animal_count = int(getattr(animal, animal_name))
-            self.schedule.add(animal)
+        # Index NDVI values, so animals don't scan the whole grid
+        if self.ndvi_raster is not None and self.engine == "array":
+            self.ndvi_x, self.ndvi_y, raster_values = self.ndvi_raster.cells()
+            self.ndvi_index = NDVIIndex(range(len(raster_values)), raster_values)
+        elif self.ndvi_layer is not None and self.engine == "array":
+            self.ndvi_index = NDVIIndex(range(len(self.ndvi_layer)), self.ndvi_layer.values)
+        else:
+            self.ndvi_index = NDVIIndex(ndvi_agents, [ndvi.value for ndvi in ndvi_agents])
+
+        self._schedule_agents(animal_agents)
         print("Animal agents added to schedule.")
 
-        # Calcualte Animal & NDVI location pairs
+        self._ndvi_agents = ndvi_agents
+        self._animal_agents = animal_agents
+        # Schedule position of every animal, to find its random displacement in the agent engine
+        self._animal_order = {id(animal): pos for pos, animal in enumerate(animal_agents)}
+
+        # NDVI centroids, used by the array engine and local movement
+        if self.ndvi_layer is not None:
+            self.ndvi_x, self.ndvi_y = self.ndvi_layer.ndvi_x, self.ndvi_layer.ndvi_y
+        elif ndvi_agents and (self.engine == "array" or self.movement == "local"):
+            centroids = [ndvi.shape.centroid for ndvi in ndvi_agents]
+            self.ndvi_x = np.array([c.x for c in centroids], dtype=float)
+            self.ndvi_y = np.array([c.y for c in centroids], dtype=float)
+
+        # Survey area mask at the resolution of the NDVI data
+        if self.ndvi_raster is not None:
+            resolution = abs(self.ndvi_raster.transform.a)
+        elif ndvi_agents:
+            resolution = self.ndvi_polygon_index.bucket_size
+        else:
+            resolution = None
+        if self.ndvi_layer is not None:
+            self.boundary = self.ndvi_layer.boundary(self.SURVEY_POLYGON, mode=boundary)
+        else:
+            self.boundary = SurveyBoundary(self.SURVEY_POLYGON, resolution=resolution, mode=boundary)
+        # Moves requested by the animals during an agent engine step
+        self._requested_moves = []
+
+        # Start the NDVI time series at its first date
+        if self.ndvi_series is not None:
+            if self.ndvi_raster is not None and self.engine == "array":
+                self._series_cells = self.ndvi_series.cell_index(self.ndvi_x, self.ndvi_y)
+            else:
+                self._series_cells = self.ndvi_series.cell_index(*self._patch_points())
+            self.set_ndvi_date(0)
+
+        # Spatial index over NDVI centroids, built once for all species
+        if self.movement == "local":
+            if self.ndvi_layer is not None:
+                self.centroid_index = self.ndvi_layer.centroid_index(min(self.search_radii.values()))
+            else:
+                self.centroid_index = CentroidIndex(self.ndvi_x, self.ndvi_y,
+                                                    bucket_size=min(self.search_radii.values()))
+
+        if self.engine == "array":
+            self._init_arrays()
+
+        # Calculate Animal & NDVI location pairs
         self.get_animal_ndvi_pairs()
 
-    def get_animal_ndvi_pairs(self) -> None:
-        """Calculate which animals are located on which NDVI patch."""
+        # Record the initial state
+        if self.recorder is not None:
+            self.recorder.collect(self)
+
+    @staticmethod
+    def _animal_groups(gdf_animal, animal_name) -> list:
+        """Get the animal data of every modelled species.
+        :param gdf_animal: GeoDataframe with animal data, or a sequence of (gdf, name) pairs.
+        :param animal_name: Species name or list of names; with pairs, None selects all of them.
+
+        Returns: List of (gdf, name) pairs, one per species.
+        """
+
+        if isinstance(gdf_animal, gp.GeoDataFrame):
+            if isinstance(animal_name, str):
+                return [(gdf_animal, animal_name)]
+            # One frame with a count column per species, rows without the species are left out
+            groups = [(gdf_animal[gdf_animal[name] > 0], name) for name in animal_name]
+        else:
+            groups = [(gdf, name) for gdf, name in gdf_animal]
+            if animal_name is not None:
+                names = [animal_name] if isinstance(animal_name, str) else list(animal_name)
+                missing = set(names) - {name for _, name in groups}
+                if missing:
+                    raise ValueError(f"No animal data for species {sorted(missing)}")
+                groups = [group for group in groups if group[1] in names]
+
+        if not groups:
+            raise ValueError("At least one species must be modelled")
+        if len({name for _, name in groups}) != len(groups):
+            raise ValueError("Every species can only be modelled once")
+        return groups
+
+    def _per_species(self, value, parameter) -> dict:
+        """Get a movement parameter per species.
+        :param value: Value for all species, or a dictionary with the value per species.
+        :param parameter: Name of the parameter, for the error message.
+
+        Returns: Dictionary with the value per species.
+        """
+
+        if not isinstance(value, dict):
+            return {name: value for name in self.species}
+        missing = set(self.species) - value.keys()
+        if missing:
+            raise ValueError(f"{parameter} is missing species {sorted(missing)}")
+        return {name: value[name] for name in self.species}
+
+    def _create_ndvi_agents(self, gdf_ndvi, layer=None) -> list:
+        """Create NDVI agents from a GeoDataFrame and add them to the grid.
+        :param gdf_ndvi: GeoDataframe with NDVI data.
+        :param layer: SharedNDVILayer of gdf_ndvi, whose indexes are used instead of building new ones.
+
+        Returns: List of NDVIcell agents.
+        """
+
+        ndvi_agents = NDVIcell.from_geodataframe(self, gdf_ndvi)
+        if layer is not None:
+            self.grid.add_static_agents(ndvi_agents, shared_index=layer.static_index(), lock=layer.lock)
+            self.ndvi_polygon_index = layer.polygon_index
+        else:
+            bounds = gdf_ndvi.geometry.bounds.to_numpy()
+            self.grid.add_static_agents(ndvi_agents, bounds=bounds)
+            # Patch polygons in agent order, for batched point lookups
+            self.ndvi_polygon_index = PolygonIndex(gdf_ndvi.geometry.tolist(), bounds=bounds)
+        self._ndvi_points = None
+        print("NDVI agents added to grid.")
+
+        return ndvi_agents
+
+    def _patch_points(self):
+        """Get a point inside every NDVI patch, in agent order. Calculated once.
+
+        Returns: (x, y): Arrays with coordinates.
+        """
+
+        if self.ndvi_layer is not None:
+            return self.ndvi_layer.patch_points()
+        if self._ndvi_points is None:
+            points = [ndvi.shape.representative_point() for ndvi in self._ndvi_agents]
+            self._ndvi_points = (np.array([point.x for point in points], dtype=float),
+                                 np.array([point.y for point in points], dtype=float))
+        return self._ndvi_points
+
+    def set_ndvi_date(self, date) -> None:
+        """Activate one date of the NDVI time series, updating the NDVI patches in place.
+        Every patch takes the value of the series cell under its centroid (or representative point).
+        :param date: Position of the date in ndvi_series.
+        """
+
+        layer = self.ndvi_series.layer(date)
+        rows, cols, inside = self._series_cells
+        values = np.full(len(rows), NO_NDVI, dtype=float)
+        values[inside] = layer.values[rows[inside], cols[inside]]
+
+        # Updates the shared array, so the array engine sees the new values too
+        self.ndvi_index.assign(values)
+        if self.ndvi_raster is not None:
+            self.ndvi_raster = layer
+        if self._ndvi_agents:
+            self._update_ndvi_agents()
+
+        self.ndvi_date = date
+
+    def _update_ndvi_agents(self) -> None:
+        """Set the values of the NDVI agents to the active NDVI data."""
+
+        if self.ndvi_raster is not None and self.engine == "array":
+            # Agents only exist for the visualization here, they are not indexed
+            values = self.ndvi_raster.lookup(*self._patch_points(), fill=NO_NDVI)
+        else:
+            values = self.ndvi_index.values
+
+        # The NDVI index already holds these values
+        for ndvi, value in zip(self._ndvi_agents, values.tolist()):
+            ndvi._value = value
+
+    def _schedule_agents(self, agents) -> None:
+        """Add many agents to the schedule at once, in order.
+        :param agents: List of agents with unique ids not yet in the schedule.
+        """
+
+        scheduled = self.schedule._agents
+        unique_ids = [agent.unique_id for agent in agents]
+        if len(set(unique_ids)) != len(unique_ids) or not scheduled.keys().isdisjoint(unique_ids):
+            raise ValueError("Agents must have unique ids that are not yet in the schedule")
+        scheduled.update(zip(unique_ids, agents))
+
+    def get_animal_ndvi_pairs(self) -> np.ndarray:
+        """Calculate which animals are located on which NDVI patch, and set their NDVI value.
+        All animals are looked up at once, so this is cheap enough to repeat after every step.
+        Animals outside every NDVI patch get NO_NDVI.
+
+        Returns: Array with the NDVI value of every animal, in schedule order.
+        """
+
+        x, y, _ = self.animal_positions()
+
+        if self.ndvi_raster is not None:
+            # Inverse-affine lookup for all animals at once
+            values = self.ndvi_raster.lookup(x, y, fill=NO_NDVI)
+        else:
+            # Spatial join of all animals with the NDVI patches
+            patches = self.ndvi_polygon_index.locate(x, y)
+            values = np.where(patches >= 0, self.ndvi_index.values[np.maximum(patches, 0)], NO_NDVI)
+
+        if self.engine == "array":
+            self.animal_ndvi[:] = values
+            self._agents_stale = True
+        else:
+            for animal, value in zip(self._animal_agents, values.tolist()):
+                animal.ndvi_value = value
+
+        return values
+
+    def local_destinations(self, x, y, radius=None) -> np.ndarray:
+        """Find the best NDVI patch within the search radius of many positions at once.
+        :param x: Array with animal x coordinates.
+        :param y: Array with animal y coordinates.
+        :param radius: Search radius, defaults to the one of the first species.
+
+        Returns: Array with the NDVI patch position per animal, -1 if none is in range.
+        """
+
+        if radius is None:
+            radius = self.search_radii[self.species[0]]
+        point_idx, cell_idx = self.centroid_index.query_radius(x, y, radius)
+        return best_cells(point_idx, cell_idx, self.ndvi_index.values, len(x))
+
+    def _init_arrays(self) -> None:
+        """Copy agent state into NumPy arrays for the array engine."""
 
-        observations = [agent for agent in self.grid.agents
-                        if isinstance(agent, Animal)]
+        animal_agents = self._animal_agents
+        # Shared with the NDVI index, so value updates are seen here too
+        self.ndvi_values = self.ndvi_index.values
 
-        for idx, observation in enumerate(observations):
-            # NDVI Patches that agent is within, can only be one
-            Local_NDVI = next(self.grid.get_relation(observation, "within"))
-            if isinstance(Local_NDVI, NDVIcell):
-                # Set observation's NDVI
-                observation.ndvi = Local_NDVI.value
+        self.animal_x = np.array([a.shape.x for a in animal_agents], dtype=float)
+        self.animal_y = np.array([a.shape.y for a in animal_agents], dtype=float)
+        self.animal_counts = np.array([a.animal_count for a in animal_agents], dtype=float)
+        self.animal_ndvi = np.array([a.ndvi_value for a in animal_agents], dtype=float)
+        self.animal_mobility = np.array([a.mobility_range for a in animal_agents], dtype=float)
+
+        # Whether Mesa agents lag behind the arrays
+        self._agents_stale = False
+
+    def _step_array(self) -> None:
+        """Move all animals in one batched operation per species, mirroring Animal.step."""
+
+        if len(self.ndvi_values) == 0 or len(self.animal_x) == 0:
+            return
+
+        idx_max = None
+        if self.movement == "global":
+            # First cell holding the maximum, like max() over the agents; the same for every species
+            with self.profile_section('ndvi_lookup'):
+                idx_max = self.ndvi_index.argmax()
+
+        for name, group in self.species_slices.items():
+            self._step_species(group, self.search_radii[name], idx_max)
+        self._agents_stale = True
+
+    def _step_species(self, group, radius, idx_max=None) -> None:
+        """Move the animals of one species in one batched operation.
+        :param group: Slice of the species' animals in the arrays.
+        :param radius: Search radius of the species, for local movement.
+        :param idx_max: Position of the maximum NDVI patch, for global movement.
+        """
+
+        x, y = self.animal_x[group], self.animal_y[group]
+
+        with self.profile_section('ndvi_lookup'):
+            if self.movement == "local":
+                # Best patch within each animal's search radius
+                idx_max = self.local_destinations(x, y, radius)
+                found = idx_max >= 0
+                idx_max = np.where(found, idx_max, 0)
+                max_value = np.where(found, self.ndvi_values[idx_max], -np.inf)
+            else:
+                max_value = self.ndvi_values[idx_max]
+
+        # Move towards patch with maximum NDVI
+        mobility = self.animal_mobility[group]
+        new_x = x + mobility * (self.ndvi_x[idx_max] - x)
+        new_y = y + mobility * (self.ndvi_y[idx_max] - y)
+        if self._step_noise is not None:
+            new_x += self._step_noise[group, 0]
+            new_y += self._step_noise[group, 1]
+
+        # Only move animals that improve, within area boundaries
+        move = max_value > self.animal_ndvi[group]
+        with self.profile_section('boundary'):
+            new_x[move], new_y[move] = self.boundary.move(x[move], y[move], new_x[move], new_y[move])
+
+        self.animal_x[group] = np.where(move, new_x, x)
+        self.animal_y[group] = np.where(move, new_y, y)
+
+    def sync_agents(self) -> None:
+        """Write array engine state back into the Mesa agents, e.g. before visualization."""
+
+        if self.engine != "array":
+            return
+
+        # Raster NDVI is only polygonized once something needs the agents
+        if self.ndvi_raster is not None and not self._ndvi_agents:
+            self._ndvi_agents = self._create_ndvi_agents(self.ndvi_raster.gdf)
+        elif self.ndvi_layer is not None and not self._ndvi_agents:
+            self._ndvi_agents = self._create_ndvi_agents(self.ndvi_layer.gdf, self.ndvi_layer)
+            # Agents start at the layer's values, the model may be at another NDVI date
+            self._update_ndvi_agents()
+
+        if not self._agents_stale:
+            return
+
+        for agent, x, y, ndvi in zip(self._animal_agents, self.animal_x,
+                                     self.animal_y, self.animal_ndvi):
+            agent.shape = Point(x, y)
+            agent.ndvi_value = ndvi
+
+        # Update spatial tree, because agents have moved
+        with self.profile_section('rtree'):
+            self.grid.refresh()
+        self._agents_stale = False
+
+    def request_move(self, animal, x, y) -> None:
+        """Queue a move of an animal, to be checked against the area boundaries after all animals stepped.
+        :param animal: Animal that moves.
+        :param x: x coordinate the animal heads for.
+        :param y: y coordinate the animal heads for.
+        """
+
+        self._requested_moves.append((animal, x, y))
+
+    def _apply_moves(self) -> None:
+        """Apply the boundary rule to all requested moves in one vectorized call, and move the animals."""
+
+        if not self._requested_moves:
+            return
+
+        animals, new_x, new_y = zip(*self._requested_moves)
+        self._requested_moves = []
+        x = np.array([animal.shape.x for animal in animals], dtype=float)
+        y = np.array([animal.shape.y for animal in animals], dtype=float)
+        if self._step_noise is not None:
+            # Same displacement per animal as the array engine, by schedule position
+            order = [self._animal_order[id(animal)] for animal in animals]
+            new_x = np.asarray(new_x, dtype=float) + self._step_noise[order, 0]
+            new_y = np.asarray(new_y, dtype=float) + self._step_noise[order, 1]
+
+        new_x, new_y = self.boundary.move(x, y, new_x, new_y)
+        moved = (new_x != x) | (new_y != y)
+        for animal, ax, ay in zip(np.array(animals, dtype=object)[moved], new_x[moved], new_y[moved]):
+            animal.shape = Point(ax, ay)
+
+    def animal_positions(self):
+        """Get current animal positions and counts, in schedule order, for either engine.
+
+        Returns: (x, y, counts): Arrays with animal coordinates and animal counts.
+        """
+
+        if self.engine == "array":
+            return self.animal_x, self.animal_y, self.animal_counts
+
+        animals = self._animal_agents
+        return (np.array([a.shape.x for a in animals], dtype=float),
+                np.array([a.shape.y for a in animals], dtype=float),
+                np.array([a.animal_count for a in animals], dtype=float))
+
+    def set_animal_state(self, x, y, ndvi, mobility=None) -> None:
+        """Set position and NDVI value of all animals at once, e.g. when resuming from a checkpoint.
+        :param x: Array with x coordinates, in schedule order.
+        :param y: Array with y coordinates, in schedule order.
+        :param ndvi: Array with the NDVI value of every animal.
+        :param mobility: Optional array with the mobility range of every animal.
+        """
+
+        x, y, ndvi = (np.array(values, dtype=float) for values in (x, y, ndvi))
+        if not len(x) == len(y) == len(ndvi) == len(self._animal_agents):
+            raise ValueError("State must hold one value per animal")
+
+        if self.engine == "array":
+            self.animal_x, self.animal_y, self.animal_ndvi = x, y, ndvi
+            if mobility is not None:
+                self.animal_mobility = np.array(mobility, dtype=float)
+            self._agents_stale = True
+            return
+
+        for i, animal in enumerate(self._animal_agents):
+            if animal.shape.x != x[i] or animal.shape.y != y[i]:
+                animal.shape = Point(x[i], y[i])
+            animal.ndvi_value = float(ndvi[i])
+            if mobility is not None:
+                animal.mobility_range = float(mobility[i])
+
+        # Update spatial tree for the animals that moved
+        self.grid.refresh()
+
+    def animal_ndvi_values(self) -> np.ndarray:
+        """Get the NDVI value of every animal, in schedule order, for either engine."""
+
+        if self.engine == "array":
+            return self.animal_ndvi
+
+        return np.array([a.ndvi_value for a in self._animal_agents], dtype=float)
 
     def step(self) -> None:
         """"Step through the model."""
 
         self.steps += 1
-        self.schedule.step()
 
-        # Recalculate spatial tree, because agents are moving
-        self.grid._recreate_rtree()
+        if self.profiler is None:
+            self._advance()
+        else:
+            with self.profiler.step():
+                self._advance()
+
+    def profile_report(self):
+        """Print the step profile and write the cProfile dump, if profiling is on.
+
+        Returns: DataFrame with time per section, or None.
+        """
+
+        if self.profiler is None:
+            return None
+        return self.profiler.report()
+
+    def _advance(self) -> None:
+        """Advance all animals by one step and record the result."""
+
+        # Switch to the next NDVI date every ndvi_interval steps, staying at the last one
+        if self.ndvi_series is not None:
+            date = min(self.steps // self.ndvi_interval, len(self.ndvi_series) - 1)
+            if date != self.ndvi_date:
+                with self.profile_section('ndvi_update'):
+                    self.set_ndvi_date(date)
+
+        self._step_noise = self._draw_noise()
+        if self.engine == "array":
+            with self.profile_section('agent_step'):
+                self._step_array()
+        else:
+            self._step_agents()
+
+        # Keep the animals' NDVI current
+        if self.update_ndvi:
+            with self.profile_section('ndvi_pairs'):
+                self.get_animal_ndvi_pairs()
+
+        if self.recorder is not None:
+            with self.profile_section('recording'):
+                self.recorder.collect(self)
+
+        if self.checkpointer is not None:
+            with self.profile_section('checkpoint'):
+                self.checkpointer.collect(self)
+
+    def _draw_noise(self):
+        """Draw the random displacement of every animal for one step, from the model's generator.
+        A model with the same seed, or restored from a checkpoint, draws the same displacements.
+
+        Returns: (n_animals, 2) array with x and y displacements in schedule order, None without noise.
+        """
+
+        if not self.movement_noise:
+            return None
+        seed = self.random.getrandbits(64)
+        noise = np.empty((len(self._animal_agents), 2))
+        for name, group in self.species_slices.items():
+            # A stream per species, so a species moves the same as in a model of its own with this seed
+            generator = np.random.default_rng([seed, *name.encode()])
+            noise[group] = generator.normal(0.0, self.movement_noise, (group.stop - group.start, 2))
+        return noise
+
+    def _step_agents(self) -> None:
+        """Step every agent through the Mesa scheduler."""
+
+        if self.movement == "local":
+            # Batch-query the neighbourhoods of all animals of a species before they move
+            with self.profile_section('ndvi_lookup'):
+                for name, group in self.species_slices.items():
+                    animals = self._animal_agents[group]
+                    destinations = self.local_destinations([a.shape.x for a in animals],
+                                                           [a.shape.y for a in animals],
+                                                           self.search_radii[name])
+                    for animal, pos in zip(animals, destinations):
+                        animal.destination = self._ndvi_agents[pos] if pos >= 0 else None
+
+        with self.profile_section('agent_step'):
+            self.schedule.step()
+
+        with self.profile_section('boundary'):
+            self._apply_moves()
+
+        # Update spatial tree for the agents that moved
+        with self.profile_section('rtree'):
+            self.grid.refresh()
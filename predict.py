@@ -2,4 +2,406 @@
 
 Use this file for any (machine learning) predictions.
 
-"""
\ No newline at end of file
+"""
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from density import bin_points, fft_smooth
+from recorder import read_trajectories
+from spatial import PolygonIndex, is_ndvi_raster
+
+# Grid cells along the longer side of the survey area
+EMULATOR_GRID_CELLS = 128
+
+# Smoothing of the NDVI features, in grid cells
+NDVI_SCALES = (4, 16)
+
+# Smoothing of the census density features, in grid cells
+CENSUS_SCALES = (1, 4)
+
+# Fractions of the way to the maximum NDVI patch, for the contracted census features
+CONTRACTIONS = (0.5, 0.9, 0.99)
+
+# Distance decay of the features around the maximum NDVI patch, as fractions of the grid extent
+DISTANCE_SCALES = (0.05, 0.2)
+
+# Polynomial degree of the emulator in the progress of the animals
+PROGRESS_DEGREE = 3
+
+# Batch run settings an emulator is trained for rather than takes as input, with the defaults of batch.run_model
+EMULATOR_CONFIG = {'movement': 'global', 'boundary': 'stay', 'ndvi_interval': None, 'movement_noise': 0.0}
+
+
+def progress(mobility_range, steps) -> np.ndarray:
+    """Fraction of the way to its destination an animal covers in a number of steps.
+    Each step moves mobility_range of the remaining distance, so this is 1 - (1 - mobility_range) ** steps.
+    :param mobility_range: Number or array of mobility ranges.
+    :param steps: Number or array of steps.
+
+    Returns: Array with the progress, in [0, 1].
+    """
+    mobility_range = np.clip(np.asarray(mobility_range, dtype=float), 0, 1)
+    return 1 - (1 - mobility_range) ** np.asarray(steps, dtype=float)
+
+
+def run_config(params) -> dict:
+    """Settings of a batch run that an emulator is trained for, see EMULATOR_CONFIG.
+    :param params: Batch run parameters, e.g. a row of batch.sweep results.
+
+    Returns: Dictionary with the settings, missing ones at their defaults.
+    """
+    config = {}
+    for name, default in EMULATOR_CONFIG.items():
+        value = params.get(name)
+        # Results read back from CSV hold NaN where a setting was not given
+        config[name] = default if value is None or pd.isna(value) else value
+    config['ndvi_interval'] = int(config['ndvi_interval']) if config['ndvi_interval'] else None
+    config['movement_noise'] = float(config['movement_noise'])
+    return config
+
+
+def progress_basis(mobility_range, steps) -> np.ndarray:
+    """Parameter features of the emulator: powers of the progress.
+
+    Returns: (K, PROGRESS_DEGREE + 1) array for K parameter sets.
+    """
+    p = np.atleast_1d(progress(mobility_range, steps))
+    return p[:, None] ** np.arange(PROGRESS_DEGREE + 1)
+
+
+class EmulatorInputs:
+    """Grid cell features of one NDVI layer and census, the part of the emulator input that does not
+    depend on the model parameters.
+
+    The grid covers the survey area. Features per cell are the NDVI value at a few smoothing scales,
+    the census density at a few scales, the census density contracted towards the maximum NDVI patch
+    (where global movement takes the animals), and the distance to that patch.
+    """
+
+    def __init__(self, gdf_ndvi, animal_data, bounds, grid_cells=EMULATOR_GRID_CELLS):
+        """Compute the features.
+        :param gdf_ndvi: GeoDataFrame with NDVI patches and their 'value', or an NDVIRaster.
+        :param animal_data: Sequence of (gdf, name) pairs with the census of the modelled species.
+        :param bounds: (minx, miny, maxx, maxy) of the survey area.
+        :param grid_cells: Grid cells along the longer side of the bounds.
+        """
+        minx, miny, maxx, maxy = bounds
+        self.cell_size = max(maxx - minx, maxy - miny) / grid_cells
+        self.shape = (max(int(np.ceil((maxy - miny) / self.cell_size)), 1),
+                      max(int(np.ceil((maxx - minx) / self.cell_size)), 1))
+        self.bounds = (minx, miny, minx + self.shape[1] * self.cell_size, miny + self.shape[0] * self.cell_size)
+
+        rows, cols = np.mgrid[0:self.shape[0], 0:self.shape[1]]
+        x = minx + (cols.ravel() + 0.5) * self.cell_size
+        y = miny + (rows.ravel() + 0.5) * self.cell_size
+
+        # NDVI on the grid, and the patch global movement heads for
+        if is_ndvi_raster(gdf_ndvi):
+            ndvi = gdf_ndvi.lookup(x, y)
+            cell_x, cell_y, values = gdf_ndvi.cells()
+            target = (cell_x[np.argmax(values)], cell_y[np.argmax(values)])
+        else:
+            patches = PolygonIndex(gdf_ndvi.geometry.tolist()).locate(x, y)
+            values = gdf_ndvi['value'].to_numpy(dtype=float)
+            ndvi = np.where(patches >= 0, values[np.maximum(patches, 0)], np.nan)
+            centroid = gdf_ndvi.geometry.iloc[int(np.argmax(values))].centroid
+            target = (centroid.x, centroid.y)
+        ndvi = np.nan_to_num(ndvi, nan=-1).reshape(self.shape)
+
+        census_x = np.concatenate([gdf.geometry.x.to_numpy(dtype=float) for gdf, _ in animal_data])
+        census_y = np.concatenate([gdf.geometry.y.to_numpy(dtype=float) for gdf, _ in animal_data])
+        counts = np.concatenate([gdf[name].to_numpy(dtype=float) for gdf, name in animal_data])
+        self.total = float(counts.sum())
+
+        features = [np.ones(self.shape), ndvi]
+        features += [fft_smooth(ndvi, (scale, scale), 1) for scale in NDVI_SCALES]
+        features += [self._log_share(census_x, census_y, counts, scale) for scale in CENSUS_SCALES]
+        for fraction in CONTRACTIONS:
+            features.append(self._log_share(census_x + fraction * (target[0] - census_x),
+                                            census_y + fraction * (target[1] - census_y), counts, 1))
+        distance = np.hypot(x - target[0], y - target[1]).reshape(self.shape)
+        extent = self.shape[1] * self.cell_size
+        features += [np.exp(-distance / (scale * extent)) for scale in DISTANCE_SCALES]
+
+        # (cells, features)
+        self.features = np.stack([feature.ravel() for feature in features], axis=1)
+
+    def share(self, x, y, counts, scale=1) -> np.ndarray:
+        """Share of the animals per grid cell, smoothed by a Gaussian of scale grid cells.
+        :param x: Array with x coordinates.
+        :param y: Array with y coordinates.
+        :param counts: Array with animal counts.
+        :param scale: Standard deviation of the smoothing, in grid cells.
+
+        Returns: Array of the grid's shape that sums to one (or zero without animals).
+        """
+        grid = bin_points(x, y, counts, self.bounds, self.cell_size)
+        smoothed = fft_smooth(grid, (scale, scale), 1)
+        total = smoothed.sum()
+        return smoothed / total if total > 0 else smoothed
+
+    def _log_share(self, x, y, counts, scale) -> np.ndarray:
+        """Share per cell relative to an even spread, on a log scale like the emulator target."""
+        return np.log1p(self.share(x, y, counts, scale) * self.n_cells)
+
+    @property
+    def n_cells(self) -> int:
+        """Number of grid cells."""
+        return self.shape[0] * self.shape[1]
+
+
+class DensityEmulator:
+    """Fast surrogate of AnimalModel: the share of the animals per grid cell after a number of steps.
+
+    A ridge regression on the cell features of EmulatorInputs, with weights that are polynomials in
+    the progress of the animals (see progress). The target is log1p(share * cells). Training
+    accumulates the normal equations, so every recorded step of every run adds one sample per cell
+    without keeping them. Prediction for K parameter sets is a single matrix product.
+
+    Movement mode, boundary rule, NDVI dates and movement noise are not inputs: an emulator holds for
+    the one configuration of its training runs, see run_config.
+    """
+
+    def __init__(self, alpha=1.0, config=None):
+        """Create a new emulator.
+        :param alpha: Ridge penalty.
+        :param config: Settings of the runs the emulator is trained on, as from run_config.
+        """
+        self.alpha = alpha
+        self.config = config
+        self.weights = None
+        self._xtx = None
+        self._xty = None
+        self.samples = 0
+
+    def add_sample(self, inputs, mobility_range, steps, share) -> None:
+        """Add a simulated outcome to the training data.
+        :param inputs: EmulatorInputs of the run's NDVI layer and census.
+        :param mobility_range: Mobility range of the run.
+        :param steps: Step of the outcome.
+        :param share: Share of the animals per grid cell at that step, as EmulatorInputs.share.
+        """
+        basis = progress_basis(mobility_range, steps)[0]
+        target = np.log1p(np.asarray(share, dtype=float).ravel() * inputs.n_cells)
+
+        # Rows are kron(cell features, basis); the normal equations factor accordingly
+        features = inputs.features
+        xtx = np.kron(features.T @ features, np.outer(basis, basis))
+        xty = np.kron(features.T @ target, basis)
+        if self._xtx is None:
+            self._xtx, self._xty = xtx, xty
+        else:
+            self._xtx += xtx
+            self._xty += xty
+        self.samples += 1
+
+    def fit(self):
+        """Solve for the weights from the samples added so far.
+
+        Returns: The emulator itself.
+        """
+        if self._xtx is None:
+            raise ValueError("No samples to fit")
+        penalty = self.alpha * np.eye(len(self._xty))
+        # Leave the intercept unpenalized
+        penalty[0, 0] = 0
+        solution = np.linalg.solve(self._xtx + penalty, self._xty)
+        self.weights = solution.reshape(-1, PROGRESS_DEGREE + 1)
+        return self
+
+    def predict(self, inputs, mobility_range, steps) -> np.ndarray:
+        """Predict the share of the animals per grid cell, for many parameter sets at once.
+        :param inputs: EmulatorInputs of the NDVI layer and census.
+        :param mobility_range: Number or array of mobility ranges.
+        :param steps: Number or array of steps, broadcast against mobility_range.
+
+        Returns: (K, height, width) array of shares, each grid summing to one.
+        """
+        if self.weights is None:
+            raise ValueError("Emulator is not fitted")
+        mobility_range, steps = np.broadcast_arrays(np.atleast_1d(mobility_range), np.atleast_1d(steps))
+        basis = progress_basis(mobility_range, steps)
+
+        # (K, cells): one product for all parameter sets
+        target = basis @ (inputs.features @ self.weights).T
+        share = np.maximum(np.expm1(target), 0)
+        total = share.sum(axis=1, keepdims=True)
+        share = np.where(total > 0, share / np.where(total > 0, total, 1), 1 / share.shape[1])
+        return share.reshape(-1, *inputs.shape)
+
+    def predict_density(self, inputs, mobility_range, steps) -> np.ndarray:
+        """Predict the density of the animals, in animals per squared CRS unit.
+
+        Returns: (K, height, width) array, rows along y like DensityGrid.
+        """
+        return self.predict(inputs, mobility_range, steps) * inputs.total / inputs.cell_size ** 2
+
+    def save(self, path) -> None:
+        """Write the fitted weights as JSON.
+        :param path: Location of the file.
+        """
+        with open(path, 'w') as f:
+            json.dump({'alpha': self.alpha, 'config': self.config, 'samples': self.samples,
+                       'weights': self.weights.tolist()}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Read an emulator written by save.
+        :param path: Location of the file.
+
+        Returns: DensityEmulator
+        """
+        with open(path) as f:
+            state = json.load(f)
+        emulator = cls(state['alpha'], state.get('config'))
+        emulator.samples = state['samples']
+        emulator.weights = np.array(state['weights'])
+        return emulator
+
+
+def _inputs_for(params, datasets, bounds, grid_cells, cache) -> EmulatorInputs:
+    """EmulatorInputs of the census and NDVI layer of a batch run, computed once per combination."""
+    key = (params['year'], params['species'], params['cloudmask'])
+    if key not in cache:
+        census = datasets[('census', params['year'])]
+        animal_data = [(census[name], name) for name in params['species'].split('+')]
+        cache[key] = EmulatorInputs(datasets[('ndvi', params['cloudmask'])], animal_data, bounds, grid_cells)
+    return cache[key]
+
+
+def train_emulator(results, datasets, bounds, grid_cells=EMULATOR_GRID_CELLS, alpha=1.0) -> tuple:
+    """Train an emulator on the recorded trajectories of batch runs.
+    :param results: DataFrame from batch.sweep with record_dir set, one row per run with its record_path.
+    :param datasets: Datasets from batch.load_datasets the runs used.
+    :param bounds: (minx, miny, maxx, maxy) of the survey area.
+    :param grid_cells: Grid cells along the longer side of the survey area.
+    :param alpha: Ridge penalty.
+
+    Returns: (emulator, inputs): Fitted DensityEmulator and dictionary of EmulatorInputs per
+             (year, species, cloudmask).
+    """
+
+    # The emulator does not take these settings as input, so all runs must share them
+    configs = [run_config(params) for params in results.to_dict('records')]
+    mixed = [name for name in EMULATOR_CONFIG if len({config[name] for config in configs}) > 1]
+    if mixed:
+        raise ValueError(f"Runs differ in {', '.join(mixed)}; train an emulator per configuration")
+
+    emulator = DensityEmulator(alpha, configs[0] if configs else run_config({}))
+    inputs = {}
+    for params in results.to_dict('records'):
+        run_inputs = _inputs_for(params, datasets, bounds, grid_cells, inputs)
+        # With the segments of resumed runs
+        table = read_trajectories(params['record_path'], columns=['step', 'x', 'y', 'animal_count'])
+        steps = table.column('step').to_numpy()
+        x, y = table.column('x').to_numpy(), table.column('y').to_numpy()
+        counts = table.column('animal_count').to_numpy().astype(float)
+
+        # One sample per recorded step; rows are written in step order
+        changes = np.flatnonzero(np.diff(steps, prepend=-1, append=-1))
+        for start, stop in zip(changes[:-1], changes[1:]):
+            share = run_inputs.share(x[start:stop], y[start:stop], counts[start:stop])
+            emulator.add_sample(run_inputs, params['mobility_range'], steps[start], share)
+
+    print(f"Emulator trained on {emulator.samples} samples from {len(results)} runs")
+    return emulator.fit(), inputs
+
+
+def validate_emulator(emulator, inputs, param_sets, steps, datasets, hotspot_fraction=0.05) -> pd.DataFrame:
+    """Compare the emulator with fresh simulations.
+    :param emulator: Fitted DensityEmulator.
+    :param inputs: Dictionary of EmulatorInputs per (year, species, cloudmask), as from train_emulator.
+    :param param_sets: Sequence of batch run parameters (year, species, cloudmask, mobility_range,
+                       replicate and optionally engine). Settings of run_config default to the ones
+                       the emulator was trained for, and must match them.
+    :param steps: Number of steps to simulate and predict.
+    :param datasets: Datasets from batch.load_datasets.
+    :param hotspot_fraction: Share of the grid cells that counts as hotspot.
+
+    Returns: DataFrame with one row per parameter set: error of the shares, misplaced share of the animals,
+             correlation, overlap of the hotspot cells, and the time of the simulation and the prediction.
+    """
+
+    # Import here, the emulator itself does not need the model
+    from model import AnimalModel, get_survey_polygon
+
+    rows = []
+    for params in param_sets:
+        key = (params['year'], params['species'], params['cloudmask'])
+        run_inputs = inputs[key]
+        params = dict(emulator.config or {}, **params)
+        config = run_config(params)
+        if emulator.config is not None and config != emulator.config:
+            raise ValueError(f"Emulator was trained for {emulator.config}, not for {config}")
+
+        start = time.perf_counter()
+        predicted = emulator.predict(run_inputs, params['mobility_range'], steps)[0].ravel()
+        predict_time = time.perf_counter() - start
+
+        census = datasets[('census', params['year'])]
+        gdf_ndvi = datasets[('ndvi', params['cloudmask'])]
+        ndvi_series = None
+        if config['ndvi_interval']:
+            from sentinel import get_ndvi_series
+            ndvi_series = get_ndvi_series(params['cloudmask'], get_survey_polygon())
+        start = time.perf_counter()
+        model = AnimalModel([(census[name], name) for name in params['species'].split('+')], gdf_ndvi,
+                            None, gdf_ndvi['value'], engine=params.get('engine', 'array'),
+                            movement=config['movement'], boundary=config['boundary'],
+                            mobility_range=params['mobility_range'], movement_noise=config['movement_noise'],
+                            seed=params['replicate'], ndvi_series=ndvi_series,
+                            ndvi_interval=config['ndvi_interval'] or 10, profile=False)
+        for _ in range(steps):
+            model.step()
+        simulate_time = time.perf_counter() - start
+        if ndvi_series is not None:
+            ndvi_series.close()
+        simulated = run_inputs.share(*model.animal_positions()).ravel()
+
+        # Cells holding the largest shares, in both outcomes
+        k = max(int(hotspot_fraction * len(simulated)), 1)
+        hotspots = np.argpartition(simulated, -k)[-k:]
+        predicted_hotspots = np.argpartition(predicted, -k)[-k:]
+
+        rows.append(dict(params,
+                         steps=steps,
+                         share_rmse=float(np.sqrt(np.mean((predicted - simulated) ** 2))),
+                         # Share of the animals put in other cells than the simulation
+                         misplaced_share=float(0.5 * np.abs(predicted - simulated).sum()),
+                         correlation=float(np.corrcoef(predicted, simulated)[0, 1]),
+                         hotspot_overlap=len(np.intersect1d(hotspots, predicted_hotspots)) / k,
+                         simulate_seconds=simulate_time,
+                         predict_seconds=predict_time))
+
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    from batch import load_datasets
+    from model import get_survey_polygon
+
+    parser = argparse.ArgumentParser(description="Train a density emulator on recorded batch runs and validate it.")
+    parser.add_argument('results', help="CSV with batch results of runs recorded with --record.")
+    parser.add_argument('--output', default='emulator.json', help="File to write the emulator to.")
+    parser.add_argument('--grid-cells', type=int, default=EMULATOR_GRID_CELLS,
+                        help="Grid cells along the longer side of the survey area.")
+    parser.add_argument('--alpha', type=float, default=1.0, help="Ridge penalty.")
+    parser.add_argument('--validate', type=float, nargs='*', default=[],
+                        help="Mobility ranges to validate against fresh simulations.")
+    parser.add_argument('--steps', type=int, default=100, help="Steps of the validation runs.")
+    args = parser.parse_args()
+
+    results = pd.read_csv(args.results)
+    results = results[results['record_path'].notna()]
+    datasets = load_datasets(sorted(results['year'].unique()), sorted(results['cloudmask'].unique()))
+    emulator, inputs = train_emulator(results, datasets, get_survey_polygon().bounds, args.grid_cells, args.alpha)
+    emulator.save(args.output)
+    print(f"Emulator written to {args.output}")
+
+    if args.validate:
+        run = results.iloc[0]
+        param_sets = [dict(year=run['year'], species=run['species'], cloudmask=run['cloudmask'],
+                           mobility_range=mobility_range, replicate=0) for mobility_range in args.validate]
+        print(validate_emulator(emulator, inputs, param_sets, args.steps, datasets).to_string())
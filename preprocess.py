@@ -4,13 +4,14 @@ Use this file to preprocess data.
 
 """
 from typing import Tuple
-import fiona
-from fiona.crs import from_epsg
+from functools import lru_cache
+import json
 from shapely.geometry import mapping, Polygon
 import numpy as np
 import geopandas as gp
 import os
 import pandas as pd
+import pyarrow as pa
 pd.options.display.width = 0
 
 # Data locations
@@ -18,37 +19,242 @@ census_path = r'./data/census/'
 flight_path = r'./data/tracks/'
 poly_path = r'./data/geometries/'
 block_path = r'./data/blocks/'
+cache_path = r'./data/cache/'
 
-# Read data
-gdf_2008 = gp.read_file(os.path.join(
-    census_path, 'census_data_2008.shp'))
-gdf_2017 = gp.read_file(os.path.join(
-    census_path, 'census_data_2017.shp'))
+# Census years and species in the census store
+CENSUS_YEARS = (2008, 2017)
+CENSUS_SPECIES = ('EL', 'BF')
+
+# Bump when the layout of the census store changes
+CENSUS_STORE_VERSION = 2
+
+# Census observations of all years and species in long format, sorted by (year, species)
+CENSUS_SCHEMA = pa.schema([('year', pa.int16()),
+                           ('species', pa.dictionary(pa.int8(), pa.string())),
+                           ('row', pa.int32()),
+                           ('count', pa.float64()),
+                           ('x', pa.float64()),
+                           ('y', pa.float64())])
+
+
+@lru_cache(maxsize=None)
+def read_census_data(year) -> gp.GeoDataFrame:
+    """Read the census shapefile of a year, once per process.
+    :param year: Census year, 2008 or 2017.
+
+    Returns: gdf: Raw census GeoDataFrame. Shared between callers, do not modify in place.
+    """
+
+    return gp.read_file(os.path.join(
+        census_path, f'census_data_{year}.shp'))
+
+
+def _census_rows(gdf, year, species) -> Tuple[np.ndarray, np.ndarray]:
+    """Select the observations of one species from a raw census GeoDataFrame.
+    :param gdf: Raw census GeoDataFrame of the year.
+    :param year: Census year, 2008 or 2017.
+    :param species: Species code, 'EL' or 'BF'.
+
+    Returns: (rows, counts): Positions of the observations in the census, and their animal counts.
+    """
+
+    if year == 2008:
+        # One column of counts per species
+        counts = gdf[species].to_numpy(dtype=float)
+        keep = counts > 0
+    else:
+        # One row per observation, with the species and its estimated count
+        counts = gdf['Estimate'].to_numpy(dtype=float)
+        keep = (gdf['Species'] == species).to_numpy() & (counts > 0)
+        if species == 'EL':
+            # Remove outlier point in the middle of the sea
+            keep &= gdf['X'].to_numpy(dtype=float) > 0
+
+    rows = np.flatnonzero(keep)
+    return rows, counts[rows]
+
+
+class CensusStore:
+    """Census observations of all years and species, in one long-format columnar table.
+
+    Rows are sorted by (year, species), so each combination is a contiguous partition that is found
+    by a dictionary lookup. Partitions are returned as views on the columns, without copying. Each
+    partition keeps the coordinates and CRS of its census shapefile, so years need not share a CRS. The
+    table is built once from the census shapefiles and kept as an Arrow IPC file, which is memory
+    mapped when loaded again.
+    """
+
+    def __init__(self, table):
+        """Create a new census store.
+        :param table: pa.Table with CENSUS_SCHEMA, sorted by (year, species), with the partitions and their
+                      CRS in its metadata.
+        """
+        self.table = table
+
+        # Zero-copy NumPy views, the table is a single chunk without nulls
+        self.columns = {name: table.column(name).chunk(0).to_numpy(zero_copy_only=True)
+                        for name in ('year', 'row', 'count', 'x', 'y')}
+        species = table.column('species').chunk(0)
+        self.columns['species'] = species.indices.to_numpy(zero_copy_only=True)
+        self.species_names = species.dictionary.to_pylist()
+
+        self.partitions = {}
+        self.partition_crs = {}
+        for year, species, start, stop, crs in json.loads(table.schema.metadata[b'partitions']):
+            self.partitions[(year, species)] = slice(start, stop)
+            self.partition_crs[(year, species)] = crs
+        self.years = tuple(sorted({year for year, _ in self.partitions}))
+
+    @classmethod
+    def build(cls, years=CENSUS_YEARS, species=CENSUS_SPECIES):
+        """Build the store from the census shapefiles.
+        :param years: Census years to include.
+        :param species: Species to include.
+
+        Returns: CensusStore
+        """
+        if not years or not species:
+            raise ValueError("The census store needs at least one census year and one species")
+
+        arrays = {name: [] for name in ('year', 'species', 'row', 'count', 'x', 'y')}
+        partitions = []
+        start = 0
+        for year in years:
+            gdf = read_census_data(year)
+            crs = gdf.crs.to_string()
+            x = gdf.geometry.x.to_numpy()
+            y = gdf.geometry.y.to_numpy()
+            for code, name in enumerate(species):
+                rows, counts = _census_rows(gdf, year, name)
+                arrays['year'].append(np.full(len(rows), year, dtype=np.int16))
+                arrays['species'].append(np.full(len(rows), code, dtype=np.int8))
+                arrays['row'].append(rows.astype(np.int32))
+                arrays['count'].append(counts)
+                arrays['x'].append(x[rows])
+                arrays['y'].append(y[rows])
+                partitions.append((year, name, start, start + len(rows), crs))
+                start += len(rows)
+
+        arrays = {name: np.concatenate(parts) for name, parts in arrays.items()}
+        table = pa.Table.from_arrays(
+            [pa.array(arrays['year']),
+             pa.DictionaryArray.from_arrays(pa.array(arrays['species']), pa.array(list(species))),
+             pa.array(arrays['row']),
+             pa.array(arrays['count']),
+             pa.array(arrays['x']),
+             pa.array(arrays['y'])],
+            schema=CENSUS_SCHEMA)
+        metadata = {'version': str(CENSUS_STORE_VERSION), 'partitions': json.dumps(partitions)}
+        return cls(table.replace_schema_metadata(metadata))
+
+    @classmethod
+    def load(cls, path):
+        """Load a store written by save, memory mapped.
+        :param path: Location of the store file.
+
+        Returns: CensusStore, or None if the file has another version.
+        """
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        if table.schema.metadata.get(b'version') != str(CENSUS_STORE_VERSION).encode():
+            return None
+        # One chunk, so all columns can be viewed as NumPy arrays
+        return cls(table.combine_chunks())
+
+    def save(self, path) -> None:
+        """Write the store as an uncompressed Arrow IPC file, which can be memory mapped.
+        :param path: Location of the store file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_file, 'wb') as sink:
+            with pa.ipc.new_file(sink, self.table.schema) as writer:
+                writer.write_table(self.table)
+        os.replace(tmp_file, path)
+
+    def partition(self, year, species) -> dict:
+        """Observations of one species in one census year.
+        :param year: Census year, 2008 or 2017.
+        :param species: Species code, 'EL' or 'BF'.
+
+        Returns: Dictionary with read-only views 'row' (position in the census shapefile), 'count', 'x'
+                 and 'y'.
+        """
+        part = self.partitions[(year, species)]
+        return {name: self.columns[name][part] for name in ('row', 'count', 'x', 'y')}
+
+    def frame(self, year, species) -> gp.GeoDataFrame:
+        """Observations of one species in one census year as GeoDataFrame, the input of AnimalModel.
+        :param year: Census year, 2008 or 2017.
+        :param species: Species code, 'EL' or 'BF'.
+
+        Returns: gdf: GeoDataFrame with the counts in a column named after the species, and point
+                 geometries in the CRS of the census shapefile; indexed by position in the census shapefile.
+        """
+        part = self.partition(year, species)
+        return gp.GeoDataFrame({species: part['count']}, index=pd.Index(part['row']),
+                               geometry=gp.points_from_xy(part['x'], part['y']),
+                               crs=self.partition_crs[(year, species)])
+
+
+@lru_cache(maxsize=None)
+def get_census_store() -> CensusStore:
+    """Census store of all years and species, built from the shapefiles the first time it is needed.
+    The store file is rebuilt when a census shapefile is newer. Shared within the process.
+
+    Returns: CensusStore
+    """
+
+    store_file = os.path.join(cache_path, 'census_store.arrow')
+    # Only the years whose census is present
+    sources = {year: os.path.join(census_path, f'census_data_{year}.shp') for year in CENSUS_YEARS}
+    years = tuple(year for year, src in sources.items() if os.path.exists(src))
+    if not years:
+        raise FileNotFoundError(f"No census shapefiles census_data_<year>.shp of {CENSUS_YEARS} in {census_path}")
+    if os.path.exists(store_file) and all(
+            os.path.getmtime(store_file) > os.path.getmtime(sources[year]) for year in years):
+        store = CensusStore.load(store_file)
+        if store is not None and store.years == years:
+            return store
+
+    store = CensusStore.build(years)
+    store.save(store_file)
+    # Views on the written file, rather than on the arrays it was built from
+    return CensusStore.load(store_file)
 
 
 def get_2008_population_data() -> Tuple[Tuple[gp.GeoDataFrame, str], Tuple[gp.GeoDataFrame, str]]:
     """Processes and returns 2008 population data.
     Tuple including data from elephants and buffalos. Each animal is a Tuple of (gdf, name).
+    The data is processed once per process; every call returns copies, which may be modified.
 
     Returns: Tuple of Tuples with population data."""
 
-    gdf = gdf_2008
+    return tuple((gdf.copy(), name) for gdf, name in _process_2008_population_data())
 
-    # Get elephants & buffalos only, remove rows with no animal observations
-    gdf_el = gdf.drop(gdf.iloc[:, np.r_[12:27, 28:63]], axis=1)
-    gdf_el = gdf_el[gdf_el['EL'] > 0]
-    gdf_el.reset_index(drop=True, inplace=True)
-    el_counts = gdf_el['EL'].tolist()
 
-    gdf_bf = gdf.drop(gdf.iloc[:, np.r_[12:14, 15:63]], axis=1)
-    gdf_bf = gdf_bf[gdf_bf['BF'] > 0]
-    bf_counts = gdf_bf['BF'].tolist()
+@lru_cache(maxsize=None)
+def _process_2008_population_data() -> Tuple[Tuple[gp.GeoDataFrame, str], Tuple[gp.GeoDataFrame, str]]:
+    """2008 population data, shared within the process."""
+
+    store = get_census_store()
+    gdf_el = store.frame(2008, 'EL')
+    # Elephants were numbered anew, buffalos keep their census row
+    gdf_el.reset_index(drop=True, inplace=True)
+    gdf_bf = store.frame(2008, 'BF')
 
     return (gdf_el, 'EL'), (gdf_bf, 'BF')
 
 
 def get_track_data() -> gp.GeoDataFrame:
-    """Processes and returns flight track data."""
+    """Processes and returns flight track data. Computed once per process, every call returns a copy."""
+
+    return _process_track_data().copy()
+
+
+@lru_cache(maxsize=None)
+def _process_track_data() -> gp.GeoDataFrame:
+    """Flight track data, shared within the process."""
 
     # Get aerial tracks
     tracksdf = gp.read_file(os.path.join(
@@ -63,7 +269,14 @@ def get_track_data() -> gp.GeoDataFrame:
 
 
 def get_block_data() -> gp.GeoDataFrame:
-    """Processes and returns block data."""
+    """Processes and returns block data. Computed once per process, every call returns a copy."""
+
+    return _process_block_data().copy()
+
+
+@lru_cache(maxsize=None)
+def _process_block_data() -> gp.GeoDataFrame:
+    """Block data, shared within the process."""
 
     # Get block data
     blocksdf = gp.read_file(os.path.join(
@@ -76,30 +289,25 @@ def get_block_data() -> gp.GeoDataFrame:
 
 
 def get_2017_population_data() -> Tuple[Tuple[gp.GeoDataFrame, str], Tuple[gp.GeoDataFrame, str]]:
-    """Processes and returns 2008 population data: Tuple of (gdf, name)
+    """Processes and returns 2017 population data: Tuple of (gdf, name)
+    The data is processed once per process; every call returns copies, which may be modified.
 
     Returns: Tuple of Tuples with population data."""
 
-    gdf = gdf_2017
+    return tuple((gdf.copy(), name) for gdf, name in _process_2017_population_data())
 
-    # Get elephants & buffalos only, remove rows with no elephants or buffalos
-    gdf_el = gdf.loc[gdf['Species'] == 'EL']
-    gdf_el['EL'] = gdf_el['Estimate']
-    gdf_el = gdf_el[gdf_el['EL'] > 0]
-    # Remove outlier point in the middle of the sea
-    gdf_el = gdf_el[gdf_el['X'] > 0]
 
-    gdf_bf = gdf.loc[gdf['Species'] == 'BF']
-    gdf_bf['BF'] = gdf_bf['Estimate']
-    gdf_bf = gdf_bf[gdf_bf['BF'] > 0]
+@lru_cache(maxsize=None)
+def _process_2017_population_data() -> Tuple[Tuple[gp.GeoDataFrame, str], Tuple[gp.GeoDataFrame, str]]:
+    """2017 population data, shared within the process."""
 
-    # Make new indicies
-    el_index = pd.Index(['Obs' + str(idx) for idx in range(len(gdf_el))])
-    bf_index = pd.Index(['Obs' + str(idx) for idx in range(len(gdf_bf))])
+    store = get_census_store()
+    gdf_el = store.frame(2017, 'EL')
+    gdf_bf = store.frame(2017, 'BF')
 
-    # Set new indices
-    gdf_el.set_index(el_index, inplace=True)
-    gdf_bf.set_index(bf_index, inplace=True)
+    # Number the observations of each species
+    gdf_el.index = pd.Index(np.char.add('Obs', np.arange(len(gdf_el)).astype(str)).astype(object))
+    gdf_bf.index = pd.Index(np.char.add('Obs', np.arange(len(gdf_bf)).astype(str)).astype(object))
 
     print("Animal data loaded!")
 
@@ -125,7 +333,9 @@ def get_aoi() -> None:
 
     schema = {'geometry': 'Polygon'}
 
-    # Write a new Shapefile
+    # Write a new Shapefile; import here, as only this function needs fiona
+    import fiona
+    from fiona.crs import from_epsg
     with fiona.open(os.path.join(poly_path, 'Census2017Polygon-filled.shp'), 'w',
                     crs=from_epsg(4326), driver='ESRI Shapefile', schema=schema) as c:
         c.write({
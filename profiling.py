@@ -0,0 +1,138 @@
+"""
+
+Use this file to profile where the model spends its time.
+
+"""
+import cProfile
+import os
+import time
+from contextlib import nullcontext
+import pandas as pd
+
+# Environment variables that switch on profiling without code changes
+PROFILE_ENV = 'ANIMALMODEL_PROFILE'
+PROFILE_DUMP_ENV = 'ANIMALMODEL_PROFILE_DUMP'
+PROFILE_EVERY_ENV = 'ANIMALMODEL_PROFILE_EVERY'
+
+# Shared no-op section, used when profiling is off
+_NULL_SECTION = nullcontext()
+
+
+def null_section(name):
+    """Section that measures nothing, for models without a profiler."""
+    return _NULL_SECTION
+
+
+class _Section:
+    """Context manager timing one section of a step."""
+
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit()
+
+
+class StepProfiler:
+    """Accumulate wall time per section of each model step.
+
+    Times are exclusive: while a nested section runs, its parent's clock is paused. So the sections of
+    a step add up to the step's wall time, and time not inside any named section counts as 'other'.
+    """
+
+    def __init__(self, dump_path=None, report_every=None):
+        """Create a new step profiler.
+        :param dump_path: Optional file to write cProfile stats of all profiled steps to.
+        :param report_every: Print the summary table every report_every steps, None to never print.
+        """
+        self.dump_path = dump_path
+        self.report_every = report_every
+        self.totals = {}
+        self.steps = 0
+        self._stack = []
+        self._since = None
+        self._cprofile = cProfile.Profile() if dump_path else None
+
+    @classmethod
+    def from_env(cls):
+        """Create a profiler if ANIMALMODEL_PROFILE is set, else return None."""
+        if os.environ.get(PROFILE_ENV, '0') in ('', '0'):
+            return None
+        report_every = os.environ.get(PROFILE_EVERY_ENV)
+        return cls(dump_path=os.environ.get(PROFILE_DUMP_ENV),
+                   report_every=int(report_every) if report_every else None)
+
+    def section(self, name) -> _Section:
+        """Time the enclosed code as section name."""
+        return _Section(self, name)
+
+    def _charge(self, now) -> None:
+        if self._stack:
+            name = self._stack[-1]
+            self.totals[name] = self.totals.get(name, 0.0) + now - self._since
+        self._since = now
+
+    def _enter(self, name) -> None:
+        self._charge(time.perf_counter())
+        self._stack.append(name)
+
+    def _exit(self) -> None:
+        self._charge(time.perf_counter())
+        self._stack.pop()
+
+    def step(self):
+        """Time a whole model step; time outside named sections is counted as 'other'."""
+        return _StepContext(self)
+
+    def summary(self) -> pd.DataFrame:
+        """Summarize time per section.
+
+        Returns: DataFrame with total seconds, milliseconds per step and share of step time per section.
+        """
+        total = sum(self.totals.values())
+        rows = [{"section": name,
+                 "total_s": seconds,
+                 "ms_per_step": 1000 * seconds / max(self.steps, 1),
+                 "share": seconds / total if total else 0.0}
+                for name, seconds in sorted(self.totals.items(), key=lambda item: -item[1])]
+        return pd.DataFrame(rows, columns=["section", "total_s", "ms_per_step", "share"])
+
+    def report(self) -> pd.DataFrame:
+        """Print the summary table, and write the cProfile dump if requested."""
+        summary = self.summary()
+        print(f"Profile of {self.steps} steps:")
+        print(summary.to_string(index=False))
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(self.dump_path)
+            print(f"cProfile stats written to {self.dump_path}")
+        return summary
+
+
+class _StepContext:
+    """Context manager around a full model step."""
+
+    __slots__ = ('profiler',)
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler._cprofile is not None:
+            profiler._cprofile.enable()
+        profiler._enter('other')
+
+    def __exit__(self, *exc_info):
+        profiler = self.profiler
+        profiler._exit()
+        if profiler._cprofile is not None:
+            profiler._cprofile.disable()
+        profiler.steps += 1
+        if profiler.report_every and profiler.steps % profiler.report_every == 0:
+            profiler.report()
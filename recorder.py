@@ -0,0 +1,212 @@
+"""
+
+Use this file to record model state to disk while the model runs.
+
+"""
+import os
+import queue
+import re
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from density import model_density
+
+# Schemas of the recorded tables
+TRAJECTORY_SCHEMA = pa.schema([('step', pa.int32()),
+                               ('animal', pa.int32()),
+                               ('x', pa.float64()),
+                               ('y', pa.float64()),
+                               ('animal_count', pa.float32()),
+                               ('ndvi', pa.float32()),
+                               ('species', pa.dictionary(pa.int8(), pa.string()))])
+STATS_SCHEMA = pa.schema([('step', pa.int32()),
+                          ('animals', pa.int32()),
+                          ('total_count', pa.float64()),
+                          ('mean_x', pa.float64()),
+                          ('mean_y', pa.float64()),
+                          ('mean_ndvi', pa.float64()),
+                          ('peak_density', pa.float64()),
+                          ('core_area', pa.float64())])
+
+
+def segment_path(path, step) -> str:
+    """File a run resumed at step records into, named after that step, e.g. run.step100.parquet.
+    :param path: Record path of the run.
+    :param step: Step the run starts at; 0 records into path itself.
+    """
+    if step == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.step{step}{ext}'
+
+
+def read_trajectories(path, columns=None) -> pa.Table:
+    """Read the trajectories of a run, together with the segments it recorded after being resumed.
+    An interrupted run may have recorded past its last checkpoint; those steps are taken from the
+    segment that resumed there.
+    :param path: Record path of the run, an Arrow IPC or Parquet file.
+    :param columns: Columns to read, defaults to all; 'step' is always read.
+
+    Returns: pa.Table with the rows of all segments, in step order.
+    """
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'\.step(\d+)' + re.escape(ext) + '$')
+    starts = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(os.path.dirname(path) or '.'))
+                    if match)
+    columns = None if columns is None else ['step'] + [name for name in columns if name != 'step']
+
+    tables = []
+    for start, stop in zip([0] + starts, starts + [None]):
+        segment = segment_path(path, start)
+        if segment.endswith('.arrow'):
+            with pa.memory_map(segment, 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+            table = table if columns is None else table.select(columns)
+        else:
+            table = pq.read_table(segment, columns=columns)
+        if stop is not None:
+            table = table.filter(np.asarray(table.column('step')) < stop)
+        tables.append(table)
+    return pa.concat_tables(tables)
+
+
+class _ChunkedWriter:
+    """Buffer record batches and write them as chunks of about chunk_size rows."""
+
+    def __init__(self, path, schema, chunk_size):
+        self.path = path
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self._batches = []
+        self._rows = 0
+        if path.endswith('.arrow'):
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, schema)
+        else:
+            self._sink = None
+            self._writer = pq.ParquetWriter(path, schema)
+
+    def add(self, batch) -> None:
+        self._batches.append(batch)
+        self._rows += batch.num_rows
+        if self._rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._batches:
+            return
+        self._writer.write_table(pa.Table.from_batches(self._batches, schema=self.schema))
+        self._batches = []
+        self._rows = 0
+
+    def close(self) -> None:
+        self.flush()
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+
+
+class TrajectoryRecorder:
+    """Stream per-step animal positions, counts, NDVI and species to a columnar file.
+
+    collect() copies the current state into Arrow arrays and hands them to a background thread,
+    which writes them in chunks to Parquet (or Arrow IPC, for paths ending in '.arrow').
+    The queue is bounded, so memory use stays flat however many steps are recorded.
+    """
+
+    def __init__(self, path, interval=1, stats_path=None, chunk_size=500000, queue_size=16,
+                 density_bandwidth=None):
+        """Create a new recorder.
+        :param path: File to write animal trajectories to.
+        :param interval: Record every interval-th step.
+        :param stats_path: Optional file to write per-step aggregate statistics to.
+        :param chunk_size: Number of rows per written chunk (Parquet row group).
+        :param queue_size: Number of collected steps that may wait for the writer.
+        :param density_bandwidth: Kernel standard deviation of the animal density, whose peak and core
+                                  area (holding half the animals) are added to the statistics. None
+                                  leaves them empty.
+        """
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
+
+        self.interval = interval
+        self.density_bandwidth = density_bandwidth
+        self._writers = {'trajectory': _ChunkedWriter(path, TRAJECTORY_SCHEMA, chunk_size)}
+        if stats_path is not None:
+            self._writers['stats'] = _ChunkedWriter(stats_path, STATS_SCHEMA, chunk_size)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                for name, batch in item:
+                    self._writers[name].add(batch)
+            except Exception as error:
+                self._error = error
+
+    def collect(self, model) -> None:
+        """Record the current state of a model, if its step is on the sampling interval.
+        :param model: AnimalModel to record.
+        """
+        if model.steps % self.interval:
+            return
+        if self._error is not None:
+            raise RuntimeError("Trajectory writer failed") from self._error
+
+        x, y, counts = model.animal_positions()
+        ndvi = model.animal_ndvi_values()
+        n = len(x)
+
+        item = [('trajectory', pa.RecordBatch.from_arrays(
+            [pa.array(np.full(n, model.steps, dtype=np.int32)),
+             pa.array(np.arange(n, dtype=np.int32)),
+             pa.array(np.array(x, dtype=np.float64)),
+             pa.array(np.array(y, dtype=np.float64)),
+             pa.array(np.asarray(counts, dtype=np.float32)),
+             pa.array(np.asarray(ndvi, dtype=np.float32)),
+             pa.DictionaryArray.from_arrays(pa.array(model.animal_species), pa.array(model.species))],
+            schema=TRAJECTORY_SCHEMA))]
+
+        if 'stats' in self._writers:
+            total = counts.sum()
+            weights = counts if total > 0 else None
+            density = {}
+            if self.density_bandwidth is not None:
+                density = model_density(model, bandwidth=self.density_bandwidth).summary()
+            item.append(('stats', pa.RecordBatch.from_pylist(
+                [{'step': model.steps,
+                  'animals': n,
+                  'total_count': float(total),
+                  'mean_x': float(np.average(x, weights=weights)) if n else np.nan,
+                  'mean_y': float(np.average(y, weights=weights)) if n else np.nan,
+                  'mean_ndvi': float(np.mean(ndvi)) if n else np.nan,
+                  'peak_density': density.get('peak_density'),
+                  'core_area': density.get('core_area')}],
+                schema=STATS_SCHEMA)))
+
+        self._queue.put(item)
+
+    def close(self) -> None:
+        """Write all remaining data and close the files."""
+        self._queue.put(None)
+        self._thread.join()
+        for writer in self._writers.values():
+            writer.close()
+        if self._error is not None:
+            raise RuntimeError("Trajectory writer failed") from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
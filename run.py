@@ -1,5 +1,10 @@
+# Environment variables of the server, all off by default:
+# ANIMALMODEL_PROFILE=1 times every model step per section (see profiling.py).
+# ANIMALMODEL_PROFILE_EVERY=10 also prints the summary of the sections every 10 steps.
+# ANIMALMODEL_PROFILE_DUMP=path also writes cProfile stats of the profiled steps to path.
+# ANIMALMODEL_SESSIONS=1 gives every browser session its own model (see session.py).
+
 from server import server
-import profile
 
 # Run server
-profile.run(server.launch())
+server.launch()
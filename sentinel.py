@@ -4,16 +4,36 @@ Use this file to process and configure Sentinel-2 data.
 
 """
 import affine
+import hashlib
+import itertools
+import math
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import pyarrow as pa
 import xarray as xr
 import shapely.geometry as sg
+import shapely.ops
+from shapely.prepared import prep
 import rasterio
 import rasterio.features
+import rasterio.windows
 import geopandas as gp
 import pandas as pd
 import pickle
+from spatial import points_within
 pd.options.display.width = 0
 pd.set_option('display.max_colwidth', None)
 
+# Cache locations
+cache_path = r'./data/cache/'
+legacy_pickle = r'./data/pickled/gdf_ndvi.p'
+# Bump when the polygonization changes, to invalidate existing caches
+NDVI_CACHE_VERSION = 2
+# Width and height of the tiles polygonized in parallel, in pixels
+TILE_SIZE = 512
+
 
 def polygonize(da: xr.DataArray) -> gp.GeoDataFrame:
     """
@@ -47,6 +67,484 @@ def polygonize(da: xr.DataArray) -> gp.GeoDataFrame:
     return gdf
 
 
+def _raster_xy(cols, rows, transform):
+    """Convert pixel coordinates into geometry (lat, lon) coordinates, see polygonize."""
+    raster_x = transform.c + cols * transform.a + rows * transform.b
+    raster_y = transform.f + cols * transform.d + rows * transform.e
+    # Swap x,y coordinates to get lat, lon
+    return np.column_stack([raster_y, raster_x])
+
+
+def _survey_pixels(survey_area, transform, row_off, col_off, shape):
+    """Classify raster pixels by the survey area, conservatively.
+    :param survey_area: Shapely Polygon of survey area, in raster (x, y) order.
+    :param transform: Affine transform of the full raster.
+    :param row_off: Row of the first pixel.
+    :param col_off: Column of the first pixel.
+    :param shape: (height, width) of the pixels to classify.
+
+    Returns: (inside, outside): Summed-area tables of pixels that lie fully inside and fully outside.
+    """
+
+    pixel_transform = transform * affine.Affine.translation(col_off, row_off)
+    center_inside = rasterio.features.rasterize([survey_area], out_shape=shape, transform=pixel_transform,
+                                                fill=0, default_value=1, dtype='uint8').astype(bool)
+    edge = rasterio.features.rasterize([survey_area.boundary], out_shape=shape, transform=pixel_transform,
+                                       fill=0, default_value=1, all_touched=True, dtype='uint8').astype(bool)
+
+    # Grow the edge by one pixel, for boundaries running exactly along pixel borders
+    grown = edge.copy()
+    grown[1:, :] |= edge[:-1, :]
+    grown[:-1, :] |= edge[1:, :]
+    grown[:, 1:] |= edge[:, :-1]
+    grown[:, :-1] |= edge[:, 1:]
+
+    tables = []
+    for mask in (center_inside & ~grown, ~center_inside & ~grown):
+        table = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int64)
+        table[1:, 1:] = mask.cumsum(0).cumsum(1)
+        tables.append(table)
+    return tuple(tables)
+
+
+def _box_count(table, row_start, row_stop, col_start, col_stop):
+    """Count the pixels of a summed-area table in many boxes at once."""
+    return (table[row_stop, col_stop] - table[row_start, col_stop]
+            - table[row_stop, col_start] + table[row_start, col_start])
+
+
+def _polygonize_tile(values, row_off, col_off, seams, transform, survey_area, raster_survey_area):
+    """Polygonize one tile of a raster. Used as process pool task.
+    :param values: 2D array with the tile's raster data.
+    :param row_off: Row of the tile's first pixel in the full raster.
+    :param col_off: Column of the tile's first pixel in the full raster.
+    :param seams: (top, bottom, left, right) flags of tile sides that border another tile.
+    :param transform: Affine transform of the full raster.
+    :param survey_area: Shapely Polygon of survey area, or None to keep all patches.
+    :param raster_survey_area: The survey area in raster (x, y) order.
+
+    Returns: (first_pixels, patch_values, coords, sizes, seam_patches): (row, col) of the top-left pixel,
+             value, concatenated ring coordinates and ring length of the patches within the survey area,
+             and a list of (value, pixel Polygon) of patches that touch a seam and may continue in the
+             next tile. Plain arrays are much cheaper to send back to the parent process than Polygons.
+    """
+
+    height, width = values.shape
+
+    # Pixel coordinates, so seams and scanline order are exact
+    rings, patch_values = [], []
+    for geom, value in rasterio.features.shapes(values, transform=affine.Affine.translation(col_off, row_off)):
+        rings.append(geom['coordinates'][0])
+        patch_values.append(value)
+    patch_values = np.array(patch_values, dtype=float)
+
+    # Bounds and top-left pixel of all rings at once
+    sizes = np.array([len(ring) for ring in rings], dtype=np.int64)
+    starts = np.cumsum(sizes) - sizes
+    cols, rows = np.array(list(itertools.chain.from_iterable(rings)), dtype=float).reshape(-1, 2).T
+    min_row, max_row = np.minimum.reduceat(rows, starts), np.maximum.reduceat(rows, starts)
+    min_col, max_col = np.minimum.reduceat(cols, starts), np.maximum.reduceat(cols, starts)
+    first_col = np.minimum.reduceat(np.where(rows == np.repeat(min_row, sizes), cols, np.inf), starts)
+
+    on_seam = ((seams[0] & (min_row == row_off)) | (seams[1] & (max_row == row_off + height))
+               | (seams[2] & (min_col == col_off)) | (seams[3] & (max_col == col_off + width)))
+    seam_patches = [(patch_values[i], sg.Polygon(list(zip(cols[starts[i]:starts[i] + sizes[i]],
+                                                          rows[starts[i]:starts[i] + sizes[i]]))))
+                    for i in np.flatnonzero(on_seam).tolist()]
+
+    # Patches whose box lies fully inside the survey area are kept and single pixels fully outside it
+    # are dropped; only the patches near its boundary get the exact test
+    keep = ~on_seam
+    undecided = np.zeros(len(rings), dtype=bool)
+    if survey_area is not None:
+        inside, outside = _survey_pixels(raster_survey_area, transform, row_off, col_off, (height, width))
+        box = ((min_row - row_off).astype(np.int64), (max_row - row_off).astype(np.int64),
+               (min_col - col_off).astype(np.int64), (max_col - col_off).astype(np.int64))
+        box_size = (box[1] - box[0]) * (box[3] - box[2])
+        all_inside = _box_count(inside, *box) == box_size
+        # For single pixels the box is the patch, larger patches may only partly cover their box
+        all_outside = (box_size == 1) & (_box_count(outside, *box) == 1)
+        undecided = keep & ~all_inside & ~all_outside
+        keep &= all_inside
+
+    world = _raster_xy(cols, rows, transform)
+    if undecided.any():
+        within = prep(survey_area).contains
+        for i in np.flatnonzero(undecided).tolist():
+            keep[i] = within(sg.Polygon(world[starts[i]:starts[i] + sizes[i]]))
+
+    kept = np.flatnonzero(keep)
+    kept_sizes = sizes[kept]
+    take = np.repeat(starts[kept] - np.cumsum(kept_sizes) + kept_sizes, kept_sizes) + np.arange(kept_sizes.sum())
+    return (np.column_stack([min_row[kept], first_col[kept]]), patch_values[kept], world[take], kept_sizes,
+            seam_patches)
+
+
+def polygonize_tiled(values, transform, crs, survey_area=None, tile_size=TILE_SIZE, processes=None) -> gp.GeoDataFrame:
+    """Polygonize a raster tile by tile in a process pool, keeping the patches within the survey area.
+    Patches of equal value that cross tile borders are merged again, so the result does not depend on
+    the tile size. Patches are ordered by their top-left pixel, in scanline order.
+    :param values: 2D array with raster data.
+    :param transform: Affine transform from (col, row) to raster coordinates.
+    :param crs: Coordinate reference system of the raster.
+    :param survey_area: Shapely Polygon of survey area, or None to keep all patches.
+    :param tile_size: Width and height of the tiles, in pixels.
+    :param processes: Number of worker processes, defaults to the number of CPUs. With a single process
+                      or a single tile, the raster is polygonized in this process.
+
+    Returns: gdf: gp.GeoDataFrame with raster values & geometry.
+    """
+
+    values = np.asarray(values, dtype=np.float32)
+    transform = affine.Affine(*tuple(transform)[:6])
+    height, width = values.shape
+
+    # Crop to the survey area, with a margin of one pixel: patches cut off by the crop reach outside
+    # the survey area's bounds, so they are dropped either way
+    row_start, row_stop, col_start, col_stop = 0, height, 0, width
+    raster_survey_area = None
+    if survey_area is not None:
+        window = pixel_window(transform, width, height, survey_area, pad=1)
+        row_start, col_start = window.row_off, window.col_off
+        row_stop, col_stop = row_start + window.height, col_start + window.width
+        raster_survey_area = shapely.ops.transform(lambda x, y: (y, x), survey_area)
+
+    tasks = []
+    for row in range(row_start, row_stop, tile_size):
+        for col in range(col_start, col_stop, tile_size):
+            row_end, col_end = min(row + tile_size, row_stop), min(col + tile_size, col_stop)
+            seams = (row > row_start, row_end < row_stop, col > col_start, col_end < col_stop)
+            tasks.append((values[row:row_end, col:col_end], row, col, seams, transform, survey_area,
+                          raster_survey_area))
+
+    processes = processes or os.cpu_count() or 1
+    if len(tasks) > 1 and processes > 1:
+        with ProcessPoolExecutor(min(processes, len(tasks))) as pool:
+            results = list(pool.map(_polygonize_tile, *zip(*tasks)))
+    else:
+        results = [_polygonize_tile(*task) for task in tasks]
+
+    first_pixels = [result[0] for result in results]
+    patch_values = [result[1] for result in results]
+    polygons = []
+    for _, _, coords, sizes, _ in results:
+        coords = coords.tolist()
+        ends = np.cumsum(sizes).tolist()
+        polygons += [sg.Polygon(coords[end - size:end]) for end, size in zip(ends, sizes.tolist())]
+
+    # Merge the pieces of patches that cross tile borders, per value
+    pieces = {}
+    for *_, seam_patches in results:
+        for value, polygon in seam_patches:
+            pieces.setdefault(value, []).append(polygon)
+    within = prep(survey_area).contains if survey_area is not None else None
+    for value, group in pieces.items():
+        merged = shapely.ops.unary_union(group) if len(group) > 1 else group[0]
+        for part in getattr(merged, 'geoms', [merged]):
+            part_cols, part_rows = np.array(part.exterior.coords).T
+            polygon = sg.Polygon(_raster_xy(part_cols, part_rows, transform))
+            if within is None or within(polygon):
+                first_row = part_rows.min()
+                first_pixels.append(np.array([[first_row, part_cols[part_rows == first_row].min()]]))
+                patch_values.append(np.array([value]))
+                polygons.append(polygon)
+
+    first_pixels = np.concatenate(first_pixels) if first_pixels else np.empty((0, 2))
+    order = np.lexsort((first_pixels[:, 1], first_pixels[:, 0]))
+    gdf = gp.GeoDataFrame({"value": np.concatenate(patch_values)[order] if patch_values else [],
+                           "geometry": [polygons[i] for i in order.tolist()]})
+    gdf.crs = crs
+    return gdf
+
+
+def get_ndvi_gdf_from_dataarray(x_arr: xr.DataArray, survey_area, processes=None) -> gp.GeoDataFrame:
+    """Polygonize NDVI raster data and keep the patches within the survey area.
+    The raster is cropped to the survey area and polygonized in parallel tiles.
+    :param x_arr: xr.DataArray with NDVI data, with masked values set to -1.
+    :param survey_area: Shapely Polygon of survey area.
+    :param processes: Number of worker processes, defaults to the number of CPUs; 1 polygonizes in this process.
+
+    Returns: gdf_ndvi: gp.GeoDataframe with NDVI values & geometry.
+    """
+
+    if x_arr.dims != ("y", "x"):
+        raise ValueError('Dimensions must be ("y", "x")')
+    transform = x_arr.attrs.get("transform", None)
+    if transform is None:
+        raise ValueError("transform is required in da.attrs")
+
+    # Get GeoDataframe of NDVI patches within survey area
+    gdf_ndvi = polygonize_tiled(x_arr.values, transform, x_arr.attrs.get("crs"), survey_area, processes=processes)
+
+    # Set unique indices
+    ndvi_index = pd.Index(['NDVI' + str(idx)
+                           for idx in range(len(gdf_ndvi))])
+    gdf_ndvi.set_index(ndvi_index, inplace=True)
+
+    return gdf_ndvi
+
+
+def raster_cell_index(transform, shape, x, y):
+    """Find the raster cells of many points at once, by inverse-affine index arithmetic.
+    :param transform: Affine transform from (col, row) to raster coordinates.
+    :param shape: (height, width) of the raster.
+    :param x: Array with x coordinates, in geometry order.
+    :param y: Array with y coordinates, in geometry order.
+
+    Returns: (rows, cols, inside): Integer cell indices and a mask of points on the raster.
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inv = ~affine.Affine(*tuple(transform)[:6])
+
+    # Swap back to raster order, see polygonize
+    cols = np.floor(inv.a * y + inv.b * x + inv.c).astype(np.int64)
+    rows = np.floor(inv.d * y + inv.e * x + inv.f).astype(np.int64)
+
+    height, width = shape
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return rows, cols, inside
+
+
+class NDVIRaster:
+    """NDVI layer kept as a raster: a 2D NumPy array plus its affine transform.
+
+    Geometry coordinates are (x, y) = (raster y, raster x), matching the coordinate swap in polygonize.
+    Point lookups are inverse-affine index arithmetic; the polygon GeoDataFrame is only built on demand.
+
+    Every pixel is a cell of its own, while polygonize merges neighbouring pixels of equal value into
+    one patch. Destinations of the array engine on a raster are therefore pixel centers, and those of
+    the agent engine or a polygon layer are patch centroids. Where equal pixels touch, e.g. at the
+    NDVI maximum, animals head for different points depending on the engine.
+    """
+
+    def __init__(self, values, transform, crs, survey_area=None):
+        """Create a new NDVI raster layer.
+        :param values: 2D array with NDVI values, with masked values set to -1. Stored as float32,
+                       like the GeoTIFF and as rasterio.features.shapes requires.
+        :param transform: Affine transform from (col, row) to raster coordinates.
+        :param crs: Coordinate reference system of the raster.
+        :param survey_area: Shapely Polygon of survey area, or None to use the whole raster.
+        """
+        self.values = np.asarray(values, dtype=np.float32)
+        self.transform = affine.Affine(*tuple(transform)[:6])
+        self.crs = crs
+        self.survey_area = survey_area
+        self._gdf = None
+        self._cells = None
+
+    @classmethod
+    def from_file(cls, raster, survey_area=None):
+        """Read an NDVI GeoTIFF into memory.
+        :param raster: Path of the raster file.
+        :param survey_area: Shapely Polygon of survey area.
+
+        Returns: NDVIRaster with the first band of the file.
+        """
+        with rasterio.open(raster) as src:
+            return cls(read_ndvi_band(src, 1), src.transform, src.crs.to_string() if src.crs else None,
+                       survey_area)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def cell_index(self, x, y):
+        """Find the raster cells of many points at once.
+        :param x: Array with x coordinates, in geometry order.
+        :param y: Array with y coordinates, in geometry order.
+
+        Returns: (rows, cols, inside): Integer cell indices and a mask of points on the raster.
+        """
+        return raster_cell_index(self.transform, self.values.shape, x, y)
+
+    def lookup(self, x, y, fill=np.nan) -> np.ndarray:
+        """Get the NDVI value under many points at once.
+        :param x: Array with x coordinates, in geometry order.
+        :param y: Array with y coordinates, in geometry order.
+        :param fill: Value for points outside the raster.
+
+        Returns: Array with NDVI values.
+        """
+        rows, cols, inside = self.cell_index(x, y)
+        result = np.full(rows.shape, fill, dtype=float)
+        result[inside] = self.values[rows[inside], cols[inside]]
+        return result
+
+    def cells(self):
+        """Get centroids and values of all cells within the survey area.
+        Cells are single pixels, not the merged patches of gdf; see the class documentation.
+
+        Returns: (x, y, values): Arrays with cell centroids, in geometry order, and NDVI values.
+        """
+        if self._cells is None:
+            height, width = self.values.shape
+            rows, cols = np.mgrid[0:height, 0:width]
+            raster_x, raster_y = self.transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+            x, y = np.asarray(raster_y, dtype=float), np.asarray(raster_x, dtype=float)
+            values = self.values.ravel()
+
+            if self.survey_area is not None:
+                keep = points_within(self.survey_area, x, y)
+                x, y, values = x[keep], y[keep], values[keep]
+            self._cells = (x, y, values.astype(float))
+
+        return self._cells
+
+    def to_dataarray(self) -> xr.DataArray:
+        """Wrap the raster in an xr.DataArray, as polygonize expects."""
+        da = xr.DataArray(self.values, dims=("y", "x"))
+        return da.assign_attrs(transform=tuple(self.transform)[:6], crs=self.crs)
+
+    @property
+    def gdf(self) -> gp.GeoDataFrame:
+        """Polygonized NDVI patches, e.g. for the map visualization. Built on first access.
+
+        The first access may come from a server or session thread, so the patches are polygonized in
+        this process: forking a process pool there would copy the locks of the other threads.
+        """
+        if self._gdf is None:
+            if self.survey_area is None:
+                self._gdf = polygonize(self.to_dataarray())
+            else:
+                self._gdf = get_ndvi_gdf_from_dataarray(self.to_dataarray(), self.survey_area, processes=1)
+        return self._gdf
+
+
+def read_ndvi_band(src, band, window=None) -> np.ndarray:
+    """Read one NDVI band of an open raster, with masked values set to -1.
+    :param src: Open rasterio dataset.
+    :param band: Band number, starting at 1.
+    :param window: Optional rasterio Window to read.
+
+    Returns: 2D float32 array with NDVI values.
+    """
+
+    values = src.read(band, window=window).astype(np.float32)
+    values[values < -10000000] = -1
+    return values
+
+
+def survey_window(src, survey_area) -> rasterio.windows.Window:
+    """Get the smallest raster window that covers the survey area.
+    :param src: Open rasterio dataset.
+    :param survey_area: Shapely Polygon of survey area, or None for the whole raster.
+
+    Returns: rasterio Window in whole pixels.
+    """
+
+    if survey_area is None:
+        return rasterio.windows.Window(0, 0, src.width, src.height)
+    return pixel_window(src.transform, src.width, src.height, survey_area)
+
+
+def pixel_window(transform, width, height, survey_area, pad=0) -> rasterio.windows.Window:
+    """Get the smallest window of a raster that covers the survey area.
+    :param transform: Affine transform from (col, row) to raster coordinates.
+    :param width: Width of the raster in pixels.
+    :param height: Height of the raster in pixels.
+    :param survey_area: Shapely Polygon of survey area.
+    :param pad: Number of extra pixels around the survey area.
+
+    Returns: rasterio Window in whole pixels, within the raster.
+    """
+
+    # Geometry (x, y) is raster (y, x), see polygonize
+    minx, miny, maxx, maxy = survey_area.bounds
+    window = rasterio.windows.from_bounds(miny, minx, maxy, maxx, transform=transform)
+
+    col_start = min(max(math.floor(window.col_off) - pad, 0), width)
+    row_start = min(max(math.floor(window.row_off) - pad, 0), height)
+    col_stop = min(max(math.ceil(window.col_off + window.width) + pad, col_start), width)
+    row_stop = min(max(math.ceil(window.row_off + window.height) + pad, row_start), height)
+    return rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+class NDVISeries:
+    """NDVI time series, read one date at a time from a multi-band raster or from one raster per date.
+
+    Every date is read as a window around the survey area. Only the layer in use is held in memory;
+    after each layer is handed out, the next date is read ahead on a background thread.
+    """
+
+    def __init__(self, sources, survey_area=None, dates=None):
+        """Create a new NDVI time series.
+        :param sources: Path of a multi-band raster with one band per date, or a list of single-band
+                        raster paths in date order. All rasters must share their grid.
+        :param survey_area: Shapely Polygon of survey area, or None to use the whole raster.
+        :param dates: Optional names of the dates, defaults to band descriptions or file names.
+        """
+        if isinstance(sources, (str, os.PathLike)):
+            with rasterio.open(sources) as src:
+                self.layers = [(sources, band) for band in range(1, src.count + 1)]
+                default_dates = [description or f'band {band}'
+                                 for band, description in enumerate(src.descriptions, start=1)]
+        else:
+            self.layers = [(source, 1) for source in sources]
+            default_dates = [os.path.splitext(os.path.basename(source))[0] for source in sources]
+        if not self.layers:
+            raise ValueError("NDVI series has no layers")
+
+        self.dates = list(dates) if dates is not None else default_dates
+        if len(self.dates) != len(self.layers):
+            raise ValueError("dates must name every layer of the series")
+
+        self.survey_area = survey_area
+        with rasterio.open(self.layers[0][0]) as src:
+            self.window = survey_window(src, survey_area)
+            self.transform = rasterio.windows.transform(self.window, src.transform)
+            self.crs = src.crs.to_string() if src.crs else None
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetch = None
+
+    def __len__(self):
+        return len(self.layers)
+
+    def read(self, date) -> NDVIRaster:
+        """Read the NDVI layer of one date from disk.
+        :param date: Position of the date in the series.
+
+        Returns: NDVIRaster with the NDVI values of the date.
+        """
+        source, band = self.layers[date]
+        with rasterio.open(source) as src:
+            values = read_ndvi_band(src, band, window=self.window)
+        return NDVIRaster(values, self.transform, self.crs, self.survey_area)
+
+    def layer(self, date) -> NDVIRaster:
+        """Get the NDVI layer of a date, and start reading the next date in the background.
+        Returns without I/O if the date was prefetched and the read has finished.
+        :param date: Position of the date in the series.
+
+        Returns: NDVIRaster with the NDVI values of the date.
+        """
+        if self._prefetch is not None and self._prefetch[0] == date:
+            ndvi_raster = self._prefetch[1].result()
+        else:
+            ndvi_raster = self.read(date)
+
+        self._prefetch = None
+        if date + 1 < len(self):
+            self._prefetch = (date + 1, self._executor.submit(self.read, date + 1))
+        return ndvi_raster
+
+    def cell_index(self, x, y):
+        """Find the cells of many points in the series grid, see NDVIRaster.cell_index.
+        :param x: Array with x coordinates, in geometry order.
+        :param y: Array with y coordinates, in geometry order.
+
+        Returns: (rows, cols, inside): Integer cell indices and a mask of points on the grid.
+        """
+        return raster_cell_index(self.transform, (self.window.height, self.window.width), x, y)
+
+    def close(self) -> None:
+        """Stop the background reader."""
+        self._prefetch = None
+        self._executor.shutdown(wait=True)
+
+
 def get_ndvi_loc(cloudmask) -> str:
     """Get NDVI raster location.
     :param cloudmask: Boolean variable if cloudmask is applied in data or not
@@ -66,47 +564,161 @@ def get_ndvi_loc(cloudmask) -> str:
     return ndvi_raster
 
 
-def get_ndvi_gdf(preload, cloudmask, survey_area) -> gp.GeoDataFrame:
+def get_ndvi_series_loc(cloudmask) -> str:
+    """Get location of the multi-date NDVI raster, with one band per date.
+    :param cloudmask: Boolean variable if cloudmask is applied in data or not
+
+    Returns: string with data location of raster data.
+    """
+
+    return get_ndvi_loc(cloudmask).replace('.tif', '_series.tif')
+
+
+def get_ndvi_cache_file(raster, cloudmask, survey_area) -> str:
+    """Get the content-addressed cache file for a polygonized NDVI raster.
+    The key covers the raster path, size and modification time, the cloudmask flag and the survey area,
+    so a changed input never reuses a stale cache.
+    :param raster: Path of the raster file.
+    :param cloudmask: Boolean variable if clouds are masked in data.
+    :param survey_area: Shapely Polygon of survey area.
+
+    Returns: String with location of the cache file.
+    """
+
+    stat = os.stat(raster)
+    key = hashlib.sha256()
+    for part in (NDVI_CACHE_VERSION, os.path.abspath(raster), stat.st_size, stat.st_mtime_ns, bool(cloudmask)):
+        key.update(str(part).encode())
+    key.update(survey_area.wkb)
+
+    return os.path.join(cache_path, 'gdf_ndvi_' + key.hexdigest()[:20] + '.arrow')
+
+
+def write_ndvi_cache(gdf_ndvi, cache_file) -> None:
+    """Store NDVI patches as an uncompressed Arrow IPC file, with geometries as WKB.
+    The file is written next to its destination and renamed into place, so concurrent readers never see
+    a partial file.
+    :param gdf_ndvi: gp.GeoDataframe with NDVI values & geometry.
+    :param cache_file: Location of the cache file.
+    """
+
+    crs = gdf_ndvi.crs.to_string() if gdf_ndvi.crs else ''
+    table = pa.table({'index': pa.array(gdf_ndvi.index.astype(str)),
+                      'value': pa.array(gdf_ndvi['value'].to_numpy()),
+                      'geometry': pa.array(gdf_ndvi.geometry.to_wkb(), type=pa.binary())},
+                     metadata={'crs': crs})
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_file, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_file, cache_file)
+
+
+def read_ndvi_cache(cache_file) -> gp.GeoDataFrame:
+    """Load NDVI patches from an Arrow IPC cache file.
+    The file is memory-mapped: NDVI values are read zero-copy, and its pages are shared between processes
+    loading the same cache.
+    :param cache_file: Location of the cache file.
+
+    Returns: gdf_ndvi: gp.GeoDataframe with NDVI values & geometry.
+    """
+
+    with pa.memory_map(cache_file, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    crs = table.schema.metadata.get(b'crs', b'').decode() or None
+    geometry = gp.GeoSeries.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False), crs=crs)
+    gdf_ndvi = gp.GeoDataFrame({'value': table.column('value').to_numpy()},
+                               geometry=geometry.values, crs=crs)
+    gdf_ndvi.set_index(pd.Index(table.column('index').to_pylist()), inplace=True)
+
+    return gdf_ndvi
+
+
+def get_ndvi_gdf(preload, cloudmask, survey_area, legacy=False) -> gp.GeoDataFrame:
     """Polygonize raster.
 
     Parameters:
     :param preload: Boolean variable to decide whether to preload existing data or to fetch new.
     :param cloudmask: Boolean variable if clouds should be masked in data( = set to -1).
     :param survey_area: Shapely Polygon of survey area.
+    :param legacy: Without the raster, load the old pickled NDVI data instead. Nothing checks that the
+                   pickle matches the cloudmask or the survey area.
 
     Returns: gdf_ndvi: gp.GeoDataframe with NDVI values & geometry.
     """
 
-    if preload:
+    # Get location
+    raster = get_ndvi_loc(cloudmask)
+
+    if not os.path.exists(raster):
+        # Without the raster there is nothing to key a cache on
+        if not (legacy and os.path.exists(legacy_pickle)):
+            raise FileNotFoundError(f"NDVI raster {raster} not found")
+        warnings.warn(f"NDVI raster {raster} not found, loading unchecked legacy data from {legacy_pickle}")
+        with open(legacy_pickle, "rb") as file:
+            gdf_ndvi = pickle.load(file)
+        print("NDVI data loaded!")
+        return gdf_ndvi
+
+    cache_file = get_ndvi_cache_file(raster, cloudmask, survey_area)
+
+    if preload and os.path.exists(cache_file):
         print("Loading existing NDVI data...")
-        gdf_ndvi = pickle.load(open("./data/pickled/gdf_ndvi.p", "rb"))
+        gdf_ndvi = read_ndvi_cache(cache_file)
         print("NDVI data loaded!")
     else:
         print("Fetching new NDVI data...")
-        # Get location
-        raster = get_ndvi_loc(cloudmask)
-        # Open as raster
-        x_arr = xr.open_rasterio(raster).squeeze('band', drop=True)
-        # Save attributes to put back later
-        attributes = x_arr.attrs
-        # This function removes attributes
-        x_arr = xr.where(x_arr < -10000000, -1, x_arr)
-        # Re-add attributes
-        x_arr = x_arr.assign_attrs(attributes)
-        # Get GeoDataframe from DataArray
-        gdf_ndvi = polygonize(x_arr)
-
-        # Only keep NDVI patches within survey area
-        gdf_ndvi = gdf_ndvi.loc[lambda _df: _df['geometry'].within(
-            survey_area)]
-
-        # Set unique indices
-        ndvi_index = pd.Index(['NDVI' + str(idx)
-                               for idx in range(len(gdf_ndvi))])
-        gdf_ndvi.set_index(ndvi_index, inplace=True)
+        # Only read the raster around the survey area, with masked values set to -1
+        with rasterio.open(raster) as src:
+            window = pixel_window(src.transform, src.width, src.height, survey_area, pad=1)
+            ndvi_raster = NDVIRaster(read_ndvi_band(src, 1, window), rasterio.windows.transform(window, src.transform),
+                                     src.crs.to_string() if src.crs else None)
+        # Get GeoDataframe of NDVI patches within survey area
+        gdf_ndvi = get_ndvi_gdf_from_dataarray(ndvi_raster.to_dataarray(), survey_area)
 
         # Save data locally.
-        pickle.dump(gdf_ndvi, open("./data/pickled/gdf_ndvi.p", "wb"))
+        write_ndvi_cache(gdf_ndvi, cache_file)
         print("NDVI data loaded and saved locally.")
 
     return gdf_ndvi
+
+
+def get_ndvi_raster(cloudmask, survey_area) -> NDVIRaster:
+    """Load NDVI data as a raster layer, without polygonizing it.
+
+    Parameters:
+    :param cloudmask: Boolean variable if clouds should be masked in data( = set to -1).
+    :param survey_area: Shapely Polygon of survey area.
+
+    Returns: ndvi_raster: NDVIRaster with NDVI values & affine transform.
+    """
+
+    print("Loading NDVI raster...")
+    ndvi_raster = NDVIRaster.from_file(get_ndvi_loc(cloudmask), survey_area)
+    print("NDVI raster loaded!")
+
+    return ndvi_raster
+
+
+def get_ndvi_series(cloudmask, survey_area) -> NDVISeries:
+    """Open the multi-date NDVI raster as a lazily read time series.
+    Date names are taken from the '_dates.csv' file next to the raster, if present.
+
+    Parameters:
+    :param cloudmask: Boolean variable if clouds should be masked in data( = set to -1).
+    :param survey_area: Shapely Polygon of survey area.
+
+    Returns: ndvi_series: NDVISeries with one NDVI layer per date.
+    """
+
+    raster = get_ndvi_series_loc(cloudmask)
+    dates_file = raster.replace('.tif', '_dates.csv')
+    dates = pd.read_csv(dates_file)['date'].astype(str).tolist() if os.path.exists(dates_file) else None
+
+    ndvi_series = NDVISeries(raster, survey_area, dates=dates)
+    print(f"NDVI series with {len(ndvi_series)} dates opened.")
+
+    return ndvi_series
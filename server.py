@@ -1,12 +1,16 @@
-import math
-from matplotlib import cm
-import matplotlib.colors as mc
-from model import AnimalModel, Animal, NDVIcell
+import os
+import numpy as np
+import pandas as pd
+from model import AnimalModel
 from preprocess import get_2017_population_data
 from sentinel import get_ndvi_gdf
-from mesa_geo.visualization.MapModule import MapModule
+from density import scott_bandwidth
 from mesa.visualization.modules import TextElement
-from mesa_geo.visualization.ModularVisualization import ModularServer
+from mapmodule import DeltaMapModule, DeltaModularServer, AnimalPortrayal
+from session import SessionServer
+
+# Set to 1 to give every browser session its own model, stepped in the background on shared data
+SESSIONS_ENV = 'ANIMALMODEL_SESSIONS'
 
 
 class StepElement(TextElement):
@@ -21,31 +25,19 @@ class StepElement(TextElement):
         return "Steps: " + str(model.steps)
 
 
-def agent_portrayal(agent):
-    """Portayal function to send to visualize agent"""
-
-    portrayal = dict()
-    # Animals
-    if isinstance(agent, Animal):
-        portrayal["color"] = "Red"
-        portrayal["radius"] = math.sqrt(agent.animal_count)
-        portrayal['layer'] = 1
-     # NDVI
-    if isinstance(agent, NDVIcell):
-        # Visualize NDVI-dependent color
-        greens = cm.get_cmap("Greens", num_NDVI)
-        # Convert NDVI value (from [-1,1] to [0,1] range)
-        color_val = (float(agent.value) + 1) / 2
-        portrayal['color'] = mc.to_hex(greens(color_val))
-        portrayal['text'] = str(round(agent.value, 2))
-        portrayal['layer'] = 0
-
-    return portrayal
+# Portayal function to send to visualize animals, NDVI is drawn as an overlay
+agent_portrayal = AnimalPortrayal()
 
 
-# Load animal data
+# Load animal data, elephants and buffalos are modelled together
 elephants, buffalos = get_2017_population_data()
-(gdf_animal, animal_name) = elephants
+animal_data = [elephants, buffalos]
+animal_name = "/".join(name for _, name in animal_data)
+
+# Density overlay kernel, by Scott's rule on the census of all species
+census = pd.concat([gdf.geometry for gdf, _ in animal_data])
+census_counts = np.concatenate([gdf[name].to_numpy(dtype=float) for gdf, name in animal_data])
+density_bandwidth = max(scott_bandwidth(census.x, census.y, census_counts))
 
 # Load NDVI data
 gdf_ndvi = get_ndvi_gdf(preload=True, cloudmask=True,
@@ -56,25 +48,36 @@ ndvi_value = gdf_ndvi['value']
 # Get maximum NDVI value for agent portrayal
 max_ndvi = gdf_ndvi['value'].max()
 
-model_params = {"gdf_animal": gdf_animal,
+model_params = {"gdf_animal": animal_data,
                 "gdf_ndvi": gdf_ndvi,
-                "animal_name": animal_name,
+                "animal_name": None,
                 "ndvi_value": ndvi_value
                 }
 
 # Set visualization elements
 step_element = StepElement()
-map_element = MapModule(agent_portrayal,
-                        view=AnimalModel.MAP_COORDS,
-                        zoom=7,
-                        map_height=500, map_width=500)
+map_element = DeltaMapModule(agent_portrayal,
+                             view=AnimalModel.MAP_COORDS,
+                             zoom=7,
+                             map_height=500, map_width=500,
+                             density_bandwidth=density_bandwidth)
 
 # Initialize web server
-server = ModularServer(AnimalModel,
-                       [map_element, step_element],
-                       f"{animal_name} Model",
-                       model_params)
-
-# Set server port and launch
+if os.environ.get(SESSIONS_ENV, '0') in ('', '0'):
+    server = DeltaModularServer(AnimalModel,
+                                [map_element, step_element],
+                                f"{animal_name} Model",
+                                model_params)
+else:
+    # Sessions share the NDVI layer, the array engine keeps them from building NDVI agents
+    model_params["engine"] = "array"
+    server = SessionServer(AnimalModel,
+                           [map_element, step_element],
+                           f"{animal_name} Model",
+                           model_params)
+
+# Set server port
 server.port = 8521  # The default
-server.launch()
+
+if __name__ == '__main__':
+    server.launch()
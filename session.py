@@ -0,0 +1,334 @@
+"""
+
+Use this file to serve the model to several browser sessions, each stepping its own model in the background.
+
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import geopandas as gp
+import tornado.escape
+import tornado.ioloop
+from mesa.visualization.UserParam import UserSettableParameter
+from mesa_geo.visualization.ModularVisualization import ModularServer, SocketHandler
+from model import AnimalModel, SharedNDVILayer
+from mapmodule import DeltaMapModule
+
+# Seconds a step request waits for the new step before the browser gets the latest snapshot
+STEP_WAIT = 0.25
+
+# Seconds a request waits for the model of its session to be built
+BUILD_WAIT = 120.0
+
+# Threads that wait for the runners of all sessions, apart from the event loop's default executor
+WAIT_THREADS = 16
+
+
+class _NDVIValues:
+    """Stands in for the NDVI index of a model in a snapshot, with a copy of its values only."""
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+
+class ModelSnapshot:
+    """State of a model after a step, for rendering while the model steps on in another thread.
+
+    Animal positions and NDVI values are copied when the snapshot is taken. Everything else is read
+    from the model itself and must not change while it steps, like the survey area, the CRS of the
+    grid and the species and counts of the animals.
+    """
+
+    def __init__(self, model, previous=None):
+        """Take a snapshot of a model.
+        :param model: AnimalModel, not stepping while the snapshot is taken.
+        :param previous: Previous snapshot of the model, whose unchanged arrays are reused.
+        """
+        self.model = model
+        self.steps = model.steps
+        self.running = model.running
+        self.ndvi_date = model.ndvi_date
+        self.ndvi_raster = model.ndvi_raster
+
+        same_model = previous is not None and previous.model is model
+        x, y, counts = model.animal_positions()
+        # Animal counts never change, NDVI values only with the date
+        counts = previous._positions[2] if same_model else np.array(counts, dtype=float)
+        self._positions = (np.array(x, dtype=float), np.array(y, dtype=float), counts)
+        self._animal_ndvi = np.array(model.animal_ndvi_values(), dtype=float)
+        if same_model and previous.ndvi_date == model.ndvi_date:
+            self.ndvi_index = previous.ndvi_index
+        else:
+            self.ndvi_index = _NDVIValues(model.ndvi_index.values.copy())
+
+    def __getattr__(self, name):
+        # Only called for attributes the snapshot does not hold itself
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def animal_positions(self):
+        """Get animal positions and counts at the step of the snapshot.
+
+        Returns: (x, y, counts): Arrays with animal coordinates and animal counts.
+        """
+        return self._positions
+
+    def animal_ndvi_values(self) -> np.ndarray:
+        """Get the NDVI value of every animal at the step of the snapshot."""
+        return self._animal_ndvi
+
+
+class ModelRunner:
+    """Build and step a model in a background thread, publishing a snapshot after every step.
+
+    The model only steps while it is asked to: every request lets it run up to lead steps beyond
+    the latest snapshot. Requests never wait for a step to finish, so while they keep coming the model
+    runs at its own pace, and a slow step holds up nobody but its own session.
+    """
+
+    def __init__(self, lead=0):
+        """Create a new runner, without a model until reset() is called.
+        :param lead: Number of steps the model may run ahead of the requested step.
+        """
+        if lead < 0:
+            raise ValueError("lead must not be negative")
+
+        self.lead = lead
+        self.snapshot = None
+        self.error = None
+        # Set when the snapshot is of the latest model
+        self.ready = threading.Event()
+
+        self._condition = threading.Condition()
+        self._build = None
+        self._target = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        model = None
+        while True:
+            with self._condition:
+                while not (self._closed or self._build is not None or
+                           (model is not None and model.running and model.steps < self._target + self.lead)):
+                    self._condition.wait()
+                if self._closed:
+                    break
+                build, self._build = self._build, None
+
+            try:
+                if build is not None:
+                    # The old model is released before the new one is built
+                    model = self.snapshot = None
+                    model = build()
+                    with self._condition:
+                        self._target = model.steps
+                else:
+                    model.step()
+                snapshot = ModelSnapshot(model, self.snapshot)
+            except Exception as error:
+                with self._condition:
+                    self.error = error
+                    self.ready.set()
+                    self._condition.notify_all()
+                break
+
+            with self._condition:
+                if self._closed:
+                    break
+                self.snapshot = snapshot
+                if self._build is None:
+                    self.ready.set()
+                self._condition.notify_all()
+
+    def reset(self, build) -> None:
+        """Build a new model in the background, replacing the current one.
+        :param build: Function without arguments that returns the new model.
+        """
+        with self._condition:
+            self.ready.clear()
+            self._build = build
+            self._condition.notify_all()
+
+    def request_step(self) -> int:
+        """Let the model take the step after the latest snapshot, if it has not yet.
+
+        Returns: Step that was requested, None without a model.
+        """
+        with self._condition:
+            if self.snapshot is None:
+                return None
+            self._target = max(self._target, self.snapshot.steps + 1)
+            self._condition.notify_all()
+            return self._target
+
+    def wait_step(self, step, timeout=None) -> ModelSnapshot:
+        """Wait until a snapshot of at least the given step is published, or the model stops.
+        :param step: Model step to wait for.
+        :param timeout: Maximum number of seconds to wait.
+
+        Returns: Latest ModelSnapshot.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self.error is not None or self.snapshot is None or
+                                     self.snapshot.steps >= step or not self.snapshot.running,
+                                     timeout=timeout)
+            return self.snapshot
+
+    def close(self) -> None:
+        """Stop the runner after the step it is taking, and release its model."""
+        with self._condition:
+            self._closed = True
+            self.snapshot = None
+            # Nobody waits for a model that is not coming
+            self.ready.set()
+            self._condition.notify_all()
+
+
+class SessionSocketHandler(SocketHandler):
+    """WebSocket handler that gives every browser session its own model, stepping in the background.
+
+    'get_step' never steps the model on the event loop: it asks the session's ModelRunner for the
+    next step and answers with the latest snapshot once the step is done, or after STEP_WAIT seconds,
+    whichever comes first. Other sessions are served in the meantime.
+    """
+
+    def open(self):
+        self.params = {}
+        self.elements = self.application.session_elements()
+        self.runner = ModelRunner(lead=self.application.lead)
+        super().open()
+
+    def on_close(self):
+        self.runner.close()
+        if self.application.verbose:
+            print("Socket closed!")
+
+    def render(self, snapshot) -> dict:
+        """Render a snapshot with the visualization elements of this session."""
+        return {"type": "viz_state", "data": [element.render(snapshot) for element in self.elements]}
+
+    async def _run_blocking(self, func, *args):
+        """Wait for a runner in a thread of the server, so the event loop keeps serving other sessions."""
+        return await tornado.ioloop.IOLoop.current().run_in_executor(self.application.wait_executor,
+                                                                     functools.partial(func, *args))
+
+    async def _latest_snapshot(self) -> ModelSnapshot:
+        """Get the latest snapshot, waiting for the model to be built first.
+
+        Returns: Latest ModelSnapshot, None if the model is not built within the server's build_wait.
+        """
+        if not await self._run_blocking(self.runner.ready.wait, self.application.build_wait):
+            print(f"Model of the session not built within {self.application.build_wait} seconds")
+            return None
+        if self.runner.error is not None:
+            raise RuntimeError("Model of the session failed") from self.runner.error
+        return self.runner.snapshot
+
+    async def on_message(self, message):
+        """ Receiving a message from the websocket, parse, and act accordingly."""
+        if self.application.verbose:
+            print(message)
+        msg = tornado.escape.json_decode(message)
+
+        if msg["type"] == "get_step":
+            snapshot = await self._latest_snapshot()
+            if snapshot is None:
+                return
+            if not snapshot.running:
+                self.write_message({"type": "end"})
+                return
+            step = self.runner.request_step()
+            if step is not None:
+                snapshot = await self._run_blocking(self.runner.wait_step, step, self.application.step_wait)
+            if snapshot is not None:
+                self.write_message(self.render(snapshot))
+
+        elif msg["type"] == "reset":
+            self.runner.reset(functools.partial(self.application.new_model, dict(self.params)))
+            snapshot = await self._latest_snapshot()
+            if snapshot is not None:
+                self.write_message(self.render(snapshot))
+
+        elif msg["type"] == "viewport":
+            for element in self.elements:
+                if isinstance(element, DeltaMapModule):
+                    element.set_viewport(msg["bounds"])
+            # Send the animals that came into view
+            snapshot = self.runner.snapshot
+            if snapshot is not None:
+                self.write_message(self.render(snapshot))
+
+        elif msg["type"] == "submit_params":
+            # Parameters of this session only, used at its next reset
+            if msg["param"] in self.application.user_params:
+                self.params[msg["param"]] = msg["value"]
+
+        else:
+            super().on_message(message)
+
+
+class SessionServer(ModularServer):
+    """ModularServer with one model per browser session, each stepped in a background thread.
+
+    All sessions share the census data and one SharedNDVILayer with the static spatial indexes, so a
+    session only adds its own animals. The visualization elements are copied per session.
+    """
+
+    socket_handler = (r'/ws', SessionSocketHandler)
+    handlers = [ModularServer.page_handler, socket_handler,
+                ModularServer.static_handler, ModularServer.local_handler]
+
+    def __init__(self, model_cls, visualization_elements, name="Mesa Model", model_params={}, lead=0,
+                 step_wait=STEP_WAIT, build_wait=BUILD_WAIT, wait_threads=WAIT_THREADS):
+        """Create a new session server.
+        :param model_cls: AnimalModel or a subclass of it.
+        :param visualization_elements: Elements to render, copied per session where they keep state.
+        :param name: Name of the model on the page.
+        :param model_params: Model arguments; a GeoDataFrame gdf_ndvi is turned into a SharedNDVILayer.
+        :param lead: Number of steps a session's model may run ahead of what its browser asked for.
+        :param step_wait: Seconds a step request waits for the new step before sending the latest one.
+        :param build_wait: Seconds a request waits for the model of its session to be built.
+        :param wait_threads: Number of threads that wait for the sessions' models. Every wait ends after
+                             step_wait or build_wait seconds, so a slow model cannot hold one for long.
+        """
+        self.lead = lead
+        self.step_wait = step_wait
+        self.build_wait = build_wait
+        self.wait_executor = ThreadPoolExecutor(max_workers=wait_threads, thread_name_prefix="session-wait")
+        super().__init__(model_cls, visualization_elements, name, model_params)
+
+    def reset_model(self):
+        """Prepare the data shared by the sessions; every session builds its own model."""
+        gdf_ndvi = self.model_kwargs.get("gdf_ndvi")
+        if isinstance(gdf_ndvi, gp.GeoDataFrame):
+            # In the CRS the models convert it to, that of the first species
+            groups = AnimalModel._animal_groups(self.model_kwargs["gdf_animal"], self.model_kwargs.get("animal_name"))
+            self.model_kwargs = dict(self.model_kwargs, gdf_ndvi=SharedNDVILayer(gdf_ndvi, crs=groups[0][0].crs))
+        self.model = None
+
+    def new_model(self, params=None):
+        """Build a model on the shared data.
+        :param params: Values of user settable parameters of the session.
+
+        Returns: New model.
+        """
+        model_params = {}
+        for key, val in self.model_kwargs.items():
+            if isinstance(val, UserSettableParameter):
+                if val.param_type == 'static_text':
+                    continue
+                val = val.value
+            model_params[key] = val
+        model_params.update(params or {})
+        return self.model_cls(**model_params)
+
+    def session_elements(self) -> list:
+        """Get the visualization elements of a new session; elements without state are shared."""
+        return [element.session_copy() if hasattr(element, 'session_copy') else element
+                for element in self.visualization_elements]
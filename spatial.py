@@ -0,0 +1,500 @@
+"""
+
+Use this file for vectorized spatial helpers and indices shared by the model.
+
+"""
+import heapq
+import sys
+import numpy as np
+from itertools import chain
+from mesa_geo import GeoSpace
+from mesa_geo.geoagent import GeoAgent
+from rtree import index
+from shapely.geometry import Point
+
+try:
+    # Shapely >= 2.0
+    from shapely import contains_xy as _contains_xy
+except ImportError:
+    # Shapely 1.x
+    from shapely.vectorized import contains as _contains_xy
+
+
+def is_ndvi_raster(layer) -> bool:
+    """Whether an NDVI layer is a sentinel.NDVIRaster, without importing sentinel and its raster stack.
+    No raster can exist before sentinel is imported."""
+    sentinel = sys.modules.get('sentinel')
+    return sentinel is not None and isinstance(layer, sentinel.NDVIRaster)
+
+
+def points_within(polygon, x, y) -> np.ndarray:
+    """Vectorized equivalent of Point(x, y).within(polygon) for many points at once.
+    :param polygon: Shapely Polygon to test against.
+    :param x: Array with x coordinates.
+    :param y: Array with y coordinates.
+
+    Returns: Boolean array, True where a point lies in the interior of the polygon.
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.size == 0:
+        return np.zeros(x.shape, dtype=bool)
+
+    return np.asarray(_contains_xy(polygon, x, y), dtype=bool)
+
+
+class NDVIIndex:
+    """Index over NDVI cell values, giving the maximum and top-k cells without scanning the grid.
+
+    Values live in a NumPy array in cell order, next to a max-heap of (-value, position, version)
+    entries. Updated cells push a new entry; outdated entries are dropped lazily when they surface.
+    Ties are broken by position, so the first cell holding the maximum wins, like max().
+    """
+
+    def __init__(self, keys, values):
+        """Create a new NDVI index.
+        :param keys:   Cells (or cell identifiers) in model order.
+        :param values: NDVI value of each cell.
+        """
+        self.keys = list(keys)
+        self.values = np.array(values, dtype=float)
+        if len(self.keys) != len(self.values):
+            raise ValueError("keys and values must have the same length")
+
+        self._pos = {key: pos for pos, key in enumerate(self.keys)}
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        """(Re)build the heap from the current values."""
+        self._version = np.zeros(len(self.keys), dtype=np.int64)
+        self._heap = [(-value, pos, 0) for pos, value in enumerate(self.values.tolist())]
+        heapq.heapify(self._heap)
+
+    def _is_current(self, entry) -> bool:
+        return entry[2] == self._version[entry[1]]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def update(self, key, value) -> None:
+        """Set the NDVI value of a single cell in O(log n).
+        :param key:   Cell to update.
+        :param value: New NDVI value.
+        """
+        pos = self._pos[key]
+        value = float(value)
+        if value == self.values[pos]:
+            return
+
+        self.values[pos] = value
+        self._version[pos] += 1
+        heapq.heappush(self._heap, (-value, pos, int(self._version[pos])))
+
+        # Keep outdated entries from piling up
+        if len(self._heap) > 2 * len(self.keys) + 64:
+            self._rebuild()
+
+    def assign(self, values) -> None:
+        """Set the NDVI values of all cells at once, in place, e.g. for a new date.
+        :param values: New NDVI value of every cell, in key order.
+        """
+        values = np.asarray(values, dtype=float)
+        if values.shape != self.values.shape:
+            raise ValueError("values must hold one value per cell")
+
+        self.values[:] = values
+        self._rebuild()
+
+    def argmax(self) -> int:
+        """Return position of the cell with the maximum NDVI value."""
+        heap = self._heap
+        while heap and not self._is_current(heap[0]):
+            heapq.heappop(heap)
+        if not heap:
+            raise ValueError("NDVI index is empty")
+        return heap[0][1]
+
+    def max(self):
+        """Return (cell, value) of the cell with the maximum NDVI value."""
+        pos = self.argmax()
+        return self.keys[pos], self.values[pos]
+
+    def top_k(self, k) -> list:
+        """Return the k cells with the highest NDVI values as (cell, value) tuples, in O(k log n).
+        :param k: Number of cells to return.
+        """
+        current = []
+        while self._heap and len(current) < k:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                current.append(entry)
+
+        # Put the popped entries back
+        for entry in current:
+            heapq.heappush(self._heap, entry)
+
+        return [(self.keys[pos], self.values[pos]) for _, pos, _ in current]
+
+
+class CentroidIndex:
+    """Grid-bucket index over NDVI cell centroids for batched radius queries.
+
+    Centroids are sorted by the square bucket they fall in, so all cells of a bucket are one
+    contiguous slice. A radius query only looks at the buckets around each point.
+    """
+
+    def __init__(self, x, y, bucket_size):
+        """Create a new centroid index.
+        :param x:           Array with centroid x coordinates.
+        :param y:           Array with centroid y coordinates.
+        :param bucket_size: Width of the square buckets, preferably close to the search radius.
+        """
+        if bucket_size <= 0:
+            raise ValueError("bucket_size must be positive")
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.bucket_size = float(bucket_size)
+
+        self._origin = (self.x.min(), self.y.min()) if len(self.x) else (0.0, 0.0)
+        bx, by = self._buckets(self.x, self.y)
+        self._n_by = int(by.max()) + 3 if len(by) else 1
+
+        keys = self._keys(bx, by)
+        self._order = np.argsort(keys, kind='stable')
+        self._keys_sorted, self._starts, self._counts = np.unique(
+            keys[self._order], return_index=True, return_counts=True)
+
+    def _buckets(self, x, y):
+        bx = np.floor((x - self._origin[0]) / self.bucket_size).astype(np.int64)
+        by = np.floor((y - self._origin[1]) / self.bucket_size).astype(np.int64)
+        return bx, by
+
+    def _keys(self, bx, by):
+        # Shift by one, so neighbouring buckets of edge points still get valid keys
+        return (bx + 1) * self._n_by + (by + 1)
+
+    def query_radius(self, x, y, radius):
+        """Find all centroids within a radius of each query point.
+        :param x:      Array with query x coordinates.
+        :param y:      Array with query y coordinates.
+        :param radius: Search radius, in the units of the coordinates.
+
+        Returns: (point_idx, cell_idx): Arrays of matching query point and centroid positions.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        if len(x) == 0 or len(self._keys_sorted) == 0:
+            return empty
+
+        bx, by = self._buckets(x, y)
+        rings = int(np.ceil(radius / self.bucket_size))
+        points = np.arange(len(x))
+
+        point_parts, cell_parts = [], []
+        for dx in range(-rings, rings + 1):
+            for dy in range(-rings, rings + 1):
+                nbx, nby = bx + dx, by + dy
+                valid = (nby >= -1) & (nby <= self._n_by - 2) & (nbx >= -1)
+                keys = self._keys(nbx, nby)
+
+                # Look up the bucket slice for every query point
+                pos = np.searchsorted(self._keys_sorted, keys)
+                pos = np.minimum(pos, len(self._keys_sorted) - 1)
+                hit = valid & (self._keys_sorted[pos] == keys)
+                if not hit.any():
+                    continue
+
+                starts = self._starts[pos[hit]]
+                counts = self._counts[pos[hit]]
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                point_parts.append(np.repeat(points[hit], counts))
+                cell_parts.append(self._order[np.repeat(starts, counts) + offsets])
+
+        if not point_parts:
+            return empty
+
+        point_idx = np.concatenate(point_parts)
+        cell_idx = np.concatenate(cell_parts)
+
+        # Exact distance filter on the candidates
+        dist2 = (self.x[cell_idx] - x[point_idx]) ** 2 + (self.y[cell_idx] - y[point_idx]) ** 2
+        keep = dist2 <= radius ** 2
+        return point_idx[keep], cell_idx[keep]
+
+
+class PolygonIndex:
+    """Grid-bucket index over polygon bounding boxes for batched point-in-polygon lookups.
+
+    Every polygon is registered in all square buckets its bounding box overlaps. Points are tested
+    against the bounding boxes in their own bucket, which is exact for axis-aligned rectangles like
+    single NDVI pixels. Only candidates of other shapes, e.g. merged patches, get a shapely test.
+    """
+
+    def __init__(self, polygons, bounds=None, bucket_size=None):
+        """Create a new polygon index.
+        :param polygons:    Sequence of Shapely Polygons.
+        :param bounds:      Optional array with (minx, miny, maxx, maxy) per polygon.
+        :param bucket_size: Width of the square buckets, defaults to the median polygon size.
+        """
+        self.polygons = list(polygons)
+        if bounds is None:
+            bounds = [polygon.bounds for polygon in self.polygons]
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        if len(self.bounds) != len(self.polygons):
+            raise ValueError("polygons and bounds must have the same length")
+
+        # Polygons that fill their bounding box need no exact test
+        minx, miny, maxx, maxy = self.bounds.T
+        box_area = (maxx - minx) * (maxy - miny)
+        area = np.array([polygon.area for polygon in self.polygons], dtype=float)
+        self._is_box = np.isclose(area, box_area, rtol=1e-9, atol=0)
+
+        if len(self.polygons) == 0:
+            self._keys_sorted = np.empty(0, dtype=np.int64)
+            return
+
+        if bucket_size is None:
+            bucket_size = np.median(np.maximum(maxx - minx, maxy - miny))
+        self.bucket_size = float(bucket_size) if bucket_size > 0 else 1.0
+        self._origin = (minx.min(), miny.min())
+
+        # Register every polygon in all buckets its bounding box overlaps
+        bx0, by0 = self._buckets(minx, miny)
+        bx1, by1 = self._buckets(maxx, maxy)
+        self._n_bx, self._n_by = int(bx1.max()) + 1, int(by1.max()) + 1
+        heights = by1 - by0 + 1
+        counts = (bx1 - bx0 + 1) * heights
+        members = np.repeat(np.arange(len(self.polygons)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = ((bx0[members] + offsets // heights[members]) * self._n_by
+                + by0[members] + offsets % heights[members])
+
+        order = np.argsort(keys, kind='stable')
+        self._members = members[order]
+        self._keys_sorted, self._starts, self._counts = np.unique(
+            keys[order], return_index=True, return_counts=True)
+
+    def _buckets(self, x, y):
+        bx = np.floor((x - self._origin[0]) / self.bucket_size).astype(np.int64)
+        by = np.floor((y - self._origin[1]) / self.bucket_size).astype(np.int64)
+        return bx, by
+
+    def locate(self, x, y) -> np.ndarray:
+        """Find the polygon under many points at once.
+        :param x: Array with x coordinates.
+        :param y: Array with y coordinates.
+
+        Returns: Array with the position of the first polygon containing or touching each point,
+                 -1 where a point lies outside all polygons.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        located = np.full(x.shape, -1, dtype=np.int64)
+        if x.size == 0 or len(self._keys_sorted) == 0:
+            return located
+
+        # Candidate polygons from the bucket of every point
+        bx, by = self._buckets(x, y)
+        valid = (bx >= 0) & (bx < self._n_bx) & (by >= 0) & (by < self._n_by)
+        keys = bx * self._n_by + by
+        pos = np.minimum(np.searchsorted(self._keys_sorted, keys), len(self._keys_sorted) - 1)
+        hit = valid & (self._keys_sorted[pos] == keys)
+
+        starts = self._starts[pos[hit]]
+        counts = self._counts[pos[hit]]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        point_idx = np.repeat(np.flatnonzero(hit), counts)
+        polygon_idx = self._members[np.repeat(starts, counts) + offsets]
+
+        # Bounding box test, exact for rectangles
+        minx, miny, maxx, maxy = self.bounds[polygon_idx].T
+        px, py = x[point_idx], y[point_idx]
+        inside = (px >= minx) & (px <= maxx) & (py >= miny) & (py <= maxy)
+
+        # Exact test for the remaining candidates of other shapes
+        exact = np.flatnonzero(inside & ~self._is_box[polygon_idx])
+        for pair in exact:
+            inside[pair] = self.polygons[polygon_idx[pair]].intersects(Point(px[pair], py[pair]))
+
+        # Points on a shared edge touch several polygons; the first one wins
+        point_idx, polygon_idx = point_idx[inside], polygon_idx[inside]
+        first = np.full(x.shape, len(self.polygons), dtype=np.int64)
+        np.minimum.at(first, point_idx, polygon_idx)
+        found = first < len(self.polygons)
+        located[found] = first[found]
+        return located
+
+
+def best_cells(point_idx, cell_idx, values, n_points) -> np.ndarray:
+    """Pick the cell with the highest value for every query point.
+    :param point_idx: Array with query point positions, as returned by CentroidIndex.query_radius.
+    :param cell_idx:  Array with matching cell positions.
+    :param values:    Array with the value of every cell.
+    :param n_points:  Number of query points.
+
+    Returns: Array with the best cell position per point, or -1 where no cell was found.
+    """
+    best = np.full(n_points, -1, dtype=np.int64)
+    if len(point_idx) == 0:
+        return best
+
+    # Sort by point, then descending value, then cell order; first entry per point wins
+    order = np.lexsort((cell_idx, -values[cell_idx], point_idx))
+    points_sorted = point_idx[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = points_sorted[1:] != points_sorted[:-1]
+    best[points_sorted[first]] = cell_idx[order][first]
+    return best
+
+
+class SplitGeoSpace(GeoSpace):
+    """GeoSpace with a static R-tree for stationary agents and a dynamic R-tree for moving agents.
+
+    The static index is bulk-loaded once. The dynamic index (self.idx) is kept up to date by
+    refresh(), which only touches agents whose shape object has been replaced since the last call.
+    """
+
+    def __init__(self, crs="epsg:3857", reload_fraction=0.05):
+        """Create a new split GeoSpace.
+        :param crs:             Coordinate reference system of the GeoSpace.
+        :param reload_fraction: Fraction of moved dynamic agents above which refresh() bulk-reloads
+                                the dynamic index instead of deleting and inserting single agents.
+                                Single R-tree updates cost roughly 20 bulk-loaded entries.
+        """
+        super().__init__(crs=crs)
+        self.reload_fraction = reload_fraction
+
+        self.static_idx = index.Index()
+        # Static agents in index order, the static index holds their positions
+        self._static_agents = []
+        self._static_positions = {}
+        # Lock around queries of a static index that is shared with other spaces, None for our own
+        self._static_lock = None
+        # Shapes as they are currently stored in the dynamic index
+        self._indexed_shapes = {}
+
+    @staticmethod
+    def static_index(bounds):
+        """Bulk-load an R-tree over the bounds of stationary agents, keyed by their position.
+        The index can be shared by spaces that hold the same agents, see add_static_agents.
+        :param bounds: Array with (minx, miny, maxx, maxy) per agent.
+
+        Returns: rtree Index.
+        """
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 4).tolist()
+        if not bounds:
+            # Bulk loading needs at least one entry
+            return index.Index()
+        return index.Index((pos, tuple(agent_bounds), None) for pos, agent_bounds in enumerate(bounds))
+
+    def add_static_agents(self, agents, bounds=None, shared_index=None, lock=None) -> None:
+        """Bulk-load agents that never move into the static index.
+        :param agents: List of GeoAgents.
+        :param bounds: Optional array with (minx, miny, maxx, maxy) per agent, e.g. from
+                       GeoSeries.bounds, to avoid asking every shape for its bounds.
+        :param shared_index: Optional index from static_index() over the bounds of these agents, in
+                             this order, to use instead of building one. It is never modified.
+        :param lock: Lock to hold while querying the shared index, when other threads query it too.
+        """
+        agents = list(agents)
+        if shared_index is not None:
+            if self._static_agents:
+                raise ValueError("A shared static index must hold all static agents")
+            self.static_idx = shared_index
+            self._static_lock = lock
+        else:
+            if bounds is None:
+                bounds = [agent.shape.bounds for agent in agents]
+            else:
+                bounds = [tuple(agent_bounds) for agent_bounds in np.asarray(bounds, dtype=float).tolist()]
+            bounds = [agent.shape.bounds for agent in self._static_agents] + bounds
+            agents = self._static_agents + agents
+            self.static_idx = self.static_index(bounds)
+            self._static_lock = None
+
+        self._static_agents = agents
+        self._static_positions = {id(agent): pos for pos, agent in enumerate(agents)}
+        self.update_bbox()
+
+    def add_agents(self, agents):
+        """Add a list or a single moving GeoAgent to the dynamic index."""
+        super().add_agents(agents)
+        if isinstance(agents, GeoAgent):
+            agents = [agents]
+        self._indexed_shapes.update((id(agent), agent.shape) for agent in agents)
+
+    def remove_agent(self, agent):
+        """Remove an agent from the GeoSpace."""
+        if id(agent) in self._static_positions:
+            # Positions shift and a shared index must stay as it is, so the others are indexed anew
+            remaining = [static for static in self._static_agents if static is not agent]
+            self._static_agents = []
+            self.add_static_agents(remaining)
+        else:
+            shape = self._indexed_shapes.pop(id(agent))
+            self.idx.delete(id(agent), shape.bounds)
+            del self.idx.agents[id(agent)]
+        self.update_bbox()
+
+    def _recreate_rtree(self, new_agents=None):
+        """Bulk-reload the dynamic index from the current agent shapes."""
+        agents = list(self.idx.agents.values()) + list(new_agents or [])
+        index_data = ((id(agent), agent.shape.bounds, None) for agent in agents)
+        self.idx = index.Index(index_data)
+        self.idx.agents = {id(agent): agent for agent in agents}
+        self._indexed_shapes = {id(agent): agent.shape for agent in agents}
+
+    def refresh(self) -> int:
+        """Update the dynamic index for agents whose shape changed.
+
+        Returns: Number of agents that had moved.
+        """
+        moved = [agent for agent in self.idx.agents.values()
+                 if agent.shape is not self._indexed_shapes[id(agent)]]
+        if not moved:
+            return 0
+
+        if len(moved) > self.reload_fraction * len(self.idx.agents):
+            self._recreate_rtree()
+        else:
+            for agent in moved:
+                self.idx.delete(id(agent), self._indexed_shapes[id(agent)].bounds)
+                self.idx.insert(id(agent), agent.shape.bounds, None)
+                self._indexed_shapes[id(agent)] = agent.shape
+        self.update_bbox()
+        return len(moved)
+
+    def _get_rtree_intersections(self, shape):
+        """Calculate rtree intersections for candidate agents in both indices."""
+        if self._static_lock is None:
+            positions = self.static_idx.intersection(shape.bounds)
+        else:
+            with self._static_lock:
+                positions = list(self.static_idx.intersection(shape.bounds))
+        static = (self._static_agents[i] for i in positions)
+        dynamic = (self.idx.agents[i] for i in self.idx.intersection(shape.bounds))
+        return chain(static, dynamic)
+
+    def update_bbox(self, bbox=None):
+        """Update bounding box of the GeoSpace, over both indices."""
+        if bbox:
+            self.bbox = bbox
+            return
+
+        bounds = [idx.bounds for idx, agents in ((self.static_idx, self._static_agents), (self.idx, self.idx.agents))
+                  if agents]
+        if not bounds:
+            self.bbox = None
+        else:
+            self.bbox = [min(b[0] for b in bounds), min(b[1] for b in bounds),
+                         max(b[2] for b in bounds), max(b[3] for b in bounds)]
+
+    @property
+    def agents(self):
+        return self._static_agents + list(self.idx.agents.values())
@@ -0,0 +1,352 @@
+"""
+
+Use this file to relate the census blocks and flight strips to NDVI cells, observations and model output.
+
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import geopandas as gp
+import pandas as pd
+import pyarrow as pa
+from spatial import points_within
+from preprocess import cache_path, block_path, flight_path, get_block_data, get_track_data, get_census_store
+
+# Width in metres of the strip observed under each flight line
+STRIP_WIDTH = 300.0
+
+# Bump when the layout of the coverage file changes
+COVERAGE_VERSION = 1
+
+# Upper limit on the number of cells of the lookup grid for model positions
+COVERAGE_MAX_CELLS = 1000000
+
+# Sets of points the index covers, stored one after the other
+COVERAGE_KINDS = ('cell', 'observation', 'grid')
+
+COVERAGE_SCHEMA = pa.schema([('block', pa.int32()),
+                             ('strip', pa.int32())])
+
+
+def flight_strips(tracks, strip_width=STRIP_WIDTH, crs=None) -> gp.GeoSeries:
+    """Buffer the flight lines into the strips observed from the plane.
+    Lines in a geographic CRS are buffered in their UTM zone, so the width is in metres.
+    :param tracks: GeoDataFrame with flight lines, e.g. from get_track_data.
+    :param strip_width: Total width of a strip, in metres.
+    :param crs: CRS of the returned strips, defaults to the one of the tracks.
+
+    Returns: GeoSeries with one strip per flight line, in track order.
+    """
+
+    lines = tracks.geometry
+    if lines.crs is not None and lines.crs.is_geographic:
+        strips = lines.to_crs(lines.estimate_utm_crs()).buffer(strip_width / 2).to_crs(lines.crs)
+    else:
+        strips = lines.buffer(strip_width / 2)
+    return strips if crs is None or strips.crs is None else strips.to_crs(crs)
+
+
+def cover_points(x, y, polygons) -> np.ndarray:
+    """Find the first polygon covering each of many points.
+    Candidates come from one bulk query of the polygons against an R-tree over the points; each
+    polygon then tests its candidates at once.
+    :param x: Array with x coordinates.
+    :param y: Array with y coordinates.
+    :param polygons: GeoSeries of polygons.
+
+    Returns: Array with the position of the first polygon containing each point, -1 if none.
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    first = np.full(x.shape, len(polygons), dtype=np.int64)
+    if x.size == 0 or len(polygons) == 0:
+        return np.full(x.shape, -1, dtype=np.int64)
+
+    points = gp.GeoSeries(gp.points_from_xy(x, y))
+    if hasattr(points.sindex, 'query_bulk'):
+        # geopandas < 1.0, whose query takes a single geometry
+        polygon_idx, point_idx = points.sindex.query_bulk(polygons.geometry.values)
+    else:
+        # geopandas >= 1.0
+        polygon_idx, point_idx = points.sindex.query(polygons.geometry.values)
+    order = np.argsort(polygon_idx, kind='stable')
+    polygon_idx, point_idx = polygon_idx[order], point_idx[order]
+
+    # Pairs grouped by polygon
+    starts = np.flatnonzero(np.diff(polygon_idx, prepend=-1))
+    stops = np.append(starts[1:], len(polygon_idx))
+    geometries = polygons.geometry.tolist()
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        polygon = int(polygon_idx[start])
+        candidates = point_idx[start:stop]
+        inside = candidates[points_within(geometries[polygon], x[candidates], y[candidates])]
+        first[inside] = np.minimum(first[inside], polygon)
+
+    return np.where(first < len(polygons), first, -1)
+
+
+def _cover_grid(origin, resolution, shape, polygons) -> np.ndarray:
+    """Find the first polygon covering each cell center of a regular grid.
+    The candidates of a polygon are the cells within its bounds, so no point tree is needed.
+
+    Returns: Array of the grid's shape with polygon positions, -1 if none.
+    """
+
+    height, width = shape
+    first = np.full(shape, len(polygons), dtype=np.int64)
+    for polygon, geometry in enumerate(polygons.geometry.tolist()):
+        minx, miny, maxx, maxy = geometry.bounds
+        col0 = max(int(np.floor((minx - origin[0]) / resolution - 0.5)), 0)
+        col1 = min(int(np.ceil((maxx - origin[0]) / resolution - 0.5)), width - 1)
+        row0 = max(int(np.floor((miny - origin[1]) / resolution - 0.5)), 0)
+        row1 = min(int(np.ceil((maxy - origin[1]) / resolution - 0.5)), height - 1)
+        if col0 > col1 or row0 > row1:
+            continue
+
+        rows, cols = np.mgrid[row0:row1 + 1, col0:col1 + 1]
+        x = origin[0] + (cols + 0.5) * resolution
+        y = origin[1] + (rows + 0.5) * resolution
+        inside = points_within(geometry, x, y)
+        window = first[row0:row1 + 1, col0:col1 + 1]
+        window[inside] = np.minimum(window[inside], polygon)
+
+    return np.where(first < len(polygons), first, -1)
+
+
+class CoverageIndex:
+    """Census block and flight strip of every NDVI cell, census observation and model position.
+
+    Blocks and strips of the NDVI cells and observations are looked up once, exactly. Model positions
+    change every step, so they are looked up in a grid of precomputed cell centers instead: one array
+    index per animal and no geometry test, at the cost of misplacing animals within half a grid cell of
+    a block or strip edge. Blocks and strips are numbered by their position in the block and track data.
+    """
+
+    def __init__(self, table):
+        """Create a new coverage index.
+        :param table: pa.Table with COVERAGE_SCHEMA and the layout in its metadata, as built by build.
+        """
+        self.table = table
+        meta = json.loads(table.schema.metadata[b'coverage'])
+        self.block_ids = meta['block_ids']
+        self.n_strips = meta['n_strips']
+        self.strip_width = meta['strip_width']
+        self.crs = meta['crs']
+        self.cells_digest = meta['cells_digest']
+        self.origin = tuple(meta['origin'])
+        self.resolution = meta['resolution']
+        self.grid_shape = tuple(meta['grid_shape'])
+
+        block = table.column('block').chunk(0).to_numpy(zero_copy_only=True)
+        strip = table.column('strip').chunk(0).to_numpy(zero_copy_only=True)
+        self._parts = {kind: slice(start, stop) for kind, start, stop in meta['partitions']}
+        self.cell_block, self.cell_strip = block[self._parts['cell']], strip[self._parts['cell']]
+        self.observation_block = block[self._parts['observation']]
+        self.observation_strip = strip[self._parts['observation']]
+        self.grid_block = block[self._parts['grid']].reshape(self.grid_shape)
+        self.grid_strip = strip[self._parts['grid']].reshape(self.grid_shape)
+
+    @classmethod
+    def build(cls, cell_x, cell_y, blocks, tracks, observation_x=(), observation_y=(), crs=None,
+              strip_width=STRIP_WIDTH, resolution=None, max_cells=COVERAGE_MAX_CELLS):
+        """Build the index.
+        :param cell_x: Array with x coordinates of a point in every NDVI cell, in model order.
+        :param cell_y: Array with y coordinates of a point in every NDVI cell.
+        :param blocks: GeoDataFrame with census blocks.
+        :param tracks: GeoDataFrame with flight lines.
+        :param observation_x: Array with x coordinates of the census observations, in census store order.
+        :param observation_y: Array with y coordinates of the census observations.
+        :param crs: CRS of all coordinates, defaults to the one of the blocks.
+        :param strip_width: Total width of a flight strip, in metres.
+        :param resolution: Cell size of the lookup grid for model positions. Defaults to the finest
+                           that keeps the grid within max_cells.
+        :param max_cells: Upper limit on the number of grid cells.
+
+        Returns: CoverageIndex
+        """
+
+        crs = crs or blocks.crs.to_string()
+        blocks = blocks.to_crs(crs) if blocks.crs is not None else blocks
+        strips = flight_strips(tracks, strip_width, crs)
+
+        # Lookup grid over the blocks
+        minx, miny, maxx, maxy = blocks.total_bounds
+        extent = max(maxx - minx, maxy - miny)
+        resolution = max(resolution or 0, extent / np.sqrt(max_cells)) or 1.0
+        shape = (int(np.ceil((maxy - miny) / resolution)) or 1, int(np.ceil((maxx - minx) / resolution)) or 1)
+
+        cell_x, cell_y = np.asarray(cell_x, dtype=float), np.asarray(cell_y, dtype=float)
+        observation_x, observation_y = np.asarray(observation_x, dtype=float), np.asarray(observation_y, dtype=float)
+        columns = {'block': [], 'strip': []}
+        for polygons, name in ((blocks, 'block'), (strips, 'strip')):
+            columns[name].append(cover_points(cell_x, cell_y, polygons))
+            columns[name].append(cover_points(observation_x, observation_y, polygons))
+            columns[name].append(_cover_grid((minx, miny), resolution, shape, polygons).ravel())
+
+        lengths = [len(cell_x), len(observation_x), shape[0] * shape[1]]
+        stops = np.cumsum(lengths).tolist()
+        meta = {'version': COVERAGE_VERSION,
+                'block_ids': [str(block_id) for block_id in blocks.index],
+                'n_strips': len(strips),
+                'strip_width': strip_width,
+                'crs': crs,
+                'cells_digest': cells_digest(cell_x, cell_y),
+                'origin': [float(minx), float(miny)],
+                'resolution': float(resolution),
+                'grid_shape': list(shape),
+                'partitions': [[kind, stop - length, stop]
+                               for kind, length, stop in zip(COVERAGE_KINDS, lengths, stops)]}
+
+        table = pa.Table.from_arrays([pa.array(np.concatenate(columns[name]).astype(np.int32))
+                                      for name in ('block', 'strip')], schema=COVERAGE_SCHEMA)
+        return cls(table.replace_schema_metadata({'coverage': json.dumps(meta)}))
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save, memory mapped.
+        :param path: Location of the coverage file.
+
+        Returns: CoverageIndex, or None if the file has another version.
+        """
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        if json.loads(table.schema.metadata[b'coverage'])['version'] != COVERAGE_VERSION:
+            return None
+        return cls(table.combine_chunks())
+
+    def save(self, path) -> None:
+        """Write the index as an uncompressed Arrow IPC file, which can be memory mapped.
+        :param path: Location of the coverage file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_file, 'wb') as sink:
+            with pa.ipc.new_file(sink, self.table.schema) as writer:
+                writer.write_table(self.table)
+        os.replace(tmp_file, path)
+
+    def lookup(self, x, y):
+        """Find the block and strip of many model positions at once, from the lookup grid.
+        :param x: Array with x coordinates.
+        :param y: Array with y coordinates.
+
+        Returns: (block, strip): Integer arrays with block and strip positions, -1 where there is none.
+        """
+        cols = np.floor((np.asarray(x, dtype=float) - self.origin[0]) / self.resolution).astype(np.int64)
+        rows = np.floor((np.asarray(y, dtype=float) - self.origin[1]) / self.resolution).astype(np.int64)
+        height, width = self.grid_shape
+        on_grid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+        block = np.full(cols.shape, -1, dtype=np.int64)
+        strip = np.full(cols.shape, -1, dtype=np.int64)
+        block[on_grid] = self.grid_block[rows[on_grid], cols[on_grid]]
+        strip[on_grid] = self.grid_strip[rows[on_grid], cols[on_grid]]
+        return block, strip
+
+    def block_totals(self, block, counts, strip=None) -> np.ndarray:
+        """Sum counts per block, e.g. of animals located with lookup.
+        :param block: Array with the block position of every count, -1 outside all blocks.
+        :param counts: Array with the counts.
+        :param strip: Optional array with strip positions; only counts inside a strip are summed.
+
+        Returns: Array with the total per block, in block order.
+        """
+        keep = block >= 0
+        if strip is not None:
+            keep &= strip >= 0
+        return np.bincount(block[keep], weights=np.asarray(counts, dtype=float)[keep],
+                           minlength=len(self.block_ids))
+
+    def observed_totals(self, store, year, species) -> np.ndarray:
+        """Sum the census counts of some species per block.
+        :param store: CensusStore the observations of the index were taken from.
+        :param year: Census year.
+        :param species: Species code, or a sequence of codes to sum.
+
+        Returns: Array with the observed count per block, in block order.
+        """
+        species = [species] if isinstance(species, str) else species
+        totals = np.zeros(len(self.block_ids))
+        for name in species:
+            part = store.partitions[(year, name)]
+            totals += self.block_totals(self.observation_block[part], store.columns['count'][part])
+        return totals
+
+    def compare(self, model, store, year, species=None) -> pd.DataFrame:
+        """Compare the animals of a model with the census, block by block.
+        :param model: AnimalModel to count.
+        :param store: CensusStore the observations of the index were taken from.
+        :param year: Census year to compare with.
+        :param species: Species to include, defaults to all species of the model.
+
+        Returns: DataFrame indexed by block with observed, simulated and simulated_in_strip counts: what the
+                 census saw, where the model puts the animals, and what a survey along the flight strips
+                 would see of them.
+        """
+        species = list(model.species) if species is None else species
+        x, y, counts = model.animal_positions()
+        block, strip = self.lookup(x, y)
+
+        keep = np.zeros(len(x), dtype=bool)
+        for name in species:
+            keep[model.species_slices[name]] = True
+        counts = np.where(keep, counts, 0)
+
+        return pd.DataFrame({'observed': self.observed_totals(store, year, species),
+                             'simulated': self.block_totals(block, counts),
+                             'simulated_in_strip': self.block_totals(block, counts, strip)},
+                            index=pd.Index(self.block_ids, name='block'))
+
+
+def cells_digest(cell_x, cell_y) -> str:
+    """Fingerprint of the NDVI cells an index was built for."""
+    digest = hashlib.blake2b(digest_size=16)
+    for values in (cell_x, cell_y):
+        digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def get_coverage_index(gdf_ndvi, strip_width=STRIP_WIDTH, resolution=None) -> CoverageIndex:
+    """Coverage index of an NDVI layer, the 2017 blocks and flight lines, and all census observations.
+    Built with the first call and kept in the cache directory; rebuilt for other NDVI cells, another
+    strip width, or newer block, track or census data.
+    :param gdf_ndvi: GeoDataFrame with NDVI patches, in the CRS of the model.
+    :param strip_width: Total width of a flight strip, in metres.
+    :param resolution: Cell size of the lookup grid for model positions.
+
+    Returns: CoverageIndex
+    """
+
+    cell_points = gdf_ndvi.geometry.representative_point()
+    cell_x, cell_y = cell_points.x.to_numpy(), cell_points.y.to_numpy()
+    digest = cells_digest(cell_x, cell_y)
+
+    name = f'coverage_{digest}_{strip_width:g}' + ('' if resolution is None else f'_{resolution:g}')
+    coverage_file = os.path.join(cache_path, name + '.arrow')
+    store = get_census_store()
+    store_file = os.path.join(cache_path, 'census_store.arrow')
+    sources = [os.path.join(block_path, 'blocks_2017.shp'), os.path.join(flight_path, 'Flightlines_2017.shp'),
+               store_file]
+    if os.path.exists(coverage_file) and all(
+            os.path.getmtime(coverage_file) > os.path.getmtime(src) for src in sources if os.path.exists(src)):
+        index = CoverageIndex.load(coverage_file)
+        if index is not None:
+            return index
+
+    # Observations in the CRS of the model, reprojected per partition as census years may differ in CRS
+    observation_x, observation_y = store.columns['x'].copy(), store.columns['y'].copy()
+    if gdf_ndvi.crs is not None:
+        for key, part in store.partitions.items():
+            points = gp.GeoSeries(gp.points_from_xy(observation_x[part], observation_y[part]),
+                                  crs=store.partition_crs[key]).to_crs(gdf_ndvi.crs)
+            observation_x[part], observation_y[part] = points.x.to_numpy(), points.y.to_numpy()
+
+    crs = gdf_ndvi.crs.to_string() if gdf_ndvi.crs is not None else None
+    index = CoverageIndex.build(cell_x, cell_y, get_block_data(), get_track_data(),
+                                observation_x, observation_y, crs=crs,
+                                strip_width=strip_width, resolution=resolution)
+    index.save(coverage_file)
+    print("Coverage index built!")
+    return CoverageIndex.load(coverage_file)
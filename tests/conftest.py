@@ -0,0 +1,69 @@
+"""
+
+Use this file for the fixtures shared by the tests: small synthetic census, NDVI and survey data.
+
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# The modules of the model live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Side of the synthetic study area, in CRS units
+EXTENT = 10.0
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Run in a temporary directory holding a synthetic survey polygon."""
+    gp = pytest.importorskip("geopandas")
+    from shapely.geometry import box
+    model = pytest.importorskip("model")
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(model.polygon_path)
+    gp.GeoDataFrame(geometry=[box(-0.1, -0.1, EXTENT + 0.1, EXTENT + 0.1)], crs="epsg:4326").to_file(
+        os.path.join(model.polygon_path, 'Census2017Polygon-filled.shp'))
+    model.get_survey_polygon.cache_clear()
+    model.get_map_coords.cache_clear()
+    yield tmp_path
+    model.get_survey_polygon.cache_clear()
+    model.get_map_coords.cache_clear()
+
+
+def make_ndvi(n_side=10, seed=0):
+    """Square NDVI patches covering the study area, with random values."""
+    import geopandas as gp
+    from shapely.geometry import box
+
+    rng = np.random.default_rng(seed)
+    size = EXTENT / n_side
+    cells = [box(i * size, j * size, (i + 1) * size, (j + 1) * size) for i in range(n_side) for j in range(n_side)]
+    return gp.GeoDataFrame({'value': rng.uniform(-1, 1, len(cells))}, geometry=cells, crs="epsg:4326",
+                           index=pd.Index([f'NDVI{i}' for i in range(len(cells))]))
+
+
+def make_animals(n_animals=40, animal_name='EL', seed=0):
+    """Animal observations spread over the study area, with counts."""
+    import geopandas as gp
+
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0.5, EXTENT - 0.5, (n_animals, 2))
+    return gp.GeoDataFrame({animal_name: rng.integers(1, 20, n_animals)},
+                           geometry=gp.points_from_xy(xy[:, 0], xy[:, 1]), crs="epsg:4326",
+                           index=pd.Index([f'Obs{i}' for i in range(n_animals)]))
+
+
+@pytest.fixture
+def ndvi_gdf():
+    pytest.importorskip("geopandas")
+    return make_ndvi()
+
+
+@pytest.fixture
+def animals():
+    pytest.importorskip("geopandas")
+    return make_animals()
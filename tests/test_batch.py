@@ -0,0 +1,54 @@
+import contextlib
+import io
+import pytest
+from conftest import make_animals, make_ndvi
+
+
+def run(batch, params, steps=3):
+    datasets = {('census', 2017): {'EL': make_animals()}, ('ndvi', True): make_ndvi()}
+    params = dict({'year': 2017, 'species': 'EL', 'cloudmask': True, 'mobility_range': 0.3, 'replicate': 0}, **params)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return batch.run_model(params, steps, datasets)
+
+
+def read_table(path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if str(path).endswith('.arrow'):
+        with pa.OSFile(str(path), 'rb') as source:
+            return pa.ipc.open_file(source).read_all()
+    return pq.read_table(str(path))
+
+
+@pytest.mark.parametrize("ext", [".arrow", ".parquet"])
+def test_statistics_are_written_next_to_the_trajectories(workspace, ext):
+    batch = pytest.importorskip("batch")
+    import recorder
+
+    run(batch, {'record_path': str(workspace / ('run' + ext))})
+
+    assert read_table(workspace / ('run' + ext)).column_names == recorder.TRAJECTORY_SCHEMA.names
+    assert read_table(workspace / ('run.stats' + ext)).column_names == recorder.STATS_SCHEMA.names
+
+
+def test_resumed_run_records_into_files_of_its_own(workspace):
+    batch = pytest.importorskip("batch")
+    params = {'movement_noise': 0.1, 'checkpoint_path': str(workspace / 'run.ckpt'),
+              'record_path': str(workspace / 'run.arrow')}
+
+    # Interrupted after two steps, then resumed
+    run(batch, params, steps=2)
+    resumed = run(batch, params, steps=4)
+    uninterrupted = run(batch, {'movement_noise': 0.1, 'record_path': str(workspace / 'full.arrow')}, steps=4)
+
+    assert read_table(workspace / 'run.arrow').column('step').unique().to_pylist() == [0, 1, 2]
+    assert read_table(workspace / 'run.step2.arrow').column('step').unique().to_pylist() == [2, 3, 4]
+    assert read_table(workspace / 'run.step2.stats.arrow').column('step').to_pylist() == [2, 3, 4]
+    assert (resumed['mean_x'], resumed['mean_y']) == pytest.approx((uninterrupted['mean_x'], uninterrupted['mean_y']))
+
+    # A finished run leaves the recorded files alone
+    files = sorted(p.name for p in workspace.iterdir())
+    run(batch, params, steps=4)
+    assert sorted(p.name for p in workspace.iterdir()) == files
+    assert read_table(workspace / 'run.step2.arrow').column('step').unique().to_pylist() == [2, 3, 4]
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+MODES = ["stay", "clamp", "slide"]
+
+
+@pytest.fixture
+def polygon():
+    from shapely.geometry import Polygon
+    # L-shaped area, with a concave corner
+    return Polygon([(0, 0), (10, 0), (10, 4), (4, 4), (4, 10), (0, 10)])
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-2, 12, n), rng.uniform(-2, 12, n)
+
+
+def test_contains_matches_shapely(polygon):
+    boundary = pytest.importorskip("boundary")
+    from shapely.geometry import Point
+    x, y = random_points(2000)
+    # Points on the border and exactly on mask cell corners too
+    x = np.concatenate([x, [0, 5, 10, 4, 2, 4.0]])
+    y = np.concatenate([y, [5, 0, 4, 7, 10, 4.0]])
+
+    expected = [Point(px, py).within(polygon) for px, py in zip(x, y)]
+    np.testing.assert_array_equal(boundary.SurveyBoundary(polygon, resolution=0.5).contains(x, y), expected)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_moves_end_inside(polygon, mode):
+    boundary = pytest.importorskip("boundary")
+    survey = boundary.SurveyBoundary(polygon, resolution=0.25, mode=mode)
+    rng = np.random.default_rng(1)
+    x, y = random_points(2000, seed=2)
+    start = survey.contains(x, y)
+    x, y = x[start], y[start]
+    new_x, new_y = x + rng.normal(0, 3, len(x)), y + rng.normal(0, 3, len(y))
+
+    moved_x, moved_y = survey.move(x, y, new_x, new_y)
+
+    assert survey.contains(moved_x, moved_y).all()
+    # Moves that stay inside are left alone
+    free = survey.contains(new_x, new_y)
+    np.testing.assert_array_equal(moved_x[free], new_x[free])
+    np.testing.assert_array_equal(moved_y[free], new_y[free])
+
+
+def test_clamp_stops_at_the_boundary(polygon):
+    boundary = pytest.importorskip("boundary")
+    x, y = np.array([2.0]), np.array([2.0])
+
+    stay_x, stay_y = boundary.SurveyBoundary(polygon, mode="stay").move(x, y, [-2.0], [2.0])
+    clamp_x, clamp_y = boundary.SurveyBoundary(polygon, mode="clamp").move(x, y, [-2.0], [2.0])
+
+    assert (stay_x[0], stay_y[0]) == (2.0, 2.0)
+    assert clamp_x[0] == pytest.approx(0.0, abs=1e-4)
+    assert clamp_y[0] == 2.0
+
+
+def test_slide_follows_the_boundary(polygon):
+    boundary = pytest.importorskip("boundary")
+    # Diagonal move out through the left edge keeps its upward part
+    x, y = boundary.SurveyBoundary(polygon, mode="slide").move([1.0], [2.0], [-1.0], [5.0])
+
+    assert x[0] == pytest.approx(0.0, abs=1e-3)
+    assert 2.0 < y[0] <= 5.0
+
+
+def test_unknown_mode_raises(polygon):
+    boundary = pytest.importorskip("boundary")
+    with pytest.raises(ValueError, match="mode"):
+        boundary.SurveyBoundary(polygon, mode="bounce")
@@ -0,0 +1,65 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+from conftest import make_animals, make_ndvi
+
+checkpoint = pytest.importorskip("checkpoint")
+
+
+def build(model, **kwargs):
+    ndvi_gdf = make_ndvi()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return model.AnimalModel(make_animals(), ndvi_gdf, 'EL', ndvi_gdf['value'], mobility_range=0.3,
+                                 profile=False, **kwargs)
+
+
+def run_steps(model, steps):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(steps):
+            model.step()
+
+
+@pytest.mark.parametrize("engine", ["agent", "array"])
+def test_restored_model_continues_like_the_original(workspace, engine):
+    model = pytest.importorskip("model")
+    original = build(model, engine=engine, movement_noise=0.1, seed=3)
+    run_steps(original, 2)
+    checkpoint.write_checkpoint(original, str(workspace / 'model.ckpt'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        restored = checkpoint.restore_model(str(workspace / 'model.ckpt'), make_ndvi(), profile=False)
+    assert restored.steps == 2
+    assert (restored.engine, restored.movement_noise) == (engine, 0.1)
+
+    run_steps(original, 3)
+    run_steps(restored, 3)
+    for original_values, restored_values in zip(original.animal_positions(), restored.animal_positions()):
+        np.testing.assert_allclose(original_values, restored_values)
+    np.testing.assert_allclose(original.animal_ndvi_values(), restored.animal_ndvi_values())
+
+
+def test_restore_state_forks_replicates_by_seed(workspace):
+    model = pytest.importorskip("model")
+    warm = build(model, movement_noise=0.1)
+    run_steps(warm, 2)
+    state = checkpoint.model_state(warm)
+
+    forks = [build(model, movement_noise=0.1) for _ in range(3)]
+    for seed, fork in zip([1, 2, 1], forks):
+        checkpoint.restore_state(fork, state, seed=seed)
+        run_steps(fork, 1)
+
+    assert not np.allclose(forks[0].animal_positions()[0], forks[1].animal_positions()[0])
+    np.testing.assert_allclose(forks[0].animal_positions()[0], forks[2].animal_positions()[0])
+
+
+def test_restore_state_rejects_other_animals(workspace):
+    model = pytest.importorskip("model")
+    state = checkpoint.model_state(build(model))
+    ndvi_gdf = make_ndvi()
+    with contextlib.redirect_stdout(io.StringIO()):
+        other = model.AnimalModel(make_animals(n_animals=30), ndvi_gdf, 'EL', ndvi_gdf['value'], profile=False)
+
+    with pytest.raises(ValueError, match="other animals"):
+        checkpoint.restore_state(other, state)
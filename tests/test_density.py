@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import density
+
+BOUNDS = (0.0, 0.0, 10.0, 8.0)
+# Rows of the default grid over BOUNDS, whose longer side has DEFAULT_GRID_CELLS cells
+DENSITY_ROWS = int(np.ceil(8.0 / (10.0 / density.DEFAULT_GRID_CELLS)))
+
+
+def direct_smooth(grid, bandwidth, cell_size):
+    # Plain sum over all cell pairs, as a direct kernel density estimate on the grid nodes
+    kernel = density.gaussian_kernel(bandwidth, cell_size)
+    radius_y, radius_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    padded = np.pad(grid, ((radius_y, radius_y), (radius_x, radius_x)))
+    smoothed = np.zeros(grid.shape)
+    for row in range(grid.shape[0]):
+        for col in range(grid.shape[1]):
+            window = padded[row:row + kernel.shape[0], col:col + kernel.shape[1]]
+            smoothed[row, col] = np.sum(window * kernel[::-1, ::-1])
+    return smoothed
+
+
+def test_bin_points_keeps_the_weight_of_points_on_the_grid():
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-2, 12, 500), rng.uniform(-2, 10, 500)
+    # Corners and edges of the grid too
+    x = np.concatenate([x, [0.0, 10.0, 0.0, 10.0, 5.0]])
+    y = np.concatenate([y, [0.0, 8.0, 8.0, 0.0, 8.0]])
+    weights = rng.uniform(0, 5, len(x))
+
+    grid = density.bin_points(x, y, weights, BOUNDS, 0.5)
+
+    on_grid = (x >= 0) & (x <= 10) & (y >= 0) & (y <= 8)
+    assert grid.shape == (16, 20)
+    assert grid.sum() == pytest.approx(weights[on_grid].sum())
+    assert (grid >= 0).all()
+
+
+def test_bin_points_splits_a_point_between_the_nearest_cell_centers():
+    # A quarter cell right of the first center, halfway up between the first two rows
+    grid = density.bin_points([0.75], [1.0], [4.0], BOUNDS, 1.0)
+    np.testing.assert_allclose(grid[:2, :2], [[1.5, 0.5], [1.5, 0.5]])
+    assert grid.sum() == pytest.approx(4.0)
+
+
+@pytest.mark.parametrize("bandwidth", [(0.8, 0.8), (1.5, 0.6)])
+def test_fft_smooth_matches_direct_convolution(bandwidth):
+    grid = np.zeros((30, 40))
+    rng = np.random.default_rng(1)
+    grid[rng.integers(0, 30, 50), rng.integers(0, 40, 50)] = rng.uniform(1, 3, 50)
+
+    np.testing.assert_allclose(density.fft_smooth(grid, bandwidth, 0.5), direct_smooth(grid, bandwidth, 0.5),
+                               atol=1e-12)
+
+
+def test_density_surface_integrates_to_the_total_weight():
+    rng = np.random.default_rng(2)
+    x, y = rng.normal(5, 0.5, 200), rng.normal(4, 0.5, 200)
+    surface = density.density_surface(x, y, np.full(200, 2.0), bounds=BOUNDS, bandwidth=0.4, cell_size=0.1)
+
+    assert surface.total == pytest.approx(400.0)
+    assert surface.values.sum() * surface.cell_size ** 2 == pytest.approx(400.0, rel=1e-6)
+    assert surface.summary()['peak_x'] == pytest.approx(5, abs=0.3)
+
+
+def test_density_surface_without_points():
+    surface = density.density_surface([], [], bounds=BOUNDS)
+    assert surface.values.shape == (DENSITY_ROWS, density.DEFAULT_GRID_CELLS)
+    assert not surface.values.any()
+    assert surface.summary()['peak_density'] == 0.0
+
+    with pytest.raises(ValueError, match="bounds"):
+        density.density_surface([], [])
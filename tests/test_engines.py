@@ -0,0 +1,122 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+
+
+def build(model, animals, ndvi_gdf, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return model.AnimalModel(animals, ndvi_gdf, 'EL', ndvi_gdf['value'], mobility_range=0.3, profile=False,
+                                 **kwargs)
+
+
+@pytest.mark.parametrize("movement", ["global", "local"])
+def test_array_engine_matches_agent_engine(workspace, animals, ndvi_gdf, movement):
+    model = pytest.importorskip("model")
+    agent = build(model, animals, ndvi_gdf, engine="agent", movement=movement, search_radius=2.0)
+    array = build(model, animals, ndvi_gdf, engine="array", movement=movement, search_radius=2.0)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(5):
+            agent.step()
+            array.step()
+
+    for agent_values, array_values in zip(agent.animal_positions(), array.animal_positions()):
+        np.testing.assert_allclose(agent_values, array_values)
+    np.testing.assert_allclose(agent.animal_ndvi_values(), array.animal_ndvi_values())
+
+
+def test_animals_head_for_the_maximum_ndvi_patch(workspace, animals, ndvi_gdf):
+    model = pytest.importorskip("model")
+    array = build(model, animals, ndvi_gdf, engine="array")
+    best = ndvi_gdf.geometry.iloc[int(np.argmax(ndvi_gdf['value']))].centroid
+    x, y, _ = (values.copy() for values in array.animal_positions())
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        array.step()
+
+    # Animals that moved went a mobility_range fraction of the way to the best patch
+    new_x, new_y, _ = array.animal_positions()
+    moved = (new_x != x) | (new_y != y)
+    assert moved.any()
+    np.testing.assert_allclose(new_x[moved], x[moved] + 0.3 * (best.x - x[moved]))
+    np.testing.assert_allclose(new_y[moved], y[moved] + 0.3 * (best.y - y[moved]))
+
+
+def test_movement_noise_is_seeded_and_the_same_for_both_engines(workspace, animals, ndvi_gdf):
+    model = pytest.importorskip("model")
+    runs = {}
+    for engine, seed in [("agent", 1), ("array", 1), ("array", 2)]:
+        m = build(model, animals, ndvi_gdf, engine=engine, seed=seed, movement_noise=0.05)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(4):
+                m.step()
+        runs[engine, seed] = m.animal_positions()[0].copy()
+
+    np.testing.assert_allclose(runs["agent", 1], runs["array", 1])
+    # Replicates differ only by their seed
+    assert not np.allclose(runs["array", 1], runs["array", 2])
+
+
+def test_models_in_one_process_keep_their_own_random_numbers(workspace, animals, ndvi_gdf):
+    model = pytest.importorskip("model")
+    alone = build(model, animals, ndvi_gdf, seed=1, movement_noise=0.05)
+    interleaved = build(model, animals, ndvi_gdf, seed=1, movement_noise=0.05)
+    with contextlib.redirect_stdout(io.StringIO()):
+        alone.step()
+        alone.step()
+        interleaved.step()
+        # Building and stepping another model in between must not touch its generator
+        other = build(model, animals, ndvi_gdf, seed=2, movement_noise=0.05)
+        other.step()
+        interleaved.step()
+    np.testing.assert_array_equal(alone.animal_positions()[0], interleaved.animal_positions()[0])
+
+
+def test_without_movement_noise_the_seed_does_not_matter(workspace, animals, ndvi_gdf):
+    model = pytest.importorskip("model")
+    positions = []
+    for seed in (1, 2):
+        m = build(model, animals, ndvi_gdf, engine="array", seed=seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            m.step()
+        positions.append(m.animal_positions()[0].copy())
+    np.testing.assert_array_equal(positions[0], positions[1])
+    with pytest.raises(ValueError):
+        build(model, animals, ndvi_gdf, movement_noise=-1)
+
+
+def test_sweep_refuses_replicates_of_a_deterministic_model():
+    batch = pytest.importorskip("batch")
+    with pytest.raises(ValueError, match="movement_noise"):
+        batch.sweep([0.1], replicates=3)
+
+
+@pytest.mark.parametrize("engine", ["agent", "array"])
+@pytest.mark.parametrize("movement", ["global", "local"])
+def test_two_species_move_as_in_models_of_their_own(workspace, ndvi_gdf, engine, movement):
+    model = pytest.importorskip("model")
+    from conftest import make_animals
+
+    groups = [(make_animals(animal_name='EL', seed=0), 'EL'), (make_animals(25, animal_name='BF', seed=1), 'BF')]
+    mobility_ranges = {'EL': 0.3, 'BF': 0.1}
+    layer = model.SharedNDVILayer(ndvi_gdf)
+
+    def run(animal_name, mobility_range):
+        with contextlib.redirect_stdout(io.StringIO()):
+            m = model.AnimalModel(groups, layer, animal_name, ndvi_gdf['value'], engine=engine, movement=movement,
+                                  search_radius=2.0, mobility_range=mobility_range, seed=3, movement_noise=0.05,
+                                  profile=False)
+            for _ in range(4):
+                m.step()
+        return m
+
+    both = run(None, mobility_ranges)
+    x, y, counts = both.animal_positions()
+    ndvi = both.animal_ndvi_values()
+    for name in ('EL', 'BF'):
+        alone = run(name, mobility_ranges[name])
+        group = both.species_slices[name]
+        for values, expected in zip((x[group], y[group], counts[group], ndvi[group]),
+                                    (*alone.animal_positions(), alone.animal_ndvi_values())):
+            np.testing.assert_allclose(values, expected)
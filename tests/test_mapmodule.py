@@ -0,0 +1,63 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+
+mapmodule = pytest.importorskip("mapmodule")
+
+
+class Browser:
+    """Socket handler of one page, keeping the markers its map would show."""
+
+    def __init__(self, application):
+        self.handler = mapmodule.ViewportSocketHandler.__new__(mapmodule.ViewportSocketHandler)
+        self.handler.application = application
+        self.handler.write_message = self.receive
+        self.markers = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.handler.open()
+
+    def receive(self, message):
+        # As DeltaMapModule.js applies a render
+        data = message["data"][0]
+        for animal in data["removed"]:
+            self.markers.pop(animal, None)
+        for animal in data["added"]:
+            self.markers[animal[0]] = (animal[1], animal[2])
+        for animal, lat, lon in data["moved"]:
+            assert int(animal) in self.markers, "moved a marker the page never drew"
+            self.markers[int(animal)] = (lat, lon)
+
+    def refresh(self):
+        self.handler.write_message(self.handler.viz_state_message)
+
+
+def test_every_page_gets_deltas_from_what_it_was_sent(workspace, animals, ndvi_gdf):
+    model = pytest.importorskip("model")
+    element = mapmodule.DeltaMapModule(mapmodule.AnimalPortrayal(), viewport=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        application = mapmodule.DeltaModularServer(
+            model.AnimalModel, [element], "Test Model",
+            dict(gdf_animal=animals, gdf_ndvi=ndvi_gdf, animal_name='EL', ndvi_value=ndvi_gdf['value'],
+                 engine="array", mobility_range=0.3, profile=False))
+    application.verbose = False
+    animal_model = application.model
+
+    first = Browser(application)
+    first.refresh()
+    animal_model.step()
+    # A second page opens between two renders of the first
+    second = Browser(application)
+    second.refresh()
+    first.refresh()
+    animal_model.step()
+    first.refresh()
+    second.refresh()
+
+    # Both pages show every animal where it is now
+    lon, lat = animal_model.grid.Transformer.transform(*animal_model.animal_positions()[:2])
+    expected = np.column_stack([lat, lon])
+    for browser in (first, second):
+        assert sorted(browser.markers) == list(range(len(expected)))
+        shown = np.array([browser.markers[i] for i in range(len(expected))])
+        np.testing.assert_allclose(shown, expected, atol=10 ** -mapmodule.COORD_DECIMALS)
@@ -0,0 +1,46 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from conftest import make_ndvi
+
+sentinel = pytest.importorskip("sentinel")
+
+
+def test_cache_round_trip(tmp_path):
+    gdf_ndvi = make_ndvi(4)
+    cache_file = str(tmp_path / 'cache' / 'gdf_ndvi.arrow')
+    sentinel.write_ndvi_cache(gdf_ndvi, cache_file)
+    loaded = sentinel.read_ndvi_cache(cache_file)
+
+    assert loaded.index.tolist() == gdf_ndvi.index.tolist()
+    np.testing.assert_array_equal(loaded['value'].to_numpy(), gdf_ndvi['value'].to_numpy())
+    assert loaded.geometry.geom_equals(gdf_ndvi.geometry).all()
+    assert loaded.crs == gdf_ndvi.crs
+
+
+def test_cache_key_follows_the_raster_and_the_survey_area(tmp_path):
+    from shapely.geometry import box
+    raster = tmp_path / 'ndvi.tif'
+    raster.write_bytes(b'first')
+    area = box(0, 0, 1, 1)
+    key = sentinel.get_ndvi_cache_file(str(raster), True, area)
+
+    assert sentinel.get_ndvi_cache_file(str(raster), False, area) != key
+    assert sentinel.get_ndvi_cache_file(str(raster), True, box(0, 0, 2, 1)) != key
+    raster.write_bytes(b'second, longer')
+    assert sentinel.get_ndvi_cache_file(str(raster), True, area) != key
+
+
+def test_missing_raster_is_an_error_unless_legacy_data_is_asked_for(tmp_path, monkeypatch):
+    from shapely.geometry import box
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.dirname(sentinel.legacy_pickle))
+    with open(sentinel.legacy_pickle, 'wb') as file:
+        pickle.dump(make_ndvi(2), file)
+
+    with pytest.raises(FileNotFoundError):
+        sentinel.get_ndvi_gdf(True, True, box(0, 0, 1, 1))
+    with pytest.warns(UserWarning, match="legacy"):
+        gdf_ndvi = sentinel.get_ndvi_gdf(True, True, box(0, 0, 1, 1), legacy=True)
+    assert len(gdf_ndvi) == 4
@@ -0,0 +1,77 @@
+import contextlib
+import io
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import EXTENT, make_animals, make_ndvi
+
+predict = pytest.importorskip("predict")
+
+BOUNDS = (0.0, 0.0, EXTENT, EXTENT)
+
+
+def test_run_config_fills_in_the_defaults():
+    assert predict.run_config({}) == predict.EMULATOR_CONFIG
+    # As read back from a CSV of batch results
+    row = {'movement': 'local', 'boundary': 'slide', 'ndvi_interval': np.nan, 'movement_noise': 0.05}
+    assert predict.run_config(row) == {'movement': 'local', 'boundary': 'slide', 'ndvi_interval': None,
+                                       'movement_noise': 0.05}
+    assert predict.run_config({'ndvi_interval': 20.0})['ndvi_interval'] == 20
+
+
+def test_train_emulator_refuses_mixed_configurations():
+    results = pd.DataFrame([{'movement': 'global', 'boundary': 'stay'}, {'movement': 'local', 'boundary': 'stay'}])
+    with pytest.raises(ValueError, match="movement"):
+        predict.train_emulator(results, {}, BOUNDS)
+
+
+def test_emulator_keeps_its_configuration(workspace):
+    batch = pytest.importorskip("batch")
+    datasets = {('census', 2017): {'EL': make_animals()}, ('ndvi', True): make_ndvi()}
+    base = {'year': 2017, 'species': 'EL', 'cloudmask': True, 'replicate': 0, 'boundary': 'clamp'}
+    runs = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for run, mobility_range in enumerate((0.1, 0.3)):
+            params = dict(base, mobility_range=mobility_range, record_path=str(workspace / f'run_{run}.parquet'))
+            runs.append(batch.run_model(params, 3, datasets))
+        emulator, inputs = predict.train_emulator(pd.DataFrame(runs), datasets, BOUNDS, grid_cells=16)
+    assert emulator.config == dict(predict.EMULATOR_CONFIG, boundary='clamp')
+
+    emulator.save(str(workspace / 'emulator.json'))
+    loaded = predict.DensityEmulator.load(str(workspace / 'emulator.json'))
+    assert loaded.config == emulator.config
+    run_inputs = inputs[(2017, 'EL', True)]
+    np.testing.assert_allclose(loaded.predict(run_inputs, 0.2, 3), emulator.predict(run_inputs, 0.2, 3))
+
+    # Validation runs default to the configuration of the emulator, and may not change it
+    with contextlib.redirect_stdout(io.StringIO()):
+        validation = predict.validate_emulator(emulator, inputs, [dict(base, mobility_range=0.2)], 3, datasets)
+    assert validation.loc[0, 'boundary'] == 'clamp'
+    with pytest.raises(ValueError, match="trained for"):
+        predict.validate_emulator(emulator, inputs, [dict(base, mobility_range=0.2, movement='local')], 3, datasets)
+
+
+def test_emulator_trains_on_all_segments_of_a_resumed_run(workspace):
+    batch = pytest.importorskip("batch")
+    datasets = {('census', 2017): {'EL': make_animals()}, ('ndvi', True): make_ndvi()}
+    base = {'year': 2017, 'species': 'EL', 'cloudmask': True, 'replicate': 0, 'movement_noise': 0.1}
+    resumed, uninterrupted = [], []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for run, mobility_range in enumerate((0.1, 0.3)):
+            params = dict(base, mobility_range=mobility_range, record_path=str(workspace / f'run_{run}.parquet'),
+                          checkpoint_path=str(workspace / f'run_{run}.ckpt'))
+            # Interrupted after three steps, past its last checkpoint at step 2, then resumed there
+            batch.run_model(params, 3, datasets)
+            batch.run_model(dict(params, record_path=None, checkpoint_path=str(workspace / 'step2.ckpt')), 2, datasets)
+            os.replace(workspace / 'step2.ckpt', workspace / f'run_{run}.ckpt')
+            resumed.append(batch.run_model(params, 5, datasets))
+            uninterrupted.append(batch.run_model(
+                dict(base, mobility_range=mobility_range, record_path=str(workspace / f'full_{run}.parquet')),
+                5, datasets))
+        emulator, _ = predict.train_emulator(pd.DataFrame(resumed), datasets, BOUNDS, grid_cells=16)
+        expected, _ = predict.train_emulator(pd.DataFrame(uninterrupted), datasets, BOUNDS, grid_cells=16)
+
+    assert (workspace / 'run_0.step2.parquet').exists()
+    assert emulator.samples == expected.samples == 12
+    np.testing.assert_allclose(emulator.weights, expected.weights)
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pytest
+
+preprocess = pytest.importorskip("preprocess")
+
+
+@pytest.fixture
+def census_dir(tmp_path, monkeypatch):
+    """Run in a temporary directory, with the caches of the census loaders cleared."""
+    monkeypatch.chdir(tmp_path)
+    loaders = (preprocess.read_census_data, preprocess.get_census_store, preprocess._process_2017_population_data)
+    for loader in loaders:
+        loader.cache_clear()
+    yield tmp_path
+    for loader in loaders:
+        loader.cache_clear()
+
+
+def write_census_2017(n_rows=12):
+    import geopandas as gp
+
+    rng = np.random.default_rng(0)
+    os.makedirs(preprocess.census_path)
+    x, y = rng.uniform(1, 9, n_rows), rng.uniform(1, 9, n_rows)
+    gp.GeoDataFrame({'Species': np.where(np.arange(n_rows) % 3, 'EL', 'BF'),
+                     'Estimate': rng.integers(1, 20, n_rows).astype(float), 'X': x},
+                    geometry=gp.points_from_xy(x, y), crs="epsg:4326").to_file(
+        os.path.join(preprocess.census_path, 'census_data_2017.shp'))
+
+
+def test_census_store_without_census_raises(census_dir):
+    with pytest.raises(FileNotFoundError, match="census"):
+        preprocess.get_census_store()
+    with pytest.raises(ValueError, match="census year"):
+        preprocess.CensusStore.build(years=())
+
+
+def test_population_data_is_a_copy_per_call(census_dir):
+    write_census_2017()
+    (elephants, _), (buffalos, _) = preprocess.get_2017_population_data()
+    assert (len(elephants), len(buffalos)) == (8, 4)
+
+    elephants['EL'] = 0.0
+    elephants.drop(elephants.index[:2], inplace=True)
+
+    (fresh, name), _ = preprocess.get_2017_population_data()
+    assert name == 'EL'
+    assert len(fresh) == 8
+    assert (fresh['EL'] > 0).all()
+
+
+def test_census_store_keeps_the_crs_of_every_year(census_dir):
+    import geopandas as gp
+
+    write_census_2017()
+    # The 2008 census in a projected CRS, with one column of counts per species
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(2e5, 3e5, 6), rng.uniform(7e6, 8e6, 6)
+    gp.GeoDataFrame({'EL': [3.0, 0.0, 5.0, 1.0, 0.0, 2.0], 'BF': [0.0, 4.0, 0.0, 0.0, 6.0, 1.0]},
+                    geometry=gp.points_from_xy(x, y), crs="epsg:32735").to_file(
+        os.path.join(preprocess.census_path, 'census_data_2008.shp'))
+
+    store = preprocess.get_census_store()
+    # Written and memory mapped again, so the CRS survive the store file
+    assert store.partition_crs[(2008, 'EL')] == 'EPSG:32735'
+    assert store.partition_crs[(2017, 'EL')] == 'EPSG:4326'
+
+    elephants_2008 = store.frame(2008, 'EL')
+    assert elephants_2008.crs == "epsg:32735"
+    np.testing.assert_allclose(elephants_2008.geometry.x, x[[0, 2, 3, 5]])
+    assert store.frame(2017, 'BF').crs == "epsg:4326"
+    assert store.frame(2017, 'BF').geometry.x.between(1, 9).all()
@@ -0,0 +1,155 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+from affine import Affine
+from conftest import make_animals
+
+sentinel = pytest.importorskip("sentinel")
+
+# Geometry x is the raster y and geometry y the raster x, see sentinel.polygonize
+TRANSFORM = Affine(1.0, 0.0, 0.0, 0.0, -1.0, 10.0)
+
+
+def make_raster(values):
+    return sentinel.NDVIRaster(values, TRANSFORM, "epsg:4326")
+
+
+def step_models(model, raster, engines, steps=3):
+    with contextlib.redirect_stdout(io.StringIO()):
+        models = [model.AnimalModel(make_animals(), raster, 'EL', None, engine=engine, mobility_range=0.3,
+                                    profile=False) for engine in engines]
+        for _ in range(steps):
+            for m in models:
+                m.step()
+    return models
+
+
+def test_lookup_uses_the_cell_under_every_point():
+    values = np.arange(100, dtype=np.float32).reshape(10, 10) / 100
+    raster = make_raster(values)
+    # Geometry (x, y) lies in raster row 10 - x and column y
+    x, y = np.array([9.5, 0.5, 4.2, 20.0]), np.array([0.5, 9.5, 3.7, 1.0])
+    np.testing.assert_allclose(raster.lookup(x, y, fill=-1), [0.0, 0.99, 0.53, -1], rtol=1e-6)
+
+
+def test_raster_engines_match_when_every_pixel_is_its_own_patch(workspace):
+    model = pytest.importorskip("model")
+    values = np.random.default_rng(1).uniform(-1, 1, (10, 10)).astype(np.float32)
+    agent, array = step_models(model, make_raster(values), ("agent", "array"))
+    np.testing.assert_allclose(agent.animal_positions()[0], array.animal_positions()[0])
+    np.testing.assert_allclose(agent.animal_positions()[1], array.animal_positions()[1])
+
+
+def test_raster_array_engine_heads_for_pixel_centers_not_merged_patches(workspace):
+    # Documented difference: polygonize merges equal neighbouring pixels into one patch, whose
+    # centroid is the agent engine's destination; the array engine on a raster heads for a pixel
+    model = pytest.importorskip("model")
+    values = np.random.default_rng(1).uniform(-1, 0.5, (10, 10)).astype(np.float32)
+    values[4, 2:4] = 0.9
+    start = make_animals().geometry
+    x, y = start.x.to_numpy(), start.y.to_numpy()
+    agent, array = step_models(model, make_raster(values), ("agent", "array"), steps=1)
+
+    def destinations(m):
+        new_x, new_y, _ = m.animal_positions()
+        moved = (new_x != x) | (new_y != y)
+        assert moved.any()
+        return x[moved] + (new_x[moved] - x[moved]) / 0.3, y[moved] + (new_y[moved] - y[moved]) / 0.3
+
+    # Raster row 4 is geometry x 5.5; columns 2 and 3 are geometry y 2.5 and 3.5
+    np.testing.assert_allclose(np.column_stack(destinations(array)) - [5.5, 2.5], 0, atol=1e-9)
+    np.testing.assert_allclose(np.column_stack(destinations(agent)) - [5.5, 3.0], 0, atol=1e-9)
+
+
+def test_lazy_patches_are_polygonized_without_a_process_pool(monkeypatch):
+    from shapely.geometry import box
+    # More than one tile, in patches of 10 by 10 pixels
+    blocks = np.random.default_rng(2).uniform(-1, 1, (60, 60)).astype(np.float32)
+    values = np.kron(blocks, np.ones((10, 10), dtype=np.float32))
+    survey_area = box(-590, 0, 10, 600)
+    raster = sentinel.NDVIRaster(values, TRANSFORM, "epsg:4326", survey_area)
+    expected = sentinel.polygonize_tiled(values, TRANSFORM, "epsg:4326", survey_area, processes=1)
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("NDVIRaster.gdf must not start worker processes")
+
+    monkeypatch.setattr(sentinel, "ProcessPoolExecutor", no_pool)
+    # A pool would be started by default on more than one CPU
+    monkeypatch.setattr(sentinel.os, "cpu_count", lambda: 4)
+    gdf = raster.gdf
+    assert len(gdf) == len(expected)
+    np.testing.assert_allclose(gdf['value'].to_numpy(), expected['value'].to_numpy())
+
+
+@pytest.mark.parametrize("tile_size", [4, 5])
+def test_tiled_polygonize_matches_polygonize_within_the_survey_area(tile_size):
+    xr = pytest.importorskip("xarray")
+    from shapely.geometry import Polygon
+    # Patches of 3 by 3 pixels with few distinct values, so equal neighbours merge into larger patches
+    # that the tiles cut apart
+    blocks = np.random.default_rng(6).choice([0.1, 0.2, 0.3, 0.4], (8, 8)).astype(np.float32)
+    values = np.kron(blocks, np.ones((3, 3), dtype=np.float32))
+    transform = Affine(1.0, 0.0, 0.0, 0.0, -1.0, 24.0)
+    # One edge along pixel borders, one slanted through tiles and patches
+    survey_area = Polygon([(-1, -1), (25, -1), (25, 12), (10, 12), (-1, 17.5)])
+
+    tiled = sentinel.polygonize_tiled(values, transform, "epsg:4326", survey_area, tile_size=tile_size,
+                                      processes=1)
+    whole = sentinel.polygonize(xr.DataArray(values, dims=("y", "x"),
+                                             attrs={'transform': tuple(transform)[:6], 'crs': "epsg:4326"}))
+    expected = whole[whole.within(survey_area)]
+    assert 0 < len(expected) < len(whole)
+
+    def patches(gdf):
+        centroids = gdf.geometry.centroid
+        return sorted(zip(gdf['value'].round(6), centroids.x.round(9), centroids.y.round(9), gdf.geometry))
+
+    assert len(tiled) == len(expected)
+    for (value, x, y, polygon), (expected_value, expected_x, expected_y, expected_polygon) in zip(
+            patches(tiled), patches(expected)):
+        assert (value, x, y) == (expected_value, expected_x, expected_y)
+        assert polygon.equals(expected_polygon)
+
+
+@pytest.mark.parametrize("engine", ["agent", "array"])
+def test_model_steps_through_the_ndvi_dates_of_a_series(workspace, engine):
+    import rasterio
+    model = pytest.importorskip("model")
+    from conftest import make_ndvi
+
+    # Three dates on the grid of the NDVI patches, one pixel per patch
+    dates = np.random.default_rng(4).uniform(-1, 1, (3, 10, 10)).astype(np.float32)
+    path = str(workspace / 'series.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=10, height=10, count=3, dtype='float32',
+                       crs="epsg:4326", transform=TRANSFORM) as dst:
+        dst.write(dates)
+    series = sentinel.NDVISeries(path)
+    # Count the reads, including those of the background thread
+    reads = []
+    read = series.read
+    series.read = lambda date: reads.append(date) or read(date)
+
+    gdf_ndvi = make_ndvi()
+    centroids = gdf_ndvi.geometry.centroid
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        m = model.AnimalModel(make_animals(), gdf_ndvi, 'EL', None, engine=engine, mobility_range=0.3,
+                              ndvi_series=series, ndvi_interval=2, profile=False)
+        # The next date is read ahead while the first one is active
+        series._prefetch[1].result()
+        assert reads == [0, 1]
+        for step in range(1, 7):
+            m.step()
+            # A new date every two steps, staying at the last one
+            date = min(step // 2, 2)
+            assert m.ndvi_date == date
+            layer = make_raster(dates[date])
+            np.testing.assert_allclose(m.ndvi_index.values, layer.lookup(centroids.x, centroids.y), rtol=1e-6)
+            # The animals see the values of the active date
+            x, y, _ = m.animal_positions()
+            np.testing.assert_allclose(m.animal_ndvi_values(), layer.lookup(x, y, fill=model.NO_NDVI), rtol=1e-6)
+    series.close()
+
+    # Every date is read once
+    assert reads == [0, 1, 2]
+    assert "NDVI date" not in output.getvalue()
@@ -0,0 +1,46 @@
+import asyncio
+import contextlib
+import io
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from conftest import make_animals, make_ndvi
+
+session = pytest.importorskip("session")
+
+
+def make_handler(build_wait):
+    # The parts of a socket handler _latest_snapshot uses, without a running server
+    handler = session.SessionSocketHandler.__new__(session.SessionSocketHandler)
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-wait")
+    handler.application = types.SimpleNamespace(wait_executor=executor, build_wait=build_wait)
+    handler.runner = session.ModelRunner()
+    return handler
+
+
+def test_latest_snapshot_gives_up_on_a_model_that_is_not_built_in_time(workspace):
+    model = pytest.importorskip("model")
+    handler = make_handler(build_wait=0.1)
+    release = threading.Event()
+
+    def build():
+        release.wait(10)
+        ndvi_gdf = make_ndvi()
+        with contextlib.redirect_stdout(io.StringIO()):
+            return model.AnimalModel(make_animals(), ndvi_gdf, 'EL', ndvi_gdf['value'], engine="array",
+                                     profile=False)
+
+    handler.runner.reset(build)
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        assert asyncio.run(handler._latest_snapshot()) is None
+    assert "not built" in output.getvalue()
+    # The wait ran on the server's own threads
+    assert any(thread.name.startswith("session-wait") for thread in threading.enumerate())
+
+    release.set()
+    handler.application.build_wait = 10
+    snapshot = asyncio.run(handler._latest_snapshot())
+    assert snapshot is not None and snapshot.steps == 0
+    handler.runner.close()
+    handler.application.wait_executor.shutdown()
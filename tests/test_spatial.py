@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from spatial import NDVIIndex
+
+
+def test_ndvi_index_max_breaks_ties_by_position():
+    index = NDVIIndex(['a', 'b', 'c', 'd'], [0.2, 0.7, 0.7, -0.1])
+    assert index.argmax() == 1
+    assert index.max() == ('b', 0.7)
+
+
+def test_ndvi_index_follows_updates():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-1, 1, 50)
+    index = NDVIIndex(range(50), values)
+
+    # Many more updates than cells, so outdated heap entries are rebuilt away too
+    for _ in range(500):
+        key, value = int(rng.integers(50)), float(rng.uniform(-1, 1))
+        index.update(key, value)
+        values[key] = value
+        assert index.argmax() == int(np.argmax(values))
+    assert len(index._heap) <= 2 * len(index) + 64
+
+
+def test_ndvi_index_top_k_is_sorted_and_keeps_the_heap():
+    values = [0.1, 0.9, -0.5, 0.4, 0.9, 0.3]
+    index = NDVIIndex(range(6), values)
+    assert index.top_k(3) == [(1, 0.9), (4, 0.9), (3, 0.4)]
+    # Asking again gives the same answer
+    assert index.top_k(3) == [(1, 0.9), (4, 0.9), (3, 0.4)]
+    assert index.top_k(10) == sorted(zip(range(6), values), key=lambda item: (-item[1], item[0]))
+
+
+def test_ndvi_index_assign_replaces_all_values_in_place():
+    index = NDVIIndex(range(4), [0.1, 0.2, 0.3, 0.4])
+    values = index.values
+    index.assign([0.9, 0.1, 0.1, 0.1])
+    assert index.values is values
+    assert index.argmax() == 0
+    with pytest.raises(ValueError):
+        index.assign([0.1, 0.2])
+
+
+def test_ndvi_index_rejects_mismatched_keys_and_empty_max():
+    with pytest.raises(ValueError):
+        NDVIIndex(range(3), [0.1, 0.2])
+    with pytest.raises(ValueError):
+        NDVIIndex([], []).argmax()
+
+
+# SplitGeoSpace relies on the dict of agents that mesa-geo 0.2 keeps on its R-tree, see requirements.txt
+requires_mesa_geo_0_2 = pytest.mark.skipif(not __import__('mesa_geo').__version__.startswith('0.2.'),
+                                           reason="SplitGeoSpace needs mesa-geo 0.2")
+
+
+def make_space(cells, movers, reload_fraction=0.05):
+    from spatial import SplitGeoSpace
+
+    space = SplitGeoSpace(crs="epsg:4326", reload_fraction=reload_fraction)
+    space.add_static_agents(cells)
+    space.add_agents(movers)
+    return space
+
+
+def assert_matches_geospace(space, agents):
+    """Queries of the space give the same agents as a GeoSpace built anew from agents."""
+    from mesa_geo import GeoSpace
+
+    expected = GeoSpace(crs="epsg:4326")
+    expected.add_agents(list(agents))
+
+    def ids(found):
+        return sorted(agent.unique_id for agent in found)
+
+    assert ids(space.agents) == ids(agents)
+    for agent in agents:
+        assert ids(space.get_intersecting_agents(agent)) == ids(expected.get_intersecting_agents(agent))
+        assert ids(space.get_neighbors_within_distance(agent, 0.5)) == ids(
+            expected.get_neighbors_within_distance(agent, 0.5))
+        assert ids(space.get_neighbors(agent)) == ids(expected.get_neighbors(agent))
+    assert space.bbox == pytest.approx(list(expected.bbox))
+
+
+@requires_mesa_geo_0_2
+@pytest.mark.parametrize("moves", [1, 12])
+def test_split_geo_space_matches_geo_space_after_moves_and_removals(moves):
+    from mesa_geo.geoagent import GeoAgent
+    from shapely.geometry import box
+
+    # Stationary cells of a 5 by 5 grid, and small squares that move across them
+    cells = [GeoAgent(f'cell{i}', None, box(i % 5, i // 5, i % 5 + 1, i // 5 + 1)) for i in range(25)]
+    rng = np.random.default_rng(0)
+
+    def square(x, y):
+        return box(x - 0.1, y - 0.1, x + 0.1, y + 0.1)
+
+    movers = [GeoAgent(f'animal{i}', None, square(*rng.uniform(0, 5, 2))) for i in range(20)]
+    space = make_space(cells, movers)
+    assert_matches_geospace(space, cells + movers)
+
+    # One move updates the index agent by agent, many moves reload it; some leave the grid
+    for agent in movers[:moves]:
+        agent.shape = square(*rng.uniform(-1, 6, 2))
+    assert space.refresh() == moves
+    assert space.refresh() == 0
+    assert_matches_geospace(space, cells + movers)
+
+    # Removing a moved agent uses the bounds it is indexed with
+    space.remove_agent(movers[0])
+    space.remove_agent(cells[12])
+    assert_matches_geospace(space, cells[:12] + cells[13:] + movers[1:])
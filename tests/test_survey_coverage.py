@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+survey_coverage = pytest.importorskip("survey_coverage")
+gp = pytest.importorskip("geopandas")
+from shapely.geometry import LineString, Point, box
+
+# Projected CRS, so strip widths and coordinates are both in metres
+CRS = "epsg:32736"
+
+
+@pytest.fixture
+def blocks():
+    # Two by two blocks of 2 km, with ids that are not their positions
+    cells = [box(i * 2000, j * 2000, (i + 1) * 2000, (j + 1) * 2000) for i in range(2) for j in range(2)]
+    return gp.GeoDataFrame(geometry=cells, crs=CRS, index=['B7', 'B3', 'B9', 'B1'])
+
+
+@pytest.fixture
+def tracks():
+    # North-south flight lines through x=500 and x=2500
+    return gp.GeoDataFrame(geometry=[LineString([(500, 0), (500, 4000)]), LineString([(2500, 0), (2500, 4000)])],
+                           crs=CRS)
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-500, 4500, n), rng.uniform(-500, 4500, n)
+
+
+def test_cover_points_finds_the_first_covering_polygon():
+    polygons = gp.GeoSeries([box(0, 0, 2, 2), box(1, 1, 3, 3), box(5, 5, 6, 6)])
+    x, y = np.random.default_rng(1).uniform(-1, 7, (2, 500))
+
+    expected = [next((i for i, polygon in enumerate(polygons) if Point(px, py).within(polygon)), -1)
+                for px, py in zip(x, y)]
+    np.testing.assert_array_equal(survey_coverage.cover_points(x, y, polygons), expected)
+    assert survey_coverage.cover_points([], [], polygons).shape == (0,)
+
+
+def test_index_places_cells_observations_and_positions(tmp_path, blocks, tracks):
+    cell_x, cell_y = random_points(300, seed=2)
+    observation_x, observation_y = random_points(100, seed=3)
+    index = survey_coverage.CoverageIndex.build(cell_x, cell_y, blocks, tracks, observation_x, observation_y,
+                                         strip_width=300, resolution=10)
+    strips = survey_coverage.flight_strips(tracks, 300)
+
+    np.testing.assert_array_equal(index.cell_block, survey_coverage.cover_points(cell_x, cell_y, blocks.geometry))
+    np.testing.assert_array_equal(index.observation_strip,
+                                  survey_coverage.cover_points(observation_x, observation_y, strips))
+    assert index.block_ids == ['B7', 'B3', 'B9', 'B1']
+
+    # Grid lookup of positions away from block and strip edges
+    x, y = np.array([1000.0, 2500.0, 500.0, 3200.0]), np.array([1000.0, 3000.0, 2900.0, 5000.0])
+    block, strip = index.lookup(x, y)
+    np.testing.assert_array_equal(block, [0, 3, 1, -1])
+    np.testing.assert_array_equal(strip, [-1, 1, 0, -1])
+    np.testing.assert_allclose(index.block_totals(block, [1, 2, 4, 8]), [1, 4, 0, 2])
+    np.testing.assert_allclose(index.block_totals(block, [1, 2, 4, 8], strip), [0, 4, 0, 2])
+
+    index.save(str(tmp_path / 'coverage.arrow'))
+    loaded = survey_coverage.CoverageIndex.load(str(tmp_path / 'coverage.arrow'))
+    np.testing.assert_array_equal(loaded.grid_block, index.grid_block)
+    np.testing.assert_array_equal(loaded.observation_strip, index.observation_strip)
@@ -6,14 +6,17 @@ Use this file for any visualisations.
 
 import contextily as ctx
 import geoplot as gplt
+import numpy as np
 from osgeo import gdal
 import matplotlib.pyplot as plt
+from density import census_density
 
 
-def plot_density(gdf, name) -> None:
+def plot_density(gdf, name, bandwidth=None) -> None:
     """Plot the density and locations of a specific species.
     :param gdf: GeoDataframe holding population count values for a species.
     :param name: Name of species to visualize. Currently only elephant ('EL')  / buffalo ('BF') available. 
+    :param bandwidth: Standard deviation of the density kernel in CRS units, defaults to Scott's rule.
     """
 
     # Set colors
@@ -27,8 +30,12 @@ def plot_density(gdf, name) -> None:
     # Pointplot showing animals, scaled with number of observations
     ax = gplt.pointplot(gdf, ax=ax, scale=name, limits=(2, 16), color=COLOR, edgecolor='black', zorder=2,
                         legend=True, legend_var='scale', legend_kwargs={'loc': 'lower right'})
-    # KDEplot showing distribution of animals.
-    ax = gplt.kdeplot(gdf, shade=True, cmap=CMAP, alpha=0.5, zorder=1, ax=ax)
+    # Density of animals, weighted by count; cached, so plotting again is free
+    density = census_density(gdf, name, bandwidth=bandwidth)
+    # Leave the lowest densities out, like a shaded kdeplot
+    values = np.ma.masked_less(density.values, 0.05 * density.values.max())
+    ax.imshow(values, origin='lower', extent=density.extent, cmap=CMAP, alpha=0.5, zorder=1,
+              interpolation='bilinear', aspect='auto')
 
     # Add geographical reference map
     ctx.add_basemap(ax, crs=gdf.crs,